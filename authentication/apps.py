@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AuthenticationConfig(AppConfig):
     name = 'authentication'
     verbose_name = 'Authentication'
+
+    def ready(self):
+        from authentication import checks  # noqa: F401
@@ -0,0 +1,36 @@
+from django.core.checks import Tags, Warning, register
+from django.db import DatabaseError
+
+from authentication.predicates import compile_predicate
+
+
+@register(Tags.database)
+def check_usertype_validations(app_configs=None, databases=None, **kwargs) -> list:
+    """
+    Check that the validations of the stored UserTypes can be compiled,
+    otherwise the users could not be synchronized.
+    Run before migrations and with `manage.py check --database default`,
+    only as warnings so that deployments fixing them are not blocked.
+    """
+    from authentication.models import UserType
+
+    warnings = []
+    for database in databases or ():
+        try:
+            usertypes = UserType.objects.using(database).values_list('pk', 'validation')
+            usertypes = list(usertypes)
+        except DatabaseError:
+            # Not migrated yet
+            continue
+
+        for pk, validation in usertypes:
+            try:
+                compile_predicate(validation)
+            except ValueError as error:
+                warnings.append(Warning(
+                    f"The validation of UserType '{pk}' is not allowed: {error}",
+                    hint="Rewrite it in the admin, see authentication.predicates",
+                    obj=validation,
+                    id='authentication.W001',
+                ))
+    return warnings
@@ -0,0 +1,244 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from threading import Lock
+from uuid import UUID
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core import metrics
+from core.models import fetch_data_from_api
+from authentication.models import User, UserType
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+PROFILE_CACHE_KEY = "user-profile:{pk}"
+PROFILE_TIMEOUT = int(settings.USER_PROFILE_CACHE_TIMEOUT.total_seconds())
+PROFILE_REFRESH_AFTER = settings.USER_PROFILE_REFRESH_AFTER.total_seconds()
+
+# Maximum number of ids in a single users/[id1,id2,...] call
+MAX_IDS_PER_CALL = 50
+
+# Profile data with the time it was fetched at
+Entry = Tuple[dict, float]
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process Least Recently Used cache
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._data = OrderedDict()
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: str, value: Entry) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+local_profiles = LRUCache(settings.USER_PROFILE_LRU_SIZE)
+
+# Background refreshes of stale profiles per user pk
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='profile-refresh')
+_refreshes = {}
+_refreshes_lock = Lock()
+
+
+# --------------------------------------------
+#   Profile cache
+# --------------------------------------------
+
+def get_cached_profiles(pks: Sequence[str]) -> Dict[str, Entry]:
+    """
+    Get the cached profiles, first from the process then from the Django cache
+    """
+    entries, missing = {}, []
+    for pk in pks:
+        entry = local_profiles.get(pk)
+        if entry is None:
+            missing.append(pk)
+        else:
+            entries[pk] = entry
+            metrics.incr('cache.profile.local_hits')
+
+    if missing:
+        keys = { PROFILE_CACHE_KEY.format(pk=pk): pk for pk in missing }
+        found = cache.get_many(keys)
+        for key, entry in found.items():
+            local_profiles.set(keys[key], entry)
+            entries[keys[key]] = entry
+        metrics.incr('cache.profile.hits', len(found))
+        metrics.incr('cache.profile.misses', len(missing) - len(found))
+
+    return entries
+
+
+def cache_profiles(profiles: Dict[str, dict]) -> None:
+    """
+    Store fetched profiles in both cache tiers
+    """
+    fetched_at = time.time()
+    entries = { pk: (data, fetched_at) for pk, data in profiles.items() }
+    for pk, entry in entries.items():
+        local_profiles.set(pk, entry)
+    cache.set_many({ PROFILE_CACHE_KEY.format(pk=pk): entry for pk, entry in entries.items() },
+                   PROFILE_TIMEOUT)
+
+
+def clear_profile(pk: str) -> None:
+    """
+    Remove a profile from the cache of this process and the Django cache
+    """
+    local_profiles.delete(str(pk))
+    cache.delete(PROFILE_CACHE_KEY.format(pk=pk))
+
+
+def fetch_profiles(pks: Sequence[str], oauth_client=None) -> Dict[str, dict]:
+    """
+    Fetch and cache the profiles from the portal with one call per MAX_IDS_PER_CALL users
+    """
+    profiles = {}
+    for i in range(0, len(pks), MAX_IDS_PER_CALL):
+        chunk = tuple(pks[i:i + MAX_IDS_PER_CALL])
+        data = fetch_data_from_api(User, oauth_client, pk=chunk if len(chunk) > 1 else UUID(chunk[0]))
+        for profile in (data if isinstance(data, list) else [ data ]):
+            profiles[str(profile['id'])] = profile
+
+    cache_profiles(profiles)
+    return profiles
+
+
+def _refresh_profiles(pks: Sequence[str], oauth_client) -> None:
+    try:
+        fetch_profiles(pks, oauth_client)
+    except Exception:
+        logger.exception(f"Failed to refresh the profiles of {len(pks)} users")
+    finally:
+        with _refreshes_lock:
+            for pk in pks:
+                _refreshes.pop(pk, None)
+
+
+def schedule_refresh(pks: Iterable[str], oauth_client=None) -> Optional[Future]:
+    """
+    Refresh the profiles in the background, unless already being refreshed
+    """
+    with _refreshes_lock:
+        pks = [ pk for pk in pks if pk not in _refreshes ]
+        if not pks:
+            return None
+
+        # The request's client may be closed before the refresh is done
+        if oauth_client is not None:
+            from authentication.oauth import OAuthAPI
+            oauth_client = OAuthAPI(oauth_client.provider, config=oauth_client.config)
+
+        future = _refresh_executor.submit(_refresh_profiles, pks, oauth_client)
+        for pk in pks:
+            _refreshes[pk] = future
+    return future
+
+
+def wait_for_refreshes(timeout: float=None) -> None:
+    """
+    Wait for the background refreshes to finish
+    """
+    with _refreshes_lock:
+        futures = set(_refreshes.values())
+    wait(futures, timeout)
+
+
+def get_profiles(pks: Iterable[str], oauth_client=None) -> Dict[str, dict]:
+    """
+    Get the profiles of the users from the portal:
+    - fresh cached profiles are directly returned
+    - stale ones are returned and refreshed in the background
+    - missing ones are fetched together
+    """
+    pks = list(dict.fromkeys(str(pk) for pk in pks))
+    entries = get_cached_profiles(pks)
+
+    profiles, stale = {}, []
+    now = time.time()
+    for pk, (data, fetched_at) in entries.items():
+        profiles[pk] = data
+        if now - fetched_at > PROFILE_REFRESH_AFTER:
+            stale.append(pk)
+
+    if stale:
+        metrics.incr('cache.profile.stale', len(stale))
+        schedule_refresh(stale, oauth_client)
+
+    missing = [ pk for pk in pks if pk not in entries ]
+    if missing:
+        profiles.update(fetch_profiles(missing, oauth_client))
+
+    return profiles
+
+
+# --------------------------------------------
+#   User hydration
+# --------------------------------------------
+
+def hydrate_users(users: Iterable[User], oauth_client=None, save: bool=True) -> List[User]:
+    """
+    Add the portal data to the users which don't have it yet, fetching them together
+    """
+    users = list(users)
+    to_hydrate = [ user for user in users if not user.fetched_data ]
+    if not to_hydrate:
+        return users
+
+    profiles = get_profiles((user.pk for user in to_hydrate), oauth_client)
+    usertypes = list(UserType.objects.all())
+    to_update, updated_fields = [], set()
+    for user in to_hydrate:
+        data = profiles.get(str(user.pk))
+        if data is None:
+            logger.warning(f"No profile found for user {user.pk}")
+            continue
+
+        # Copy the data as the profile is shared within the process
+        user_updated_fields = user.sync_data(dict(data), usertypes=usertypes, save=False)
+        if user_updated_fields:
+            to_update.append(user)
+            updated_fields |= user_updated_fields
+
+    if save and to_update:
+        User.objects.bulk_update(to_update, updated_fields)
+
+    return users
+
+
+def hydrate_user(user: User, oauth_client=None, save: bool=True) -> User:
+    """
+    Add the portal data to a user and cache it for the authentication backend
+    """
+    if not user.fetched_data:
+        hydrate_users([ user ], oauth_client, save=save)
+        if user.fetched_data:
+            user.save_to_cache(user, { 'pk': user.pk })
+    return user
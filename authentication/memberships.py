@@ -0,0 +1,37 @@
+from typing import Iterable, Set
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core import metrics
+from authentication.models import User
+
+MEMBERSHIP_CACHE_KEY = "user-assos:{pk}"
+MEMBERSHIP_TIMEOUT = int(settings.MEMBERSHIP_CACHE_TIMEOUT.total_seconds())
+
+
+def set_managed_asso_ids(user_pk: str, asso_ids: Iterable[str]) -> None:
+    cache.set(MEMBERSHIP_CACHE_KEY.format(pk=user_pk), { str(pk) for pk in asso_ids }, MEMBERSHIP_TIMEOUT)
+
+
+def clear_managed_asso_ids(user_pk: str) -> None:
+    """
+    Invalidate the associations of a user, for example when their rights change
+    """
+    cache.delete(MEMBERSHIP_CACHE_KEY.format(pk=user_pk))
+
+
+def get_managed_asso_ids(user: User, session=None) -> Set[str]:
+    """
+    Get the ids of the associations managed by the user,
+    only fetched from the portal with the session's token if not cached
+    """
+    asso_ids = cache.get(MEMBERSHIP_CACHE_KEY.format(pk=user.pk))
+    metrics.incr('cache.membership.misses' if asso_ids is None else 'cache.membership.hits')
+    if asso_ids is None:
+        from authentication.oauth import OAuthAPI
+        user.sync_assos(oauth_client=OAuthAPI(session=session))
+        set_managed_asso_ids(user.pk, user.assos)
+    else:
+        user.assos = asso_ids
+    return user.assos
@@ -2,10 +2,12 @@ from typing import Set
 
 from django.db import models
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.contrib.auth.models import AbstractBaseUser
 
 from core.models import APIModel
 from authentication.exceptions import UserTypeValidationError
+from authentication.predicates import clear_predicate, compile_predicate, get_predicate
 
 NAME_FIELD_MAXLEN = 100
 
@@ -17,17 +19,32 @@ class UserType(models.Model):
 
     def check_user(self, user: 'User') -> bool:
         """
-        Check if the user has the current type
+        Check if the user has the current type,
+        with the validation compiled once, see authentication.predicates
         """
         if not isinstance(user, User):
             raise ValueError("Provided user must be an instance of authentication.User")
         if settings.STAGE != "test" and not getattr(user, 'fetched_data', None):
             raise ValueError("User full data must be fetched first")
         try:
-            return eval(self.validation, {}, { 'user': user })
+            return get_predicate(self)(user)
         except Exception as error:
             raise UserTypeValidationError.from_usertype(self) from error
 
+    def clean(self) -> None:
+        try:
+            compile_predicate(self.validation)
+        except ValueError as error:
+            raise ValidationError({ 'validation': str(error) }) from error
+
+    def save(self, *args, **kwargs) -> None:
+        super().save(*args, **kwargs)
+        clear_predicate(self.pk)
+
+    def delete(self, *args, **kwargs):
+        clear_predicate(self.pk)
+        return super().delete(*args, **kwargs)
+
     def __str__(self) -> str:
         return self.name
 
@@ -48,6 +65,7 @@ class User(AbstractBaseUser, APIModel):
     # Relations
     types = None
     assos = None
+    CACHED_ATTRIBUTES = ('types', 'assos')
 
     # Rights
     is_admin = models.BooleanField(default=False)
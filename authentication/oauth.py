@@ -10,8 +10,11 @@ from django.contrib.auth.backends import ModelBackend
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 
+from core import metrics
 from core.helpers import filter_dict_keys
 from authentication.exceptions import OAuthException, OAuthTokenException
+from authentication.hydration import hydrate_user
+from authentication.memberships import clear_managed_asso_ids
 
 OAUTH_TOKEN_NAME = 'oauth_token'
 
@@ -34,7 +37,7 @@ def get_user_from_request(request) -> UserOrNone:
         # Add api data and return user
         try:
             oauth_client = OAuthAPI(session=request.session)
-            return user.get_with_api_data(oauth_client)
+            return hydrate_user(user, oauth_client)
         except OAuthTokenException:
             # Flush session
             oauth_client.logout(request)
@@ -47,6 +50,9 @@ def get_user_from_request(request) -> UserOrNone:
 
     try:
         oauth_client = OAuthAPI(session=request.session)
+        user = UserModel.objects.filter(pk=user_id).first()
+        if user is not None:
+            return hydrate_user(user, oauth_client)
         return UserModel.objects.get_with_api_data(oauth_client, pk=user_id)
     except UserModel.DoesNotExist:
         raise AuthenticationFailed("user_id does not match a user")
@@ -134,6 +140,7 @@ class OAuthAPI:
 
         # Fetch and login user into Django, then create session
         user = self.fetch_user()
+        clear_managed_asso_ids(user.pk)
         request.user = user
         django_auth.login(request, user)
         request.session['user_id'] = str(user.id)
@@ -154,6 +161,8 @@ class OAuthAPI:
         #   self.client.revoke_token(url, token)
 
         # Logout from Django
+        if getattr(request.user, 'is_authenticated', False):
+            clear_managed_asso_ids(request.user.pk)
         request.user = None
         django_auth.logout(request)
 
@@ -166,14 +175,16 @@ class OAuthAPI:
         """
         if self.client.token:
             try:
-                resp = self.client.get(self.config['base_url'] + query)
+                with metrics.timer('oauth'):
+                    resp = self.client.get(self.config['base_url'] + query)
             except AuthlibBaseError as error:
                 code = getattr(error, 'error', None)
                 raise OAuthTokenException(code=code) from error
         else:
             # Try vanilla request if no token is specified
             try:
-                resp = requests.get(self.config['base_url'] + query)
+                with metrics.timer('oauth'):
+                    resp = requests.get(self.config['base_url'] + query)
                 if not resp.ok:
                     resp.raise_for_status()
             except requests.RequestException as error:
@@ -0,0 +1,97 @@
+from typing import Callable
+from threading import Lock
+import ast
+
+# Functions that can be called in the validation of a UserType
+SAFE_FUNCTIONS = {
+    'str': str,
+    'int': int,
+    'bool': bool,
+    'len': len,
+}
+
+# Read-only methods that can be called on the data of the user,
+# for example user.fetched_data.get('types', {})
+SAFE_METHODS = {
+    'get', 'keys', 'values', 'items',
+    'lower', 'upper', 'strip', 'startswith', 'endswith', 'count',
+}
+
+# Nodes allowed in a validation, which must be a simple expression on the user
+ALLOWED_NODES = (
+    ast.Expression, ast.Load,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.UnaryOp, ast.Not,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.In, ast.NotIn, ast.Is, ast.IsNot,
+    ast.IfExp, ast.Call, ast.Name, ast.Attribute, ast.Subscript, ast.Constant,
+    ast.List, ast.Tuple, ast.Set, ast.Dict,
+    # Python 3.8 nodes
+    *(getattr(ast, name) for name in ('Index', 'NameConstant', 'Str', 'Num') if hasattr(ast, name)),
+)
+
+Predicate = Callable[['User'], bool]
+
+_predicates = {}
+_predicates_lock = Lock()
+
+
+def check_node(node: ast.AST) -> None:
+    """
+    Raise a ValueError if the node is not allowed in a validation
+    """
+    if not isinstance(node, ALLOWED_NODES):
+        raise ValueError(f"'{type(node).__name__}' n'est pas autorisé")
+    if isinstance(node, ast.Name) and node.id != 'user' and node.id not in SAFE_FUNCTIONS:
+        raise ValueError(f"'{node.id}' n'est pas défini")
+    if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+        raise ValueError(f"L'attribut '{node.attr}' n'est pas accessible")
+    if isinstance(node, ast.Call):
+        is_function = isinstance(node.func, ast.Name) and node.func.id in SAFE_FUNCTIONS
+        is_method = isinstance(node.func, ast.Attribute) \
+            and node.func.attr in SAFE_METHODS
+        if not (is_function or is_method):
+            functions = ", ".join((*SAFE_FUNCTIONS, *sorted(SAFE_METHODS)))
+            raise ValueError(f"Seules les fonctions {functions} peuvent être appelées")
+        if node.keywords:
+            raise ValueError("Les arguments nommés ne sont pas autorisés")
+
+
+def compile_predicate(source: str) -> Predicate:
+    """
+    Parse and check a validation expression once and compile it into a predicate on users
+    """
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as error:
+        raise ValueError(f"Expression invalide : {error.msg}") from error
+
+    for node in ast.walk(tree):
+        check_node(node)
+
+    code = compile(tree, '<usertype>', 'eval')
+    namespace = { '__builtins__': {}, **SAFE_FUNCTIONS }
+
+    def predicate(user: 'User') -> bool:
+        return bool(eval(code, namespace, { 'user': user }))
+
+    return predicate
+
+
+def get_predicate(usertype: 'UserType') -> Predicate:
+    """
+    Get the compiled predicate of a UserType, cached until its validation changes
+    """
+    cached = _predicates.get(usertype.pk)
+    if cached is not None and cached[0] == usertype.validation:
+        return cached[1]
+
+    predicate = compile_predicate(usertype.validation)
+    with _predicates_lock:
+        _predicates[usertype.pk] = (usertype.validation, predicate)
+    return predicate
+
+
+def clear_predicate(pk: str) -> None:
+    with _predicates_lock:
+        _predicates.pop(pk, None)
@@ -1,5 +1,31 @@
+from typing import List
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import unquote
+import logging
+import pickle
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.test import tag, SimpleTestCase
+from rest_framework.test import APITestCase
+
+from core.faker import FakeModelFactory
 from core.testcases import APIModelViewSetTestCase, ModelViewSetTestCase, get_permissions_from_compact
+from authentication.checks import check_usertype_validations
+from authentication.exceptions import UserTypeValidationError
+from authentication.hydration import (
+    cache_profiles, clear_profile, get_profiles, hydrate_user, hydrate_users, local_profiles, wait_for_refreshes
+)
 from authentication.models import User, UserType
+from authentication.oauth import OAuthAPI
+from authentication.predicates import compile_predicate, get_predicate
+
+logger = logging.getLogger(f"woolly.{__name__}")
 
 
 class UserViewSetTestCase(APIModelViewSetTestCase):
@@ -25,3 +51,249 @@ class UserTypeViewSetTestCase(ModelViewSetTestCase):
     })
 
 # TODO Test user retrieval from API
+
+
+class StubPortalHandler(BaseHTTPRequestHandler):
+    """
+    Minimal portal API serving the resources of the server by id:
+    /users, /users/[id1,id2] or /users/id
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = unquote(self.path.split('?')[0]).strip('/')
+        self.server.paths.append(path)
+        name, _, ids = path.partition('/')
+        resources = self.server.resources[name]
+        if not ids:
+            data = list(resources.values())
+        elif ids.startswith('['):
+            data = [ resources[pk] for pk in ids[1:-1].split(',') ]
+        else:
+            data = resources[ids]
+
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubPortalTestMixin:
+    """
+    Serve a stub portal to the test case, reachable with get_oauth_client
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubPortalHandler)
+        cls.server.daemon_threads = True
+        cls.server.resources = {}
+        cls.server.paths = []
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def get_oauth_client(self) -> OAuthAPI:
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        return OAuthAPI(config={ **settings.OAUTH['portal'], 'base_url': base_url })
+
+
+@tag('auth', 'hydration')
+class UserHydrationTestCase(StubPortalTestMixin, APITestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        self.users = self.factory.create(User, nb=3)
+        self.server.paths = []
+        self.server.resources['users'] = {
+            str(user.pk): {
+                'id': str(user.pk),
+                'email': user.email,
+                'firstname': "Portal",
+                'lastname': user.last_name,
+                'types': { 'admin': False },
+            }
+            for user in self.users
+        }
+        for user in self.users:
+            clear_profile(user.pk)
+        self.oauth_client = self.get_oauth_client()
+
+    def get_fresh_users(self) -> List[User]:
+        return list(User.objects.filter(pk__in=[ user.pk for user in self.users ]))
+
+    def test_batched_hydration(self):
+        users = hydrate_users(self.get_fresh_users(), self.oauth_client)
+        self.assertEqual(len(self.server.paths), 1)
+        self.assertTrue(self.server.paths[0].startswith('users/['))
+        for user in users:
+            self.assertEqual(user.fetched_data['first_name'], "Portal")
+            self.assertIsNotNone(user.types)
+        # Updated fields are saved
+        self.assertEqual(User.objects.filter(first_name="Portal").count(), len(self.users))
+
+        # From the process then from the Django cache
+        for _ in range(2):
+            users = hydrate_users(self.get_fresh_users(), self.oauth_client)
+            self.assertTrue(all(user.fetched_data for user in users))
+            local_profiles.clear()
+        self.assertEqual(len(self.server.paths), 1)
+
+    def test_stale_while_revalidate(self):
+        user = self.users[0]
+        hydrate_user(user, self.oauth_client)
+        self.server.resources['users'][str(user.pk)]['lastname'] = "Renamed"
+
+        # Age the cached profile
+        pk = str(user.pk)
+        data, fetched_at = local_profiles.get(pk)
+        cache_profiles({ pk: data })
+        local_profiles.set(pk, (data, fetched_at - settings.USER_PROFILE_REFRESH_AFTER.total_seconds() - 1))
+
+        # The stale profile is returned while being refreshed
+        profiles = get_profiles([ pk ], self.oauth_client)
+        self.assertNotEqual(profiles[pk]['last_name'], "Renamed")
+        wait_for_refreshes()
+        self.assertEqual(len(self.server.paths), 2)
+        self.assertEqual(get_profiles([ pk ])[pk]['last_name'], "Renamed")
+
+
+@tag('auth', 'cache', 'benchmark')
+class UserCacheCodecTestCase(SimpleTestCase):
+    """
+    Test and benchmark the compact form of the users in cache
+    """
+    factory = FakeModelFactory()
+    n_users = 1000
+
+    def get_user(self) -> User:
+        user = User(**self.factory.get_attributes(User))
+        user.sync_data({
+            'id': str(user.pk),
+            'email': user.email,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'is_admin': False,
+            'types': { 'admin': False, 'cas': True, 'contributorBde': True, 'member': False },
+        }, usertypes=[], save=False)
+        user.assos = { str(uuid.uuid4()) }
+        return user
+
+    def test_roundtrip(self):
+        user = self.get_user()
+        cached = User.from_cache(pickle.loads(pickle.dumps(user.to_cache())))
+        self.assertEqual(str(cached.pk), user.pk)
+        self.assertEqual(cached.email, user.email)
+        self.assertEqual(cached.fetched_data, user.fetched_data)
+        self.assertEqual(cached.types, user.types)
+        self.assertEqual(cached.assos, user.assos)
+        self.assertFalse(cached._state.adding)
+
+    def test_benchmark(self):
+        users = [ self.get_user() for _ in range(self.n_users) ]
+        pickled = pickle.dumps(users, pickle.HIGHEST_PROTOCOL)
+        start = time.perf_counter()
+        pickle.loads(pickled)
+        pickled_time = time.perf_counter() - start
+
+        User.save_to_cache(users, {})
+        packed = pickle.dumps(cache.get(User._gen_key()), pickle.HIGHEST_PROTOCOL)
+        start = time.perf_counter()
+        index, rows = pickle.loads(packed)
+        [ User.from_cache(row) for row in rows ]
+        packed_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        user = User.from_cache(rows[index[User._get_cache_pk(users[-1].pk)]])
+        lookup_time = time.perf_counter() - start
+        self.assertEqual(user.email, users[-1].email)
+        self.assertEqual(User.get_from_snapshot({ 'pk': users[-1].pk }, single_result=True).email, user.email)
+
+        instance_size = len(pickle.dumps(users[0], pickle.HIGHEST_PROTOCOL))
+        packed_instance_size = len(pickle.dumps(users[0].to_cache(), pickle.HIGHEST_PROTOCOL))
+        logger.debug(f"Cached {self.n_users} users: "
+                     f"instances {len(pickled) / 1024:.0f}KB loaded in {pickled_time * 1000:.1f}ms, "
+                     f"packed {len(packed) / 1024:.0f}KB loaded in {packed_time * 1000:.1f}ms, "
+                     f"lookup by pk in {lookup_time * 1e6:.0f}µs, "
+                     f"single instance {instance_size}B packed in {packed_instance_size}B")
+        self.assertLess(len(packed), len(pickled) * 0.8)
+        self.assertLess(packed_instance_size, instance_size / 2)
+
+
+@tag('auth', 'usertype')
+class UserTypePredicateTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        self.users = self.factory.create(User, nb=3)
+        for user, is_cas in zip(self.users, (True, False, True)):
+            user.fetched_data = { 'types': { 'cas': is_cas, 'contributorBde': False } }
+
+    def test_safe_expressions(self):
+        validations = {
+            'True': [ True, True, True ],
+            'user': [ True, True, True ],
+            'user.fetched_data["types"]["cas"]': [ True, False, True ],
+            'not user.fetched_data["types"]["cas"] or user.fetched_data["types"]["contributorBde"]': [ False, True, False ],
+            f"str(user.id) in ['{self.users[1].id}']": [ False, True, False ],
+        }
+        for validation, expected in validations.items():
+            with self.subTest(validation=validation):
+                usertype = self.factory.create(UserType, validation=validation)
+                usertype.full_clean()
+                self.assertEqual([ usertype.check_user(user) for user in self.users ], expected)
+
+    def test_unsafe_expressions(self):
+        validations = (
+            "__import__('os').system('ls')",
+            "user.__class__",
+            "user.save()",
+            "open('/etc/passwd')",
+            "(lambda: True)()",
+            "[ x for x in user.fetched_data ]",
+            "user.fetched_data['types'",
+        )
+        for validation in validations:
+            with self.subTest(validation=validation):
+                self.assertRaises(ValueError, compile_predicate, validation)
+                usertype = UserType(id='unsafe', name="Unsafe", validation=validation)
+                self.assertRaises(ValidationError, usertype.full_clean)
+                self.assertRaises(UserTypeValidationError, usertype.check_user, self.users[0])
+
+    def test_safe_methods(self):
+        usertype = self.factory.create(UserType,
+                                       validation="user.fetched_data.get('types', {}).get('cas')")
+        usertype.full_clean()
+        self.assertEqual([ usertype.check_user(user) for user in self.users ], [ True, False, True ])
+        self.assertRaises(ValueError, compile_predicate, "user.fetched_data.clear()")
+
+    def test_stored_validations_check(self):
+        self.factory.create(UserType, validation='True')
+        self.assertListEqual(check_usertype_validations(databases=[ 'default' ]), [])
+
+        # Validations stored before they were checked
+        UserType.objects.create(id='unsafe', name="Unsafe", validation="user.save()")
+        warnings = check_usertype_validations(databases=[ 'default' ])
+        self.assertEqual([ warning.id for warning in warnings ], [ 'authentication.W001' ])
+        self.assertFalse(any(warning.is_serious() for warning in warnings))
+
+    def test_cached_predicate(self):
+        usertype = self.factory.create(UserType, validation='True')
+        predicate = get_predicate(usertype)
+        self.assertIs(get_predicate(UserType.objects.get(pk=usertype.pk)), predicate)
+
+        usertype.validation = 'False'
+        usertype.save()
+        self.assertIsNot(get_predicate(usertype), predicate)
+        self.assertEqual([ usertype.check_user(user) for user in self.users ], [ False ] * 3)
@@ -0,0 +1,91 @@
+from hashlib import sha256
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import QueryDict
+from django.utils.http import parse_etags, urlencode
+from rest_framework import status
+from rest_framework.response import Response
+
+from core import metrics
+
+VERSION_CACHE_KEY = "response:version:{namespace}"
+RESPONSE_CACHE_KEY = "response:{namespace}:{digest}"
+TIMEOUT = int(settings.RESPONSE_CACHE_TIMEOUT.total_seconds())
+
+# Query params with comma-separated values in any order
+UNORDERED_LIST_PARAMS = { 'include', 'select', 'with' }
+
+
+def get_cache_version(namespace: str) -> str:
+    """
+    Get the current version of the cached responses of a namespace
+    """
+    key = VERSION_CACHE_KEY.format(namespace=namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(namespace: str) -> None:
+    """
+    Invalidate all the cached responses of a namespace
+    """
+    cache.set(VERSION_CACHE_KEY.format(namespace=namespace), uuid.uuid4().hex, None)
+
+
+def normalize_query(query: QueryDict) -> str:
+    """
+    Get a canonical representation of the query params
+    """
+    params = []
+    for key in sorted(query.keys()):
+        values = query.getlist(key)
+        if key in UNORDERED_LIST_PARAMS:
+            values = [ ",".join(sorted(value.split(','))) for value in values ]
+        params.append((key, sorted(values)))
+    return urlencode(params, doseq=True)
+
+
+class ResponseCacheMixin(object):
+    """
+    Cache the data of list and retrieve responses of users who are not managers,
+    until the version of the namespace is bumped.
+    Clients get a 304 response if their ETag is still valid.
+    """
+    response_cache_namespace = None
+
+    def get_cached_response(self, handler, request, *args, **kwargs) -> Response:
+        # Managers get live data such as the quantities left
+        if getattr(request, 'is_manager', False):
+            return handler(request, *args, **kwargs)
+
+        version = get_cache_version(self.response_cache_namespace)
+        digest = sha256(f"{version}:{request.path}?{normalize_query(request.GET)}".encode()).hexdigest()
+        etag = f'"{digest[:32]}"'
+
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            key = RESPONSE_CACHE_KEY.format(namespace=self.response_cache_namespace, digest=digest)
+            data = cache.get(key)
+            metrics.incr('cache.response.misses' if data is None else 'cache.response.hits')
+            if data is None:
+                response = handler(request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                cache.set(key, response.data, TIMEOUT)
+            else:
+                response = Response(data)
+
+        response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(super().retrieve, request, *args, **kwargs)
@@ -5,6 +5,8 @@ from faker import Faker
 from django.db.models import Model
 
 from core.helpers import format_date
+from authentication.hydration import cache_profiles
+from authentication.memberships import set_managed_asso_ids
 from authentication.models import User, UserType
 from sales.models import (
     Association, Sale, ItemGroup, Item,
@@ -50,16 +52,35 @@ class FakeModelFactory:
         # Return a single model
         if nb is None:
             props = self.get_attributes(model, **kwargs)
-            return model.objects.create(**props)
+            return self.add_fake_api_data(model.objects.create(**props))
         # Or a list of models
         else:
             if type(nb) is not int or nb <= 0:
                 raise ValueError("Number of instances to generate must be greater than 0")
             return [
-                model.objects.create(**self.get_attributes(model, **kwargs))
+                self.add_fake_api_data(model.objects.create(**self.get_attributes(model, **kwargs)))
                 for __ in range(nb)
             ]
 
+    def add_fake_api_data(self, instance: Model) -> Model:
+        """
+        Cache the portal profile of generated users, managing no association,
+        so that they can be hydrated offline
+        """
+        if isinstance(instance, User):
+            set_managed_asso_ids(instance.pk, ())
+            cache_profiles({
+                str(instance.pk): {
+                    'id':         str(instance.pk),
+                    'email':      instance.email,
+                    'first_name': instance.first_name,
+                    'last_name':  instance.last_name,
+                    'is_admin':   instance.is_admin,
+                    'types':      { 'admin': instance.is_admin },
+                },
+            })
+        return instance
+
     def get_attributes(self, model: Model, **kwargs) -> Dict[str, Any]:
         """
         Generates the attributes required to create a specified Model
@@ -0,0 +1,147 @@
+from typing import Iterator, Optional
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from threading import Lock
+import time
+import os
+
+from django.db import connections
+
+_current_metrics = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics(object):
+    """
+    Metrics recorded during a request or any other unit of work
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.latency = 0.0
+        # Cache hits and misses, outbound calls, ...
+        self.counters = Counter()
+        # Time spent in outbound calls
+        self.timings = Counter()
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_time += time.perf_counter() - start
+
+    def as_dict(self) -> dict:
+        return {
+            'queries': self.queries,
+            'sql_time': round(self.sql_time * 1000, 3),
+            'latency': round(self.latency * 1000, 3),
+            **self.counters,
+            **{ f"{name}.time": round(duration * 1000, 3) for name, duration in self.timings.items() },
+        }
+
+
+def get_current_metrics() -> Optional[RequestMetrics]:
+    return _current_metrics.get()
+
+
+@contextmanager
+def collect_metrics() -> Iterator[RequestMetrics]:
+    """
+    Record the metrics of the code run in the context
+    """
+    metrics = RequestMetrics()
+    token = _current_metrics.set(metrics)
+    start = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics.sql_wrapper))
+            yield metrics
+    finally:
+        metrics.latency = time.perf_counter() - start
+        _current_metrics.reset(token)
+
+
+def incr(name: str, value: int=1) -> None:
+    """
+    Increment a counter of the current metrics, for example 'cache.apimodel.hits'
+    """
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.counters[name] += value
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """
+    Count and time an outbound call, for example to 'payutc' or 'oauth'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current_metrics.get()
+        if metrics is not None:
+            metrics.counters[f"{name}.calls"] += 1
+            metrics.timings[name] += time.perf_counter() - start
+
+
+class MetricsRegistry(object):
+    """
+    Aggregated metrics of the requests of this process per endpoint
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._endpoints = {}
+
+    def add(self, endpoint: str, status_code: int, metrics: RequestMetrics) -> None:
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                'requests': 0,
+                'errors': 0,
+                'queries': 0,
+                'max_queries': 0,
+                'sql_time': 0.0,
+                'latency': 0.0,
+                'max_latency': 0.0,
+                'counters': Counter(),
+            })
+            stats['requests'] += 1
+            stats['errors'] += int(status_code >= 500)
+            stats['queries'] += metrics.queries
+            stats['max_queries'] = max(stats['max_queries'], metrics.queries)
+            stats['sql_time'] += metrics.sql_time
+            stats['latency'] += metrics.latency
+            stats['max_latency'] = max(stats['max_latency'], metrics.latency)
+            stats['counters'].update(metrics.counters)
+
+    def snapshot(self) -> dict:
+        """
+        Get the metrics per endpoint, with averages and times in milliseconds
+        """
+        with self._lock:
+            endpoints = {
+                endpoint: {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'avg_queries': round(stats['queries'] / stats['requests'], 2),
+                    'max_queries': stats['max_queries'],
+                    'avg_sql_time': round(stats['sql_time'] * 1000 / stats['requests'], 3),
+                    'avg_latency': round(stats['latency'] * 1000 / stats['requests'], 3),
+                    'max_latency': round(stats['max_latency'] * 1000, 3),
+                    'counters': dict(stats['counters']),
+                }
+                for endpoint, stats in self._endpoints.items()
+            }
+        return { 'pid': os.getpid(), 'endpoints': endpoints }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints.clear()
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,32 @@
+import logging
+import json
+
+from core.metrics import collect_metrics, registry
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+
+class InstrumentationMiddleware(object):
+    """
+    Record the queries, cache accesses, outbound calls and latency of each request,
+    log them and aggregate them per endpoint, see core.metrics
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collect_metrics() as metrics:
+            response = self.get_response(request)
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        endpoint = resolver_match.view_name if resolver_match else 'unresolved'
+        registry.add(endpoint, response.status_code, metrics)
+        logger.info(json.dumps({
+            'endpoint': endpoint,
+            'method': request.method,
+            'status': response.status_code,
+            **metrics.as_dict(),
+        }))
+
+        return response
@@ -1,16 +1,22 @@
-from typing import Any, Union, Sequence, List, Set, Tuple
+from typing import Any, Dict, Union, Sequence, List, Set, Tuple
 import logging
+import uuid
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db.utils import IntegrityError
+from django.db import DEFAULT_DB_ALIAS
 from django.db.models import QuerySet, Model, UUIDField
+from django.db.models.base import ModelState
 from django.db.models.manager import BaseManager
 
+from core import metrics
 from core.helpers import filter_dict_keys, iterable_to_map
 
 logger = logging.getLogger(f"woolly.{__name__}")
 
+# Field values, fetched data, positions of the fields shared with it and cached attributes
+PackedInstance = Tuple[tuple, Union[dict, None], Tuple[int], tuple]
+
 
 def fetch_data_from_api(model: Model, oauth_client: 'OAuthAPI'=None, **params) -> Any:
     """
@@ -56,6 +62,20 @@ class APIQuerySet(QuerySet):
         # Fetch data
         return fetch_data_from_api(self.model, oauth_client, **params)
 
+    def get_expected_pks(self, params: dict) -> Union[List[Any], None]:
+        """
+        Get the pks of the instances expected with the params if they can be known
+        without calling the API: specified pks or filtered queryset
+        """
+        if 'pk' in params:
+            pk = params['pk']
+            return list(pk) if isinstance(pk, (list, tuple, set)) else [ pk ]
+        if params:
+            return None
+        if self.query.has_filters():
+            return list(self.values_list('pk', flat=True))
+        return None
+
     def get_with_api_data(self,
                           oauth_client=None,
                           single_result: bool=False,
@@ -63,36 +83,51 @@ class APIQuerySet(QuerySet):
                           **params) -> Union['APIModel', List['APIModel']]:
         """
         Execute query and add extra data from the API
-        Try to get data from cache if possible
+        Try to get data from cache if possible and only fetch the missing instances
         """
         # Set single_result automatically if only one result is expected
         if 'pk' in params and not hasattr(params['pk'], '__len__'):
             single_result = True
 
+        # Results of filtered querysets cannot be cached under the params
+        params_key = None if self.query.has_filters() else params
+
         # Try cache
-        if try_cache:
+        if try_cache and params_key is not None:
             cached = self.model.get_from_cache(params, single_result=False, need_full_data=True)
             if cached is not None:
                 return cached
 
-        # Get all data from the API with params
-        fetched_data = self.fetch_api_data(oauth_client, **params)
+        # Get the expected instances that are already cached
+        cached_instances = {}
+        expected_pks = self.get_expected_pks(params)
+        if expected_pks is not None and try_cache:
+            cached_instances = self.model.get_many_from_cache(expected_pks)
+        missing_pks = None if expected_pks is None else \
+            [ pk for pk in expected_pks if str(pk) not in cached_instances ]
+
+        # Get all data from the API with params, or only the missing instances
+        if missing_pks is None:
+            fetched_data = self.fetch_api_data(oauth_client, **params)
+        elif missing_pks:
+            pk = self.model._meta.pk.to_python(missing_pks[0]) if len(missing_pks) == 1 else tuple(missing_pks)
+            fetched_data = fetch_data_from_api(self.model, oauth_client, pk=pk)
+        else:
+            fetched_data = []
+        if isinstance(fetched_data, dict):
+            fetched_data = [ fetched_data ]
 
         # Get database results if they exists
         field_names = self.model.field_names()
-        can_filter = all(key in field_names for key in params)
-        if can_filter:
-            db_results = self.filter(**params)
-            db_results = iterable_to_map(db_results, get_key=lambda obj: str(obj.id))
-        else:
-            db_results = {}
+        db_results = self.model._default_manager.filter(pk__in=[ data['id'] for data in fetched_data ])
+        db_results = iterable_to_map(db_results, get_key=lambda obj: str(obj.id))
 
         # Iter through fetched data and extend database results
         to_create = []
         to_update = []
         updated_fields = set()
         for data in fetched_data:
-            obj = db_results.get(data['id'], None)
+            obj = db_results.get(str(data['id']), None)
 
             # Object is not in database, create it and add it
             if obj is None:
@@ -109,26 +144,19 @@ class APIQuerySet(QuerySet):
 
         # Create and update modified objects
         if to_create:
-            try:
-                to_create = self.bulk_create(to_create)
-                logger.debug(f"Created {len(to_create)} new {self.model.__name__}")
-            except IntegrityError as error:
-                # Some filtering may not work with the database even though the data
-                # is already in the database so we simply skip trying to create
-                # if we cannot be sure filtering went well
-                if can_filter:
-                    raise error
+            to_create = self.bulk_create(to_create)
+            logger.debug(f"Created {len(to_create)} new {self.model.__name__}")
 
         if to_update:
             self.bulk_update(to_update, updated_fields)
 
         # Cache and return list of models instance
-        results = list(db_results.values()) + to_create
+        results = list(cached_instances.values()) + list(db_results.values()) + to_create
         if single_result:
             assert len(results) == 1
             results = results[0]
 
-        self.model.save_to_cache(results, params)
+        self.model.save_to_cache(results, params_key)
         return results
 
 
@@ -204,58 +232,195 @@ class APIModel(Model):
         spec = ','.join(f"{k}={v}" for k, v in params.items())
         return f"APIModel-{name}-{spec or 'all'}"
 
+    # Instance attributes kept in cache besides the fields and the fetched data
+    CACHED_ATTRIBUTES = ()
+
+    def to_cache(self) -> PackedInstance:
+        """
+        Pack the instance in a compact tuple for the cache:
+        the values of the fields with UUIDs as bytes, the fetched data without the keys
+        which duplicate a field value, the positions of these fields and the cached attributes
+        """
+        attnames, uuid_positions = self._get_cache_layout()
+        values = [ getattr(self, attname) for attname in attnames ]
+        fetched_data = self.fetched_data
+        shared_positions = ()
+        if fetched_data is not None:
+            # Fetched data comes from JSON, so with UUIDs as strings
+            shared_positions = tuple(
+                position for position, attname in enumerate(attnames)
+                if attname in fetched_data and fetched_data[attname] == (
+                    str(values[position]) if position in uuid_positions else values[position]
+                )
+            )
+            shared_keys = { attnames[position] for position in shared_positions }
+            fetched_data = { k: v for k, v in fetched_data.items() if k not in shared_keys }
+        for position in uuid_positions:
+            if values[position] is not None:
+                values[position] = uuid.UUID(str(values[position])).bytes
+        attributes = tuple(getattr(self, attr) for attr in self.CACHED_ATTRIBUTES)
+        return (tuple(values), fetched_data, shared_positions, attributes)
+
+    @classmethod
+    def from_cache(cls, packed: PackedInstance) -> 'APIModel':
+        """
+        Unpack an instance packed with to_cache, without going through __init__ like unpickling
+        """
+        attnames, uuid_positions = cls._get_cache_layout()
+        values, fetched_data, shared_positions, attributes = packed
+        values = list(values)
+        for position in uuid_positions:
+            if values[position] is not None:
+                values[position] = uuid.UUID(bytes=values[position])
+
+        instance = cls.__new__(cls)
+        instance.__dict__.update(zip(attnames, values))
+        instance._state = ModelState()
+        instance._state.adding = False
+        instance._state.db = DEFAULT_DB_ALIAS
+        if fetched_data is not None:
+            for position in shared_positions:
+                value = values[position]
+                fetched_data[attnames[position]] = str(value) if position in uuid_positions else value
+            instance.fetched_data = fetched_data
+        for attr, value in zip(cls.CACHED_ATTRIBUTES, attributes):
+            setattr(instance, attr, value)
+        return instance
+
+    @classmethod
+    def _get_cache_pk(cls, pk) -> Any:
+        """
+        Get the pk as packed by to_cache
+        """
+        return uuid.UUID(str(pk)).bytes if isinstance(cls._meta.pk, UUIDField) else pk
+
+    @classmethod
+    def _get_cache_layout(cls) -> Tuple[List[str], Set[int]]:
+        """
+        Get the attribute names of the fields and the positions of the UUID fields
+        """
+        layout = cls.__dict__.get('_cache_layout')
+        if layout is None:
+            fields = cls._meta.concrete_fields
+            layout = (
+                [ field.attname for field in fields ],
+                { position for position, field in enumerate(fields) if isinstance(field, UUIDField) },
+            )
+            cls._cache_layout = layout
+        return layout
+
+    @classmethod
+    def get_many_from_cache(cls, pks: Sequence, need_full_data: bool=True) -> Dict[str, 'APIModel']:
+        """
+        Get the cached instances with the specified pks in a single cache access
+        """
+        keys = { cls._gen_key({ 'pk': pk }): str(pk) for pk in pks }
+        instances = {
+            keys[key]: cls.from_cache(packed)
+            for key, packed in cache.get_many(keys).items()
+            if packed[1] is not None or not need_full_data
+        }
+        metrics.incr('cache.apimodel.hits', len(instances))
+        metrics.incr('cache.apimodel.misses', len(keys) - len(instances))
+        return instances
+
+    @classmethod
+    def get_from_snapshot(cls,
+                          params: dict,
+                          single_result: bool=False,
+                          need_full_data: bool=True
+                          ) -> Union['APIModel', List['APIModel'], None]:
+        """
+        Try getting the instances from the cached snapshot of all instances,
+        with an index by pk to find them directly
+        """
+        snapshot = cache.get(cls._gen_key())
+        if snapshot is None:
+            return None
+        index, rows = snapshot
+
+        if not params:
+            return [ cls.from_cache(packed) for packed in rows ]
+
+        if set(params) == { 'pk' }:
+            pks = params['pk'] if isinstance(params['pk'], (list, tuple, set)) else [ params['pk'] ]
+            positions = [ index.get(cls._get_cache_pk(pk)) for pk in pks ]
+            if None in positions:
+                return None
+            instances = [ cls.from_cache(rows[position]) for position in positions ]
+        else:
+            instances = [
+                instance for instance in map(cls.from_cache, rows)
+                if all(getattr(instance, attr) == value for attr, value in params.items())
+            ]
+
+        if not instances:
+            return None
+        if need_full_data and any(not instance.fetched_data for instance in instances):
+            logger.warning(f"[CACHE] Skipped because needed full data for {cls.__name__} with params {params}")
+            return None
+        return instances[0] if single_result else instances
+
     @classmethod
     def get_from_cache(cls,
                        params: dict,
                        single_result: bool=False,
                        need_full_data: bool=True
-                       ) -> Union['APIModel', None]:
+                       ) -> Union['APIModel', List['APIModel'], None]:
         """
         Try getting model instance with fetched data from
-        # TODO Improve for multiple queries
         """
         key = cls._gen_key(params)
-        # logger.debug(f"[CACHE] Trying to get {cls.__name__}"
-        #              f" with key '{key}' and params {params}")
-        if key in cache:
-            logger.debug(f"[CACHE] Got {cls.__name__} with params {params}")
-            return cache.get(key)
 
-        # Try to get from cached -all
-        if params:
-            all_key = cls._gen_key()
-            if all_key in cache:
-                data = cache.get(all_key)
-
-                # Find the right instances among all data
-                results = []
-                for instance in data:
-                    if all(getattr(instance, attr) == value for attr, value in params.items()):
-                        if need_full_data and not instance.fetched_data:
-                            logger.warning(f"[CACHE] Skipped because needed full data for {cls.__name__} with params {params}")
-                            return None
-
-                        if single_result:
-                            logger.debug(f"[CACHE] Got {cls.__name__} with params {params}")
-                            return instance
-                        else:
-                            results.append(instance)
-
-                if results:
+        # Single instance cached under its own key
+        if set(params) == { 'pk' } and not isinstance(params['pk'], (list, tuple, set)):
+            packed = cache.get(key)
+            if packed is not None:
+                logger.debug(f"[CACHE] Got {cls.__name__} with params {params}")
+                metrics.incr('cache.apimodel.hits')
+                return cls.from_cache(packed)
+
+        # Other results cached as the pks of their instances
+        elif params:
+            cached = cache.get(key)
+            if cached is not None:
+                pks = [ cached ] if isinstance(cached, str) else cached
+                instances = cls.get_many_from_cache(pks, need_full_data)
+                if len(instances) == len(pks):
                     logger.debug(f"[CACHE] Got {cls.__name__} with params {params}")
-                    return results
+                    results = [ instances[pk] for pk in pks ]
+                    return results[0] if isinstance(cached, str) else results
 
+        # Try to get from cached -all
+        results = cls.get_from_snapshot(params, single_result, need_full_data)
+        if results is not None:
+            logger.debug(f"[CACHE] Got {cls.__name__} with params {params}")
+            metrics.incr('cache.apimodel.hits')
+            return results
+
+        metrics.incr('cache.apimodel.misses')
         return None
 
     @classmethod
-    def save_to_cache(cls, data: Union[Sequence, 'APIModel'], params: dict) -> None:
+    def save_to_cache(cls, data: Union[Sequence, 'APIModel'], params: dict=None) -> None:
         """
-        Save single or multiple instances to cache
+        Save single or multiple instances to cache under their own keys,
+        results of other params are saved as the pks of the instances
+        and all instances as a snapshot indexed by pk
         """
-        # TODO set_many ?
-        key = cls._gen_key(params)
-        cache.set(key, data, cls.CACHE_TIMEOUT)
-        # logger.debug(f"[CACHE] Saved {len(data) if hasattr(data, '__len__') else 1} data with key '{key}'")
+        instances = [ data ] if isinstance(data, APIModel) else data
+        entries = { cls._gen_key({ 'pk': instance.pk }): instance.to_cache() for instance in instances }
+        key = cls._gen_key(params) if params is not None else None
+        if params == {}:
+            # Index the rows by their packed pk, shared with the rows once pickled
+            rows = tuple(entries[cls._gen_key({ 'pk': instance.pk })] for instance in instances)
+            pk_position = cls._get_cache_layout()[0].index(cls._meta.pk.attname)
+            entries[key] = ({ row[0][pk_position]: position for position, row in enumerate(rows) }, rows)
+        elif key is not None and key not in entries:
+            pks = [ str(instance.pk) for instance in instances ]
+            entries[key] = pks[0] if isinstance(data, APIModel) else pks
+        cache.set_many(entries, cls.CACHE_TIMEOUT)
+        # logger.debug(f"[CACHE] Saved {len(instances)} data with key '{key}'")
 
     # ---------------------------------------------------------------------
     #       API Fetch and Sync methods
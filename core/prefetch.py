@@ -0,0 +1,99 @@
+from typing import List, Sequence, Tuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Model, Prefetch, QuerySet
+from django.utils.module_loading import import_string
+from rest_framework import serializers
+
+# select_related paths and Prefetch objects
+Plan = Tuple[List[str], List[Prefetch]]
+
+
+def get_serialized_field_names(serializer_class, include_tree: dict=None,
+                               with_fields: Sequence[str]=(), is_manager: bool=False) -> List[str]:
+    """
+    Get the names of the fields that will be serialized, see ModelSerializer.get_field_names,
+    manager fields are only serialized when requested by managers
+    """
+    base_fields = getattr(serializer_class.Meta, 'fields', ())
+    if base_fields == serializers.ALL_FIELDS:
+        base_fields = tuple(serializer_class._declared_fields)
+    requested = (*with_fields, *(include_tree or {}))
+    if not is_manager:
+        manager_fields = set(getattr(serializer_class.Meta, 'manager_fields', ()))
+        requested = tuple(name for name in requested if name not in manager_fields)
+    return list(dict.fromkeys((*base_fields, *requested)))
+
+
+def get_included_serializer(serializer_class, name: str):
+    included = getattr(serializer_class, 'included_serializers', {}).get(name)
+    return import_string(included) if isinstance(included, str) else included
+
+
+def plan_prefetch(model: Model, serializer_class, include_tree: dict=None,
+                  with_fields: Sequence[str]=(), is_manager: bool=False,
+                  prefix: str='') -> Plan:
+    """
+    Walk the serialized fields against the model metadata to get the relations to load:
+    - forward relations are selected when included, otherwise only their pk is used
+    - reverse and many-to-many relations are prefetched with narrowed querysets,
+      only loading the primary keys when not included
+    """
+    include_tree = include_tree or {}
+    selects, prefetches = [], []
+
+    field_names = get_serialized_field_names(serializer_class, include_tree, with_fields, is_manager)
+    for name in field_names:
+        declared = serializer_class._declared_fields.get(name)
+        source = getattr(declared, 'source', None) or name
+        try:
+            field = model._meta.get_field(source.split('.')[0])
+        except FieldDoesNotExist:
+            continue
+        if not field.is_relation:
+            continue
+
+        path = prefix + field.name
+        related_model = field.related_model
+        if field.many_to_many or field.one_to_many:
+            if name in include_tree:
+                queryset = plan_queryset(related_model._default_manager.all(),
+                                         get_included_serializer(serializer_class, name),
+                                         include_tree[name], is_manager=is_manager)
+            else:
+                # Only the primary keys are serialized
+                only = [ related_model._meta.pk.name ]
+                if field.one_to_many:
+                    only.append(field.field.name)
+                queryset = related_model._default_manager.only(*only)
+            prefetches.append(Prefetch(path, queryset=queryset))
+
+        elif name in include_tree or '.' in source:
+            # Forward relation serialized with its data
+            selects.append(path)
+            sub_serializer = get_included_serializer(serializer_class, name) if name in include_tree else None
+            if sub_serializer is not None:
+                sub_selects, sub_prefetches = plan_prefetch(related_model, sub_serializer, include_tree[name],
+                                                            is_manager=is_manager, prefix=f"{path}__")
+                selects.extend(sub_selects)
+                prefetches.extend(sub_prefetches)
+
+    return selects, prefetches
+
+
+def plan_queryset(queryset: QuerySet, serializer_class, include_tree: dict=None,
+                  with_fields: Sequence[str]=(), is_manager: bool=False) -> QuerySet:
+    """
+    Load with the queryset all the relations needed by the serializer,
+    including the manager fields requested by managers
+    """
+    if serializer_class is None or not hasattr(serializer_class, 'Meta'):
+        return queryset
+
+    selects, prefetches = plan_prefetch(queryset.model, serializer_class, include_tree,
+                                        with_fields, is_manager)
+    if selects:
+        queryset = queryset.select_related(*selects)
+    if prefetches:
+        queryset = queryset.prefetch_related(*prefetches)
+    return queryset
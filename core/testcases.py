@@ -10,6 +10,7 @@ from rest_framework.test import APISimpleTestCase, APITestCase, APIClient
 
 from core.helpers import get_model_name, pluralize
 from core.faker import FakeModelFactory
+from core.metrics import registry
 from authentication.models import User
 
 
@@ -332,3 +333,28 @@ class APIModelViewSetTestCase(CRUDTestCaseMixin, metaclass=CRUDViewSetTestMeta):
         Test that it is not possible to delete a resource through the API
         """
         self._test_not_allowed_method('delete', with_pk=True)
+
+
+class QueryBudgetTestMixin:
+    """
+    Check that endpoints stay within their declared budget of queries,
+    as measured by core.middleware.InstrumentationMiddleware
+
+    query_budgets = { '/sales?include=items': 5 }
+    """
+    query_budgets = {}
+
+    def assertQueryBudget(self, url: str, budget: int, method: str='get', **kwargs) -> Any:
+        registry.reset()
+        response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400, f"{method.upper()} {url} failed")
+        endpoints = registry.snapshot()['endpoints']
+        queries = sum(stats['max_queries'] for stats in endpoints.values())
+        self.assertLessEqual(queries, budget, f"{method.upper()} {url} made {queries} queries "
+                                              f"for a budget of {budget}")
+        return response
+
+    def test_query_budgets(self):
+        for url, budget in self.query_budgets.items():
+            with self.subTest(url=url):
+                self.assertQueryBudget(url, budget)
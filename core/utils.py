@@ -1,3 +1,4 @@
+from typing import Optional, Sequence
 import os
 from io import BytesIO
 from base64 import b64encode
@@ -7,6 +8,11 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.template.loader import get_template
 from xhtml2pdf import pisa
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    # Older PyPDF2 installed along with xhtml2pdf
+    from PyPDF2 import PdfFileReader as PdfReader, PdfFileWriter as PdfWriter
 
 from qrcode import QRCode
 from qrcode.constants import ERROR_CORRECT_Q
@@ -32,11 +38,12 @@ class BrowsableAPIRenderer(BaseAPIRenderer):
 #   Tickets
 # --------------------------------------------
 
-def link_asset(uri: str) -> str:
+def link_asset(uri: str, rel: str=None) -> str:
     """
     Callback to allow xhtml2pdf/reportlab to retrieve Images,Stylesheets, etc.
     `uri` is the href attribute from the html link element.
     """
+    path = uri
     if settings.MEDIA_URL and uri.startswith(settings.MEDIA_URL):
         path = os.path.join(settings.MEDIA_ROOT, uri.replace(settings.MEDIA_URL, ''))
     elif settings.STATIC_URL and uri.startswith(settings.STATIC_URL):
@@ -52,15 +59,40 @@ def link_asset(uri: str) -> str:
     return path
 
 
-def render_to_pdf(template_src: str, context_dict: dict={}) -> HttpResponse:
-    html = get_template(template_src).render(context_dict)
-
+def html_to_pdf(html: str) -> Optional[bytes]:
+    """
+    Render an HTML document to PDF, return None if it failed
+    """
     pdf_buffer = BytesIO()
     html_buffer = BytesIO(html.encode('UTF-8'))
     pdf = pisa.pisaDocument(html_buffer, pdf_buffer, link_callback=link_asset)
 
     if not pdf.err:
-        return HttpResponse(pdf_buffer.getvalue(), content_type='application/pdf')
+        return pdf_buffer.getvalue()
+    return None
+
+
+def merge_pdfs(pdfs: Sequence[bytes]) -> bytes:
+    """
+    Concatenate the pages of multiple PDF documents
+    """
+    writer = PdfWriter()
+    # Older PyPDF2 versions only have camel case methods
+    add_page = getattr(writer, 'add_page', None) or writer.addPage
+    for pdf in pdfs:
+        for page in PdfReader(BytesIO(pdf)).pages:
+            add_page(page)
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def render_to_pdf(template_src: str, context_dict: dict={}) -> HttpResponse:
+    html = get_template(template_src).render(context_dict)
+    pdf = html_to_pdf(html)
+
+    if pdf is not None:
+        return HttpResponse(pdf, content_type='application/pdf')
     return None
 
 
@@ -1,7 +1,10 @@
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
-from rest_framework.decorators import api_view
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.pagination import CursorPagination as BaseCursorPagination, PageNumberPagination
+from rest_framework.permissions import IsAdminUser
+
+from core.metrics import registry
 
 
 class Pagination(PageNumberPagination):
@@ -15,6 +18,22 @@ class Pagination(PageNumberPagination):
         return super().get_page_size(request)
 
 
+class CursorPagination(BaseCursorPagination):
+    """
+    Keyset pagination on the stable `-id` ordering, without count query nor deep offset.
+    Pages are smaller than with Pagination to keep memory bounded,
+    the next pages can be fetched with the cursor links.
+    """
+    ordering = '-id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        if request.query_params.get(self.page_size_query_param) == 'max':
+            return self.max_page_size
+        return super().get_page_size(request)
+
+
 @api_view(['GET'])
 def api_root(request, format=None):
     """
@@ -48,3 +67,14 @@ def api_root(request, format=None):
         # TODO PaymentMethods
         # 'paymentmethods':  reverse('paymentmethods-list',  **kwargs),
     })
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """
+    Metrics of the requests per endpoint handled by this process
+    """
+    if request.GET.get('reset', 'false') != 'false':
+        registry.reset()
+    return Response(registry.snapshot())
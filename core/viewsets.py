@@ -6,6 +6,7 @@ from rest_framework import viewsets
 
 from authentication.oauth import OAuthAPI
 from .exceptions import InvalidRequest
+from .prefetch import plan_queryset
 
 
 class ModelViewSetMixin(object):
@@ -15,6 +16,7 @@ class ModelViewSetMixin(object):
     - Include nested-resources prefetching (ex: /sales?include=items,items__group)
     - Filter on specified values (ex: /orders?filter=status__in=2,4&filter=id__gt=2)
     - Order as specified
+    - Paginate with a cursor on demand (ex: /orders?all=true&pagination=cursor)
 
     TODO:
     - Filter permissions per objet
@@ -24,6 +26,9 @@ class ModelViewSetMixin(object):
     - Parse query params to the right type
     """
 
+    # Keyset pagination class used with ?pagination=cursor
+    cursor_pagination_class = None
+
     # Helpers
 
     def query_params_is_true(self, key: str) -> bool:
@@ -108,19 +113,13 @@ class ModelViewSetMixin(object):
 
     def include_sub_models(self, queryset: QuerySet) -> QuerySet:
         """
-        Prefetch data required in the query for better performance
+        Prefetch data required by the serializers for better performance,
+        see core.prefetch.plan_queryset
         """
-        # Prefetch many data
-        include_query = self.request.GET.get('include')
-        if include_query:
-            queryset = queryset.prefetch_related(*include_query.split(','))
-
-        # Select one data
-        select_query = self.request.GET.get('select')
-        if select_query:
-            queryset = queryset.select_related(*select_query.split(','))
-
-        return queryset
+        return plan_queryset(queryset, self.get_serializer_class(),
+                             self.get_include_tree(self.request.GET),
+                             self.get_with_fields(self.request.GET),
+                             getattr(self.request, 'is_manager', False))
 
     def filter_by_sub_urls(self, queryset: QuerySet) -> QuerySet:
         """
@@ -181,6 +180,21 @@ class ModelViewSetMixin(object):
 
         return queryset
 
+    @property
+    def paginator(self):
+        """
+        Use the cursor pagination if requested and available
+        """
+        if not hasattr(self, '_paginator') and self.request.GET.get('pagination') == 'cursor':
+            if self.cursor_pagination_class is None:
+                raise InvalidRequest("La pagination par curseur n'est pas disponible ici",
+                                     code="invalid_pagination")
+            if self.request.GET.get('order_by'):
+                raise InvalidRequest("La pagination par curseur ne peut pas être ordonnée",
+                                     code="invalid_pagination")
+            self._paginator = self.cursor_pagination_class()
+        return super().paginator
+
     def paginate_queryset(self, *args, **kwargs):
         try:
             return super().paginate_queryset(*args, **kwargs)
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.contrib import admin
+from django.utils import timezone
+
+from .models import ItemSync
+
+
+class PendingFilter(admin.SimpleListFilter):
+    title = 'state'
+    parameter_name = 'state'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('pending', 'Pending'),
+            ('failing', 'Failing'),
+            ('abandoned', 'Abandoned'),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == 'pending':
+            return queryset.pending()
+        if self.value() == 'failing':
+            return queryset.pending().filter(attempts__gt=0)
+        if self.value() == 'abandoned':
+            return queryset.pending().filter(attempts__gte=settings.ITEM_SYNC_MAX_ATTEMPTS)
+        return queryset
+
+
+class ItemSyncAdmin(admin.ModelAdmin):
+    list_display = ('item', 'is_pending', 'version', 'synced_version', 'attempts',
+                    'requested_at', 'next_try_at', 'synced_at', 'last_error')
+    list_filter = (PendingFilter, 'item__sale')
+    list_select_related = ('item__sale',)
+    readonly_fields = ('item', 'version', 'synced_version', 'requested_at', 'synced_at', 'last_error')
+    search_fields = ('item__name', 'item__sale__name')
+    ordering = ('next_try_at',)
+    actions = ('retry_now',)
+
+    def is_pending(self, sync: ItemSync) -> bool:
+        return sync.is_pending
+
+    is_pending.boolean = True
+
+    def retry_now(self, request, queryset):
+        count = queryset.pending().update(attempts=0, next_try_at=timezone.now())
+        self.message_user(request, f"{count} synchronizations will be retried")
+
+    retry_now.short_description = "Retry the synchronization now"
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        stats = ItemSync.objects.get_stats()
+        extra_context['title'] = f"Item synchronizations: {stats['pending']} pending, " \
+                                 f"{stats['failing']} failing, {stats['abandoned']} abandoned, " \
+                                 f"lag {stats['lag']:.0f}s"
+        return super().changelist_view(request, extra_context)
+
+
+admin.site.register(ItemSync, ItemSyncAdmin)
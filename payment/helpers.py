@@ -1,13 +1,30 @@
+from threading import Lock
+
 from django.conf import settings
 
 from payment.services.base import AbstractPaymentService
 from payment.services.payutc import PayutcService
 # from sales.models import Order
 
+# Process-wide PayUTC service, reusing its connections and session
+_payutc_service = None
+_payutc_service_lock = Lock()
+
+
+def get_payutc_service() -> PayutcService:
+    """
+    Get the PayUTC service shared by the process
+    """
+    global _payutc_service
+    with _payutc_service_lock:
+        if _payutc_service is None:
+            _payutc_service = PayutcService()
+        return _payutc_service
+
 
 def get_pay_service(*args, **kwargs) -> AbstractPaymentService:
     """
-    Instanciate the requested payment service
+    Get the requested payment service
     """
     # TODO Select pay service
     # if request is not None:
@@ -16,4 +33,4 @@ def get_pay_service(*args, **kwargs) -> AbstractPaymentService:
         from payment.services.fake import FakePaymentService
         return FakePaymentService()
     else:
-        return PayutcService()
+        return get_payutc_service()
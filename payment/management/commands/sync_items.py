@@ -0,0 +1,158 @@
+from typing import List, Optional, Tuple
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import logging
+import time
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from sales.models import Item
+from payment.helpers import get_pay_service
+from payment.models import ItemSync
+from payment.services.base import AbstractPaymentService
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+# Time after which claimed synchronizations can be claimed again
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def claim_batch(batch_size: int) -> List[Tuple[ItemSync, int]]:
+    """
+    Claim synchronizations ready to be pushed, with their version to push,
+    so that concurrent workers do not push the same items
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        ids = list(
+            ItemSync.objects.ready()
+            .select_for_update(skip_locked=skip_locked)
+            .order_by('next_try_at')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        ItemSync.objects.filter(pk__in=ids).update(claimed_until=now + CLAIM_TIMEOUT)
+        syncs = list(
+            ItemSync.objects.filter(pk__in=ids)
+            .select_related('item__sale__association', 'item__usertype')
+        )
+    return [ (sync, sync.version) for sync in syncs ]
+
+
+def complete_sync(sync: ItemSync, version: int, error: Optional[Exception]) -> None:
+    """
+    Save the result of the push of an item
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        if error is None:
+            # Item edits during the push keep the synchronization pending,
+            # and a nemopay_id changed meanwhile is kept for the next push
+            Item.objects.filter(pk=sync.item_id, nemopay_id=sync.item._stored_nemopay_id) \
+                        .update(nemopay_id=sync.item.nemopay_id)
+            ItemSync.objects.filter(pk=sync.pk, synced_version__lt=version).update(
+                synced_version=version, synced_at=now, attempts=0, last_error='')
+        else:
+            # Item edits during the push are retried right away
+            attempts = sync.attempts + 1
+            ItemSync.objects.filter(pk=sync.pk, version=version).update(
+                attempts=attempts,
+                last_error=str(error),
+                next_try_at=now + ItemSync.get_retry_delay(attempts),
+            )
+        ItemSync.objects.filter(pk=sync.pk).update(claimed_until=None)
+
+
+class Command(BaseCommand):
+    """
+    Push the queued item synchronizations to the payment service
+
+    Usage:
+        python manage.py sync_items --help
+    """
+
+    help = "Push the queued item synchronizations to the payment service."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-l', '--loop',
+                            action='store_true',
+                            help="Keep pushing synchronizations until interrupted")
+        parser.add_argument('-i', '--interval',
+                            type=float,
+                            default=5,
+                            help="Seconds to wait when there is nothing to push in loop mode (default: 5)")
+        parser.add_argument('-b', '--batch-size',
+                            type=int,
+                            default=50,
+                            help="Number of items claimed at once (default: 50)")
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=4,
+                            help="Number of concurrent pushes to the payment service (default: 4)")
+        parser.add_argument('--stats',
+                            action='store_true',
+                            help="Only display the synchronization lag and failure counts")
+
+    @staticmethod
+    def push(pay_service: AbstractPaymentService, sync: ItemSync) -> Optional[Exception]:
+        try:
+            pay_service.sync_item(sync.item)
+        except Exception as error:
+            logger.warning(f"Could not synchronize item {sync.item_id}: {error}")
+            return error
+        return None
+
+    def sync_batch(self, pay_service: AbstractPaymentService, executor: ThreadPoolExecutor,
+                   batch_size: int) -> Counter:
+        claimed = claim_batch(batch_size)
+        syncs = [ sync for sync, _ in claimed ]
+        errors = executor.map(lambda sync: self.push(pay_service, sync), syncs)
+
+        stats = Counter()
+        for (sync, version), error in zip(claimed, errors):
+            complete_sync(sync, version, error)
+            stats['failed' if error else 'synced'] += 1
+        return stats
+
+    def sync_pending(self, pay_service: AbstractPaymentService, executor: ThreadPoolExecutor,
+                     batch_size: int) -> Counter:
+        stats = Counter()
+        while True:
+            start = time.perf_counter()
+            batch_stats = self.sync_batch(pay_service, executor, batch_size)
+            if batch_stats:
+                duration = time.perf_counter() - start
+                logger.info(f"Pushed {sum(batch_stats.values())} items in {duration * 1000:.1f}ms: "
+                            f"{dict(batch_stats)}")
+            stats.update(batch_stats)
+            if sum(batch_stats.values()) < batch_size:
+                return stats
+
+    @staticmethod
+    def format_stats(stats: dict) -> str:
+        return ', '.join(f"{count} {key}" for key, count in stats.items())
+
+    def handle(self, loop: bool=False, interval: float=5, batch_size: int=50, workers: int=4,
+               stats: bool=False, **options) -> str:
+        if stats:
+            return self.format_stats(ItemSync.objects.get_stats())
+
+        pay_service = get_pay_service()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            if not loop:
+                pushed = self.sync_pending(pay_service, executor, batch_size)
+                return f"Pushed {sum(pushed.values())} items ({self.format_stats(pushed) or 'nothing to do'})"
+
+            logger.info("Starting to push item synchronizations")
+            try:
+                while True:
+                    if self.sync_pending(pay_service, executor, batch_size):
+                        logger.info(f"Item synchronization: {self.format_stats(ItemSync.objects.get_stats())}")
+                    else:
+                        time.sleep(interval)
+            except KeyboardInterrupt:
+                pass
+        return "Stopped pushing item synchronizations"
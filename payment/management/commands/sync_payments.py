@@ -0,0 +1,138 @@
+from typing import Iterator, List, Optional, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from threading import Lock
+import logging
+import time
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from sales.models import Order, OrderStatus
+from payment.helpers import get_pay_service
+from payment.services.base import AbstractPaymentService
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing out calls to at most `rate` per second
+    """
+
+    def __init__(self, rate: float=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = 0
+        self.lock = Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def chunks(iterable: Sequence, size: int) -> Iterator[Sequence]:
+    for i in range(0, len(iterable), size):
+        yield iterable[i:i + size]
+
+
+class Command(BaseCommand):
+    """
+    Fetch the status of the orders awaiting payment and update them
+
+    Usage:
+        python manage.py sync_payments --help
+    """
+
+    help = "Fetch the status of the orders awaiting payment from the payment service and update them."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-s', '--sale',
+                            default=None,
+                            help="Only synchronize the orders of this sale")
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=16,
+                            help="Number of concurrent requests to the payment service (default: 16)")
+        parser.add_argument('-r', '--rate',
+                            type=float,
+                            default=100,
+                            help="Maximum requests per second to the payment service, 0 to disable (default: 100)")
+        parser.add_argument('-b', '--batch-size',
+                            type=int,
+                            default=200,
+                            help="Number of orders updated per transaction (default: 200)")
+
+    @staticmethod
+    def fetch_statuses(pay_service: AbstractPaymentService, orders: Sequence[Order],
+                       executor: ThreadPoolExecutor, limiter: RateLimiter
+                       ) -> List[Tuple[Order, Optional[OrderStatus]]]:
+        """
+        Concurrently fetch the transaction status of each order,
+        the status is None if it could not be fetched
+        """
+        def fetch(order: Order) -> Tuple[Order, Optional[OrderStatus]]:
+            limiter.wait()
+            try:
+                return order, pay_service.get_transaction_status(order)
+            except Exception as error:
+                logger.warning(f"Could not fetch transaction status of order {order.pk}: {error}")
+                return order, None
+
+        return list(executor.map(fetch, orders))
+
+    @staticmethod
+    def apply_statuses(statuses: Sequence[Tuple[Order, Optional[OrderStatus]]]) -> Counter:
+        """
+        Update the orders which are still awaiting payment in a single transaction
+        """
+        stats = Counter()
+        with transaction.atomic():
+            # Skip the orders updated since their status has been fetched
+            awaiting = set(
+                Order.objects.select_for_update()
+                .filter(pk__in=[ order.pk for order, _ in statuses ],
+                        status=OrderStatus.AWAITING_PAYMENT.value)
+                .values_list('pk', flat=True)
+            )
+            for order, status in statuses:
+                if status is None:
+                    stats['errors'] += 1
+                elif order.pk not in awaiting or status.value == order.status:
+                    stats['unchanged'] += 1
+                else:
+                    try:
+                        with transaction.atomic():
+                            order.update_status(status)
+                        stats[status.name] += 1
+                    except Exception as error:
+                        logger.exception(f"Could not update order {order.pk} to {status.name}: {error}")
+                        stats['errors'] += 1
+        return stats
+
+    def handle(self, sale: str=None, workers: int=16, rate: float=100, batch_size: int=200,
+               **options) -> str:
+        orders = Order.objects.select_related('sale__association') \
+                              .filter(status=OrderStatus.AWAITING_PAYMENT.value, tra_id__isnull=False)
+        if sale is not None:
+            orders = orders.filter(sale_id=sale)
+
+        start = time.perf_counter()
+        stats = Counter()
+        orders = list(orders)
+        pay_service = get_pay_service()
+        limiter = RateLimiter(rate)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in chunks(orders, batch_size):
+                statuses = self.fetch_statuses(pay_service, batch, executor, limiter)
+                stats.update(self.apply_statuses(statuses))
+                logger.info(f"Synchronized {len(batch)} orders: {dict(stats)}")
+
+        duration = time.perf_counter() - start
+        details = ', '.join(f"{count} {key}" for key, count in sorted(stats.items()))
+        return f"Synchronized {len(orders)} orders in {duration:.2f}s ({details or 'nothing to do'})"
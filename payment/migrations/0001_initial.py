@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def init_item_syncs(apps, schema_editor):
+    """
+    Queue the synchronization of the items which have never been synchronized
+    """
+    Item = apps.get_model('sales', 'Item')
+    ItemSync = apps.get_model('payment', 'ItemSync')
+    ItemSync.objects.bulk_create(
+        ItemSync(item_id=item_pk, synced_version=0 if nemopay_id is None else 1)
+        for item_pk, nemopay_id in Item.objects.values_list('pk', 'nemopay_id')
+    )
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('sales', '0003_order_status_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemSync',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='payment_sync', serialize=False, to='sales.item')),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('synced_version', models.PositiveIntegerField(default=0)),
+                ('requested_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('next_try_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='itemsync',
+            index=models.Index(fields=['next_try_at'], name='payment_ite_next_tr_ba0da6_idx'),
+        ),
+        migrations.RunPython(init_item_syncs, migrations.RunPython.noop),
+    ]
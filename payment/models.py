@@ -0,0 +1,105 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.db import models
+
+from sales.models import Item
+
+
+class ItemSyncQuerySet(models.QuerySet):
+
+    def pending(self) -> 'ItemSyncQuerySet':
+        """
+        Items edited since their last synchronization
+        """
+        return self.filter(version__gt=models.F('synced_version'))
+
+    def ready(self) -> 'ItemSyncQuerySet':
+        """
+        Pending items that can be synchronized now
+        """
+        now = timezone.now()
+        unclaimed = models.Q(claimed_until__isnull=True) \
+            | models.Q(claimed_until__lte=now)
+        return self.pending().filter(unclaimed,
+                                     next_try_at__lte=now,
+                                     attempts__lt=settings.ITEM_SYNC_MAX_ATTEMPTS)
+
+    def get_stats(self) -> dict:
+        """
+        Get the synchronization lag and failure counts
+        """
+        stats = self.pending().aggregate(
+            pending=models.Count('pk'),
+            failing=models.Count('pk', filter=models.Q(attempts__gt=0)),
+            abandoned=models.Count('pk', filter=models.Q(attempts__gte=settings.ITEM_SYNC_MAX_ATTEMPTS)),
+            oldest_request=models.Min('requested_at'),
+        )
+        oldest_request = stats.pop('oldest_request')
+        stats['lag'] = (timezone.now() - oldest_request).total_seconds() if oldest_request else 0
+        return stats
+
+
+class ItemSync(models.Model):
+    """
+    Outbox of the item synchronizations with the payment service,
+    written in the same transaction as the item and drained by the sync_items command
+    """
+    item = models.OneToOneField(Item, primary_key=True,
+                                on_delete=models.CASCADE, related_name='payment_sync')
+
+    # Successive edits are coalesced into a single synchronization
+    version        = models.PositiveIntegerField(default=1)
+    synced_version = models.PositiveIntegerField(default=0)
+
+    requested_at = models.DateTimeField(default=timezone.now)  # Oldest unsynchronized edit
+    next_try_at  = models.DateTimeField(default=timezone.now)
+    synced_at    = models.DateTimeField(null=True, blank=True)
+    attempts     = models.PositiveSmallIntegerField(default=0)
+    last_error   = models.TextField(blank=True)
+
+    # Set while a worker pushes the item, edits meanwhile must not release it
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    objects = ItemSyncQuerySet.as_manager()
+
+    @classmethod
+    def enqueue(cls, item: Item) -> None:
+        """
+        Request the synchronization of an item
+        """
+        now = timezone.now()
+        updated = cls.objects.filter(item=item).update(
+            # Keep the oldest unsynchronized edit, set before incrementing the version
+            requested_at=models.Case(
+                models.When(synced_version__gte=models.F('version'), then=models.Value(now)),
+                default=models.F('requested_at'),
+            ),
+            version=models.F('version') + 1,
+            next_try_at=now,
+            attempts=0,
+        )
+        if not updated:
+            cls.objects.create(item=item, requested_at=now, next_try_at=now)
+
+    @staticmethod
+    def get_retry_delay(attempts: int) -> timedelta:
+        """
+        Exponential backoff between failed synchronizations
+        """
+        delay = settings.ITEM_SYNC_RETRY_DELAY * 2 ** max(attempts - 1, 0)
+        return min(delay, settings.ITEM_SYNC_MAX_RETRY_DELAY)
+
+    @property
+    def is_pending(self) -> bool:
+        return self.version > self.synced_version
+
+    def __str__(self) -> str:
+        state = "pending" if self.is_pending else "synchronized"
+        return f"{self.item} ({state})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=('next_try_at',)),
+        ]
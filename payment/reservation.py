@@ -0,0 +1,111 @@
+from typing import Dict, Iterator
+from contextlib import contextmanager
+from threading import Lock
+import logging
+
+from django.db import connection, transaction
+
+from sales.models import Sale, ItemGroup, Item, Order, OrderStatus
+from payment.services.base import AbstractPaymentService
+from payment.validator import OrderValidator
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+# Fallback locks for databases that cannot lock rows (ie. SQLite)
+_process_locks: Dict[str, Lock] = {}
+_process_locks_guard = Lock()
+
+
+def _get_process_lock(sale_pk: str) -> Lock:
+    """
+    Get or create the process-local lock of a sale
+    """
+    with _process_locks_guard:
+        if sale_pk not in _process_locks:
+            _process_locks[sale_pk] = Lock()
+        return _process_locks[sale_pk]
+
+
+def lock_order_stock(order: Order) -> None:
+    """
+    Lock the database rows holding the stock required by an order
+
+    Rows are always locked in the same order (sale, groups, items)
+    to prevent deadlocks between concurrent reservations.
+    Must be called inside a transaction.
+    """
+    item_ids = set(order.orderlines.values_list('item_id', flat=True))
+    group_ids = set(
+        Item.objects.filter(pk__in=item_ids, group__isnull=False)
+        .values_list('group_id', flat=True)
+    )
+
+    # The whole sale is only locked if it has a global quantity to respect
+    list(Sale.objects.select_for_update()
+         .filter(pk=order.sale_id, max_item_quantity__isnull=False)
+         .values_list('pk', flat=True))
+    list(ItemGroup.objects.select_for_update()
+         .filter(pk__in=group_ids).order_by('pk')
+         .values_list('pk', flat=True))
+    list(Item.objects.select_for_update()
+         .filter(pk__in=item_ids).order_by('pk')
+         .values_list('pk', flat=True))
+
+
+@contextmanager
+def reserve_order_stock(order: Order) -> Iterator[None]:
+    """
+    Context manager that holds the stock of the order's sale, items
+    and item groups until the reservation is committed.
+
+    Orders of unrelated sales, or of unrelated items within a sale
+    without global quantity, can be reserved in parallel.
+    The order must enter a booking status before leaving the context
+    for the reservation to be visible to the following ones.
+    """
+    if connection.features.has_select_for_update:
+        # Row locks are released on commit
+        with transaction.atomic():
+            lock_order_stock(order)
+            yield
+    else:
+        # Only protects a single process, without transaction to avoid
+        # lock upgrade errors on databases locking all tables (ie. SQLite)
+        logger.debug(f"Database cannot lock rows, using process lock for sale {order.sale_id}")
+        with _get_process_lock(str(order.sale_id)):
+            yield
+
+
+def reserve_order(order: Order) -> OrderStatus:
+    """
+    Validate an order and book its stock while holding it,
+    and return its previous status to cancel the reservation.
+    The order awaits payment without transaction until it is created.
+    """
+    previous_status = OrderStatus(order.status)
+    with reserve_order_stock(order):
+        validator = OrderValidator(order, raise_on_error=True)
+        validator.validate()
+        order.update_status(OrderStatus.AWAITING_PAYMENT)
+    return previous_status
+
+
+def create_order_transaction(order: Order, pay_service: AbstractPaymentService,
+                             callback_url: str, return_url: str) -> dict:
+    """
+    Reserve the stock of an order and create its transaction once the stock is released,
+    so that a slow payment service does not hold the other reservations of the sale.
+    The reservation is cancelled if the transaction could not be created.
+    """
+    previous_status = reserve_order(order)
+    try:
+        transaction = pay_service.create_transaction(order, callback_url, return_url)
+    except Exception:
+        # Only restored if the order has not been updated meanwhile
+        order.update_status(previous_status)
+        raise
+
+    # Not saved with the order so that a concurrent status update is not overwritten
+    order.tra_id = transaction['tra_id']
+    Order.objects.filter(pk=order.pk).update(tra_id=order.tra_id)
+    return transaction
@@ -1,7 +1,10 @@
+from typing import Any, Callable
+from threading import Lock
 import logging
 from math import ceil
 
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework import status
 
 from sales.models import Sale, Order, OrderStatus, Item
@@ -17,6 +20,15 @@ PAYUTC_TO_ORDER_STATUS = {
     "W": OrderStatus.AWAITING_PAYMENT,
 }
 
+# HTTP status of the responses to a rejected session
+AUTH_ERROR_STATUS = { 401, 403 }
+
+# Shared between workers through the cache
+SESSION_CACHE_KEY = "payutc:session_id"
+SESSION_CACHE_TIMEOUT = int(settings.PAYUTC_SESSION_CACHE_TIMEOUT.total_seconds())
+CATEGORY_CACHE_KEY = "payutc:category:{fun_id}:{sale_id}"
+CATEGORY_CACHE_TIMEOUT = int(settings.PAYUTC_CATEGORY_CACHE_TIMEOUT.total_seconds())
+
 
 class PayutcException(TransactionException):
     """
@@ -41,30 +53,73 @@ class PayutcException(TransactionException):
 
 
 class PayutcService(AbstractPaymentService):
+    """
+    Payment service for PayUTC, meant to be shared by the whole process
+    so that the connections and the session are reused, see get_pay_service
+    """
 
     def __init__(self):
         super().__init__()
         self.client = PayutcClient(settings.PAYUTC)
+        self._login_lock = Lock()
 
-    def _check_login(self) -> None:
-        """Check that the client is logged to the app"""
-        if not self.client.is_authenticated:
+    def _check_login(self, rejected_session: str=None) -> None:
+        """
+        Check that the client is logged to the app,
+        or log in again if the current session has been rejected
+        """
+        with self._login_lock:
+            if self.client.config["session_id"] not in (None, rejected_session):
+                return
+
+            # Try the session of the other workers
+            session_id = cache.get(SESSION_CACHE_KEY)
+            if session_id not in (None, rejected_session):
+                self.client.config["session_id"] = session_id
+                return
+
+            self.client.config["session_id"] = None
             self.client.login_app()
             self.client.login_user()
+            cache.set(SESSION_CACHE_KEY, self.client.config["session_id"], SESSION_CACHE_TIMEOUT)
             logger.debug("Logged in Payutc services")
 
+    def _call_logged(self, method: Callable, *args, **kwargs) -> Any:
+        """
+        Call a client method requiring to be logged in,
+        logging in again once if PayUTC rejects the session
+        """
+        self._check_login()
+        session_id = self.client.config["session_id"]
+        try:
+            return method(*args, **kwargs)
+        except PayutcClientException as error:
+            if getattr(error.response, "status_code", None) not in AUTH_ERROR_STATUS:
+                raise
+            logger.info("Payutc session rejected, logging in again")
+            self._check_login(rejected_session=session_id)
+            return method(*args, **kwargs)
+
     def _get_category_id(self, sale: Sale) -> int:
+        """
+        Get the id of the category of the sale, creating it if needed
+        """
+        key = CATEGORY_CACHE_KEY.format(fun_id=sale.association.fun_id, sale_id=sale.id)
+        category_id = cache.get(key)
+        if category_id is not None:
+            return category_id
+
         data = {
             "name": f"Woolly - {sale.id}",
             "fundation": sale.association.fun_id,
         }
         try:
             try:
-                return self.client.get_categories(data)[0]["id"]
+                category_id = self._call_logged(self.client.get_categories, data)[0]["id"]
             except IndexError:
                 logger.info(f"Creating category {data['name']} on fundation {data['fundation']}")
                 data["fun_id"] = data.pop("fundation")
-                return self.client.upsert_category(data)
+                category_id = self._call_logged(self.client.upsert_category, data)
         except PayutcClientException as error:
             error_defaults = {
                 "code": "category_creation_error",
@@ -72,11 +127,13 @@ class PayutcService(AbstractPaymentService):
             }
             raise PayutcException.from_client(error, **error_defaults) from error
 
+        cache.set(key, category_id, CATEGORY_CACHE_TIMEOUT)
+        return category_id
+
     def sync_item(self, item: Item, **kwargs) -> None:
         """
         Adapter to synchronize an item in the payment service
         """
-        self._check_login()
         sale = item.sale
         data = {
             "name": item.name,
@@ -87,11 +144,13 @@ class PayutcService(AbstractPaymentService):
             "fun_id": sale.association.fun_id,
         }
 
-        action = "Updating" if item.pk else "Creating"
+        action = "Updating" if item.nemopay_id else "Creating"
         logger.info(f"{action} item {data['name']} on fundation {data['fun_id']}")
         try:
-            item.nemopay_id = self.client.upsert_product(data, id=item.nemopay_id)
+            item.nemopay_id = self._call_logged(self.client.upsert_product, data, id=item.nemopay_id)
         except PayutcClientException as error:
+            # The category might have been deleted meanwhile
+            cache.delete(CATEGORY_CACHE_KEY.format(fun_id=data["fun_id"], sale_id=sale.id))
             error_defaults = {
                 "code": "item_synch_error",
                 "message": "Erreur lors de la mise à jour l'article",
@@ -103,6 +162,13 @@ class PayutcService(AbstractPaymentService):
         Adapter to create transaction from an order
         """
         orderlines = order.orderlines.filter(quantity__gt=0).prefetch_related("item")
+        if any(orderline.item.nemopay_id is None for orderline in orderlines):
+            raise PayutcException(
+                message="Certains articles ne sont pas encore synchronisés avec le système de paiement, "
+                        "veuillez réessayer dans quelques instants",
+                code="item_not_synchronized",
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
         itemsArray = [ [int(orderline.item.nemopay_id), orderline.quantity] for orderline in orderlines ]
 
         try:
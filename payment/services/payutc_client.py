@@ -1,7 +1,11 @@
 from functools import partial
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Any
 
+from core import metrics
+
 
 ALLOWED_ACTIONS_MAP = {
     'get': 'get',
@@ -18,6 +22,12 @@ BASE_CONFIG = {
     'fun_id': None,
     'async': False,
 
+    # HTTP connections
+    'timeout': (5, 30),         # Connect and read timeouts in seconds
+    'pool_size': 16,            # Maximum number of kept-alive connections
+    'max_retries': 3,           # Retries on connection errors and unavailability
+    'backoff_factor': 0.2,      # Sleep 0s, 0.4s, 0.8s... between retries
+
     # Login credentials
     'session_id': None,
     'app_key': None,
@@ -45,7 +55,7 @@ class PayutcException(Exception):
                  response: requests.Response=None,
                  config: dict=None,
                  data: dict=None):
-        if response.text:
+        if getattr(response, 'text', None):
             message += f"\nResponse: {response.text}"
         super().__init__(message)
         self.response = response
@@ -79,6 +89,33 @@ class PayutcClient:
             **config,
             **kwargs,
         }
+        self.session = self._build_session()
+
+    def _build_session(self) -> requests.Session:
+        """
+        Build a session keeping the connections to the API alive
+        """
+        # Requests are retried on connection errors, but only
+        # idempotent ones are retried once they have been sent
+        retry = Retry(
+            total=self.config['max_retries'],
+            backoff_factor=self.config['backoff_factor'],
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.config['pool_size'],
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self) -> None:
+        """
+        Close the connections to the API
+        """
+        self.session.close()
 
     def request(self, method: str, uri: str, data: dict={}, api: str='resources', **kwargs) -> Any:
         """
@@ -119,7 +156,8 @@ class PayutcClient:
             request_config['json'] = data
 
         # Make the request
-        response = requests.request(method, url, **request_config)
+        with metrics.timer("payutc"):
+            response = self.session.request(method, url, timeout=self.config['timeout'], **request_config)
 
         if kwargs.get('return_response', False):
             return response
@@ -1,19 +1,41 @@
-from typing import Sequence
+from typing import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from threading import Thread
+import multiprocessing
+import logging
 import random
+import re
+import json
+import time
+
+import requests
 
 from django.utils import timezone
-from django.db import transaction
-from django.test import tag
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.test import tag, skipUnlessDBFeature, SimpleTestCase
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APITestCase, APITransactionTestCase
 
 
 from core.faker import FakeModelFactory
 from core.testcases import get_api_client
 from authentication.models import User, UserType
-from sales.models import Sale, Item, ItemGroup, Order, OrderStatus, OrderLine, OrderLineItem
+from sales.models import Association, Sale, Item, ItemGroup, Order, OrderStatus, OrderLine, OrderLineItem
+from sales.exceptions import OrderValidationException
 from payment.validator import OrderValidator
+from payment.models import ItemSync
+from payment.reservation import _get_process_lock, create_order_transaction, lock_order_stock
+from payment.services.fake import FakePaymentService
+from payment.management.commands.sync_items import Command as SyncItemsCommand, claim_batch, complete_sync
+from payment.services.payutc import PayutcService, SESSION_CACHE_KEY
+from payment.services.payutc_client import PayutcClient
+
+logger = logging.getLogger(f"woolly.{__name__}")
 
 
 def start_and_await_jobs(jobs: Sequence[Thread]) -> None:
@@ -30,6 +52,37 @@ def start_and_await_jobs(jobs: Sequence[Thread]) -> None:
         job.join()
 
 
+class ProcessResponse:
+    """
+    Picklable subset of a response returned from another process
+    """
+
+    def __init__(self, status_code: int, data: dict):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self) -> dict:
+        return self.data
+
+
+def shotgun_in_process(user_pk: str, sale_pk: str, item_pk: int, quantity: int) -> ProcessResponse:
+    """
+    Shotgun an item from another process, with its own database connection
+
+    Arguments:
+        user_pk (str):  the pk of the user to shotgun with
+        sale_pk (str):  the pk of the sale
+        item_pk (int):  the pk of the item to shotgun
+        quantity (int): the quantity to shotgun
+    """
+    user = User.objects.get(pk=user_pk)
+    with get_api_client(user) as client:
+        order_id = client.post(f"/sales/{sale_pk}/orders", {}).json()['id']
+        client.post(f"/orders/{order_id}/orderlines", { 'item': item_pk, 'quantity': quantity })
+        resp = client.get(f"/orders/{order_id}/pay?return_url=http://localhost:3000/orders/{order_id}")
+        return ProcessResponse(resp.status_code, resp.json())
+
+
 @tag('validation')
 class OrderValidatorTestCase(APITestCase):
 
@@ -307,6 +360,22 @@ class OrderValidatorTestCase(APITestCase):
         self.itemgroup.save()
         self._test_validation(True)
 
+    @tag('quantities')
+    def test_quantities_constant_queries(self):
+        """
+        Quantities must be checked with a number of queries
+        independent of the number of existing orders
+        """
+        validator = OrderValidator(self.order, raise_on_error=False)
+        list(validator.orderlines)
+        with self.assertNumQueries(1):
+            validator.check_quantities()
+
+        for user in self.users * 3:
+            self._create_order(user, status=OrderStatus.PAID.value)
+        with self.assertNumQueries(1):
+            validator.check_quantities()
+
 
 @tag('validation', 'shotgun')
 class ShotgunTestCase(APITransactionTestCase):
@@ -465,7 +534,7 @@ class ShotgunTestCase(APITransactionTestCase):
         # Buy orders
         self.start_shotguns(max_quantity=self.n_users)
         orders = [
-            resp.json()['redirect_url'].split('/', 2)[1] for resp in self.responses
+            resp.json()['redirect_url'].rsplit('/', 1)[1] for resp in self.responses
         ]
 
         # Start jobs and wait for them to finish
@@ -491,3 +560,390 @@ class ShotgunTestCase(APITransactionTestCase):
         # Check OrderLineItems quantity
         n_orderlineitems = OrderLineItem.objects.count()
         self.assertEqual(n_orderlineitems, n_orders, "Wrong number of tickets generated")
+
+
+@tag('validation', 'shotgun')
+@skipUnlessDBFeature('has_select_for_update')
+class MultiProcessShotgunTestCase(ShotgunTestCase):
+    """
+    Same shotgun as ShotgunTestCase but with concurrent processes,
+    as with multiple workers serving the API, to ensure no overselling
+    """
+
+    n_processes = 4
+
+    def start_shotguns(self, items: Sequence[Item]=None, max_quantity: int=None, quantity_per_request: int=1):
+        """
+        Shotgun items with multiple user accounts from multiple processes
+        """
+        if items is None:
+            items = self.items
+        if max_quantity is None:
+            max_quantity = self.max_quantity
+
+        # Connections must not be shared with the forked processes
+        connections.close_all()
+        args = [
+            (user.pk, self.sale.pk, random.choice(items).pk, quantity_per_request)
+            for user in self.users
+        ]
+        with multiprocessing.get_context('fork').Pool(self.n_processes) as pool:
+            self.responses = pool.starmap(shotgun_in_process, args)
+
+        # Analyse responses
+        nb_success = sum(resp.status_code == 200 for resp in self.responses)
+        nb_awaiting = sum(resp.json().get('status') == OrderStatus.AWAITING_PAYMENT.name
+                          for resp in self.responses)
+        self.assertEqual(nb_success, max_quantity)
+        self.assertEqual(nb_awaiting, max_quantity)
+
+        # Check that the database did not book more than allowed
+        booked = OrderLine.objects.filter(order__sale=self.sale,
+                                          order__status__in=OrderStatus.BOOKING_LIST.value)
+        self.assertEqual(sum(booked.values_list('quantity', flat=True)),
+                         max_quantity * quantity_per_request)
+
+
+@tag('validation', 'shotgun')
+class ReservationTestCase(APITestCase):
+    """
+    Test the reservation of the stock of orders in a single process,
+    the concurrent reservations are tested by MultiProcessShotgunTestCase
+    """
+    factory = FakeModelFactory()
+    url = "http://localhost:3000/orders"
+
+    def setUp(self):
+        now = timezone.now()
+        self.sale = self.factory.create(Sale, is_active=True, max_item_quantity=10,
+                                        begin_at=now - timezone.timedelta(days=1),
+                                        end_at=now + timezone.timedelta(days=1))
+        usertype = self.factory.create(UserType, validation='True')
+        self.group = self.factory.create(ItemGroup, sale=self.sale, quantity=None, max_per_user=None)
+        self.items = [
+            self.factory.create(Item, sale=self.sale, group=group, usertype=usertype, is_active=True,
+                                quantity=2, max_per_user=None)
+            for group in (self.group, None)
+        ]
+        self.order = self.create_order()
+
+    def create_order(self) -> Order:
+        order = self.factory.create(Order, sale=self.sale, status=OrderStatus.ONGOING.value, tra_id=None)
+        for item in self.items:
+            self.factory.create(OrderLine, order=order, item=item, quantity=2)
+        return order
+
+    def assertBooked(self, quantity: int):
+        for item in self.items:
+            item.refresh_from_db()
+            self.assertEqual(item.booked_quantity, quantity)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.booked_quantity, quantity)
+
+    def test_lock_ordering(self):
+        with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+            lock_order_stock(self.order)
+        tables = [ re.search(r'FROM "(\w+)"', query['sql']).group(1) for query in queries.captured_queries ]
+        self.assertListEqual(tables[-3:], [ 'sales_sale', 'sales_itemgroup', 'sales_item' ])
+        for query in queries.captured_queries[-2:]:
+            self.assertIn('ORDER BY', query['sql'])
+
+    def test_transaction_created_after_reservation(self):
+        def check(order: Order):
+            # The stock is booked and released before calling the payment service
+            self.assertEqual(Order.objects.get(pk=order.pk).status, OrderStatus.AWAITING_PAYMENT.value)
+            self.assertBooked(2)
+            self.assertFalse(_get_process_lock(str(order.sale_id)).locked())
+
+        create_order_transaction(self.order, CheckedPaymentService(check), self.url, self.url)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.tra_id), (OrderStatus.AWAITING_PAYMENT.value, 1))
+        self.assertBooked(2)
+
+    def test_failed_transaction_cancels_reservation(self):
+        with self.assertRaises(ConnectionError):
+            create_order_transaction(self.order, FailingPaymentService(), self.url, self.url)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.tra_id), (OrderStatus.ONGOING.value, None))
+        self.assertBooked(0)
+
+    def test_rejected_order_is_not_booked(self):
+        create_order_transaction(self.order, FakePaymentService(), self.url, self.url)
+        other_order = self.create_order()
+
+        def check(order: Order):
+            self.fail("The payment service must not be called for rejected orders")
+
+        with self.assertRaises(OrderValidationException):
+            create_order_transaction(other_order, CheckedPaymentService(check), self.url, self.url)
+        other_order.refresh_from_db()
+        self.assertEqual(other_order.status, OrderStatus.ONGOING.value)
+        self.assertBooked(2)
+
+        # Orders without transaction are expired from their age
+        Order.objects.filter(pk=self.order.pk).update(tra_id=None)
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.is_expired())
+        self.assertEqual(self.order.fetch_status(), OrderStatus.AWAITING_PAYMENT)
+
+
+@tag('payment')
+class SyncPaymentsTestCase(APITestCase):
+    """
+    Test the reconciliation of the orders awaiting payment
+    """
+    factory = FakeModelFactory()
+
+    def test_sync_payments(self):
+        sale = self.factory.create(Sale)
+        item = self.factory.create(Item, sale=sale, group=None)
+        orders = [
+            self.factory.create(Order, sale=sale, tra_id=tra_id,
+                                status=OrderStatus.AWAITING_PAYMENT.value)
+            for tra_id in (1, 2, 3, None)
+        ]
+        for order in orders:
+            self.factory.create(OrderLine, order=order, item=item, quantity=2)
+        validated = self.factory.create(Order, sale=sale, tra_id=4, status=OrderStatus.VALIDATED.value)
+
+        call_command('sync_payments', sale=sale.pk, workers=2, batch_size=2, stdout=StringIO())
+
+        # The fake payment service always considers orders as paid
+        statuses = dict(Order.objects.values_list('pk', 'status'))
+        for order in orders[:3]:
+            self.assertEqual(statuses[order.pk], OrderStatus.PAID.value)
+            self.assertEqual(OrderLineItem.objects.filter(orderline__order=order).count(), 2)
+        self.assertEqual(statuses[orders[3].pk], OrderStatus.AWAITING_PAYMENT.value)
+        self.assertEqual(statuses[validated.pk], OrderStatus.VALIDATED.value)
+
+
+class StubPayutcHandler(BaseHTTPRequestHandler):
+    """
+    Minimal keep-alive PayUTC API, rejecting sessions other than the server's one
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def parse_request(self) -> bool:
+        parsed = super().parse_request()
+        if parsed:
+            self.server.paths.append(self.path.split('?')[0])
+        return parsed
+
+    def respond(self, status_code: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.split('?')[0].endswith(('loginApp', 'login2')):
+            self.server.logins += 1
+            self.respond(200, { 'sessionid': self.server.session_id, 'username': 'woolly' })
+        elif self.path.startswith('/resources/') \
+                and self.headers.get('Cookie') != f"sessionid={self.server.session_id}":
+            self.respond(401, { 'detail': "Session expirée" })
+        else:
+            self.respond(200, [{ 'id': 1, 'status': 'V' }])
+
+    do_POST = do_GET
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@tag('payment', 'benchmark')
+class PayutcClientTestCase(SimpleTestCase):
+    """
+    Test the PayUTC client and service against a local stub server
+    """
+    n_calls = 100
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubPayutcHandler)
+        cls.server.daemon_threads = True
+        cls.server.connections = 0
+        cls.server.logins = 0
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    def setUp(self):
+        self.server.session_id = 'session'
+        self.server.paths = []
+        cache.clear()
+
+    def get_service(self) -> PayutcService:
+        service = PayutcService()
+        service.client = PayutcClient(base_url=self.base_url)
+        self.addCleanup(service.client.close)
+        return service
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def benchmark(self, call: Callable) -> tuple:
+        """
+        Return the mean latency in ms of the call and the number of opened connections
+        """
+        connections = self.server.connections
+        start = time.perf_counter()
+        for _ in range(self.n_calls):
+            call()
+        latency = (time.perf_counter() - start) * 1000 / self.n_calls
+        return latency, self.server.connections - connections
+
+    def test_connections_reuse(self):
+        client = PayutcClient(base_url=self.base_url)
+        url = f"{self.base_url}/services/WEBSALE/getTransactionInfo"
+        data = { 'tra_id': 1, 'fun_id': 1 }
+
+        latency_before, connections_before = self.benchmark(lambda: requests.post(url, json=data))
+        latency_after, connections_after = self.benchmark(lambda: client.get_transaction(data))
+        client.close()
+
+        logger.debug(f"PayUTC per-call latency: {latency_before:.2f}ms with a connection per call, "
+                     f"{latency_after:.2f}ms with a pooled session")
+        self.assertEqual(connections_before, self.n_calls)
+        self.assertEqual(connections_after, 1)
+
+    def test_login_again_when_session_rejected(self):
+        service = self.get_service()
+        logins = self.server.logins
+
+        # Log in once and reuse the session
+        for _ in range(3):
+            self.assertEqual(service._call_logged(service.client.get_categories, {})[0]['id'], 1)
+        self.assertEqual(self.server.logins - logins, 2)
+
+        # The session is shared with the other workers through the cache
+        other_service = self.get_service()
+        other_service._call_logged(other_service.client.get_categories, {})
+        self.assertEqual(self.server.logins - logins, 2)
+
+        # Log in again once the session is rejected
+        self.server.session_id = 'new_session'
+        self.assertEqual(service._call_logged(service.client.get_categories, {})[0]['id'], 1)
+        self.assertEqual(self.server.logins - logins, 4)
+        self.assertEqual(service.client.config['session_id'], 'new_session')
+        self.assertEqual(cache.get(SESSION_CACHE_KEY), 'new_session')
+
+    def test_category_id_cache(self):
+        service = self.get_service()
+        sale = Sale(pk=1, association=Association(pk='asso', fun_id=2))
+        for _ in range(3):
+            self.assertEqual(service._get_category_id(sale), 1)
+        self.assertEqual(self.server.paths.count('/resources/categories'), 1)
+
+
+class FailingPaymentService(FakePaymentService):
+
+    def sync_item(self, item: Item, **kwargs) -> None:
+        raise ConnectionError("PayUTC is down")
+
+    def create_transaction(self, order: Order, callback_url: str, return_url: str, **kwargs) -> dict:
+        raise ConnectionError("PayUTC is down")
+
+
+class CheckedPaymentService(FakePaymentService):
+    """
+    Fake payment service running a check on the orders before creating their transaction
+    """
+
+    def __init__(self, check: Callable[[Order], None]):
+        self.check = check
+
+    def create_transaction(self, order: Order, callback_url: str, return_url: str, **kwargs) -> dict:
+        self.check(order)
+        return super().create_transaction(order, callback_url, return_url, **kwargs)
+
+
+@tag('payment')
+class ItemSyncTestCase(APITestCase):
+    """
+    Test the queued synchronization of items with the payment service
+    """
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        self.item = self.factory.create(Item, group=None)
+
+    def test_item_edits_are_coalesced(self):
+        for price in (2, 3):
+            self.item.price = price
+            self.item.save()
+        sync = ItemSync.objects.get(item=self.item)
+        self.assertEqual((sync.version, sync.synced_version), (3, 0))
+
+        call_command('sync_items', stdout=StringIO())
+        sync.refresh_from_db()
+        self.assertEqual((sync.version, sync.synced_version), (3, 3))
+        self.assertEqual(ItemSync.objects.get_stats()['pending'], 0)
+
+        # Saving fields unrelated to the payment service does not queue a synchronization
+        self.item.save(update_fields=('description',))
+        self.assertFalse(ItemSync.objects.pending().exists())
+
+    def test_failed_syncs_are_retried_later(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            stats = SyncItemsCommand().sync_pending(FailingPaymentService(), executor, batch_size=10)
+            self.assertEqual(stats['failed'], 1)
+
+            sync = ItemSync.objects.get(item=self.item)
+            self.assertEqual(sync.attempts, 1)
+            self.assertEqual(sync.last_error, "PayUTC is down")
+            self.assertGreater(sync.next_try_at, timezone.now())
+            self.assertEqual(ItemSync.objects.get_stats()['failing'], 1)
+
+            # Not retried before the backoff delay
+            stats = SyncItemsCommand().sync_pending(FakePaymentService(), executor, batch_size=10)
+            self.assertFalse(stats)
+
+    def test_edit_during_push_is_synced_again(self):
+        (sync, version), = claim_batch(10)
+        self.item.name = "New name"
+        self.item.save()
+        complete_sync(sync, version, None)
+        self.assertTrue(ItemSync.objects.pending().filter(item=self.item).exists())
+
+    def test_edit_during_push_keeps_the_claim(self):
+        (sync, version), = claim_batch(10)
+        self.item.name = "New name"
+        self.item.save()
+
+        # Another worker must not push the item again before it gets its nemopay_id
+        self.assertListEqual(claim_batch(10), [])
+        sync.item.nemopay_id = '42'
+        complete_sync(sync, version, None)
+
+        (sync, new_version), = claim_batch(10)
+        self.assertGreater(new_version, version)
+        self.assertEqual(sync.item.nemopay_id, '42')
+
+    def test_stale_save_keeps_the_synced_nemopay_id(self):
+        Item.objects.filter(pk=self.item.pk).update(nemopay_id=None)
+        stale_item = Item.objects.get(pk=self.item.pk)
+        (sync, version), = claim_batch(10)
+        sync.item.nemopay_id = '42'
+        complete_sync(sync, version, None)
+
+        # Saving an instance loaded before the push does not erase its result
+        stale_item.description = "New description"
+        stale_item.save()
+        self.assertEqual(Item.objects.get(pk=self.item.pk).nemopay_id, '42')
+
+        # But explicit changes are kept
+        stale_item.nemopay_id = '43'
+        stale_item.save()
+        self.assertEqual(Item.objects.get(pk=self.item.pk).nemopay_id, '43')
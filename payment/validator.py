@@ -1,8 +1,10 @@
-from typing import List, Sequence
+from typing import List, Iterable, Tuple
 from collections import namedtuple
 
+from django.db.models import Q, Sum
 from django.utils import timezone
 
+from authentication.hydration import hydrate_user
 from sales.exceptions import OrderValidationException
 from sales.models import Order, OrderLine, OrderStatus
 
@@ -18,8 +20,8 @@ class OrderValidator:
 
     def __init__(self, order: Order, raise_on_error: bool=True):
         self.order = order
-        self.orderlines = self.order.orderlines.select_related('item__usertype').all()
-        self.owner = self.order.owner.get_with_api_data()
+        self.orderlines = self.order.orderlines.select_related('item__usertype', 'item__group').all()
+        self.owner = hydrate_user(self.order.owner)
         self.sale = self.order.sale
 
         self.raise_on_error = raise_on_error
@@ -97,12 +99,14 @@ class OrderValidator:
         if owner_has_prev_ongoing_orders:
             self._add_error("Vous avez déjà une commande en cours pour cette vente.")
 
-        # Check if user can buy items
-        # -- 2 QUERY
-        # UserType.objects.filter()
+        # Check if user can buy items, once per usertype
+        is_of_type = {}
         for orderline in self.orderlines:
-            if not orderline.item.usertype.check_user(self.owner):
-                self._add_error(f"L'article {orderline.item.name} est réservé à {orderline.item.usertype.name}")
+            usertype = orderline.item.usertype
+            if usertype.pk not in is_of_type:
+                is_of_type[usertype.pk] = usertype.check_user(self.owner)
+            if not is_of_type[usertype.pk]:
+                self._add_error(f"L'article {orderline.item.name} est réservé à {usertype.name}")
 
     def check_quantities(self) -> None:
         """
@@ -112,46 +116,57 @@ class OrderValidator:
         #   I - Fetch resources
         # --------------------------------------------
 
-        # All orders which book items except the one we are processing
-        sale_orderlines = (
+        # Quantities booked per item by all orders except the one we are processing,
+        # and among them by the orders that the user already booked
+        # -- 1 QUERY, grouped by item
+        booked_per_item = (
             OrderLine.objects
             .filter(order__sale__pk=self.sale.pk,
                     order__status__in=OrderStatus.BOOKING_LIST.value)
             .exclude(order__pk=self.order.pk)
-            .prefetch_related('item', 'item__group')
+            .order_by()
+            .values('item_id', 'item__group_id')
+            .annotate(sale_qt=Sum('quantity'),
+                      user_qt=Sum('quantity', filter=Q(order__owner__pk=self.owner.pk)))
         )
 
-        # Orders that the user already booked
-        # user_orderlines = sale_orderlines.filter(order__owner__pk=self.owner.pk)
-        user_orderlines = [
-            orderline
-            for orderline in sale_orderlines
-            if orderline.order.owner_id == self.owner.pk
-        ]
-
         # --------------------------------------------
         #   II - Process quantities
         # --------------------------------------------
 
         Quantity = namedtuple('Quantity', ['total', 'per_item', 'per_group'])
 
-        def build_quantity(orderlines: Sequence[OrderLine]) -> Quantity:
+        def build_quantity(rows: Iterable[Tuple[int, int, int]]) -> Quantity:
             """
             Helper to build total, per item and per group quantities
+            from (item_pk, group_pk, quantity) rows
             """
             count, per_item, per_group = 0, {}, {}
-            for orderline in orderlines:
-                count += orderline.quantity
-                per_item[orderline.item] = per_item.get(orderline.item, 0) + orderline.quantity
-                if orderline.item.group:
-                    per_group[orderline.item.group] = per_group.get(orderline.item.group, 0) + orderline.quantity
+            for item_pk, group_pk, quantity in rows:
+                count += quantity
+                per_item[item_pk] = per_item.get(item_pk, 0) + quantity
+                if group_pk is not None:
+                    per_group[group_pk] = per_group.get(group_pk, 0) + quantity
 
             return Quantity._make([count, per_item, per_group])
 
         # Quantity per item and Total quantity bought in the order
-        order_qt = build_quantity(self.orderlines)
-        sale_qt  = build_quantity(sale_orderlines)
-        user_qt  = build_quantity(user_orderlines)
+        items = { orderline.item_id: orderline.item for orderline in self.orderlines }
+        groups = { item.group_id: item.group for item in items.values() if item.group_id }
+        order_qt = build_quantity(
+            (orderline.item_id, orderline.item.group_id, orderline.quantity)
+            for orderline in self.orderlines
+        )
+
+        booked_per_item = list(booked_per_item)
+        sale_qt = build_quantity(
+            (row['item_id'], row['item__group_id'], row['sale_qt'])
+            for row in booked_per_item
+        )
+        user_qt = build_quantity(
+            (row['item_id'], row['item__group_id'], row['user_qt'] or 0)
+            for row in booked_per_item
+        )
 
         # --------------------------------------------
         #   III - Verification
@@ -168,22 +183,24 @@ class OrderValidator:
 
         # === III.2 - Item level verification
 
-        for item, qt in order_qt.per_item.items():
+        for item_pk, qt in order_qt.per_item.items():
+            item = items[item_pk]
             # Check quantity per item
-            if is_quantity(item.quantity) and sale_qt.per_item.get(item, 0) + qt > item.quantity:
+            if is_quantity(item.quantity) and sale_qt.per_item.get(item_pk, 0) + qt > item.quantity:
                 self._add_error(f"Il ne reste pas assez de {item.name}.")
 
             # Check max_per_user per item
-            if is_quantity(item.max_per_user) and user_qt.per_item.get(item, 0) + qt > item.max_per_user:
+            if is_quantity(item.max_per_user) and user_qt.per_item.get(item_pk, 0) + qt > item.max_per_user:
                 self._add_error(f"Vous ne pouvez pas prendre plus de {item.max_per_user} {item.name} par utilisateur.")
 
         # === III.3 - ItemGroup level verification
 
-        for group, qt in order_qt.per_group.items():
+        for group_pk, qt in order_qt.per_group.items():
+            group = groups[group_pk]
             # Check quantity per group
-            if is_quantity(group.quantity) and sale_qt.per_group.get(group, 0) + qt > group.quantity:
+            if is_quantity(group.quantity) and sale_qt.per_group.get(group_pk, 0) + qt > group.quantity:
                 self._add_error(f"Il ne reste pas assez de {group.name}.")
 
             # Check max_per_user per group
-            if is_quantity(group.max_per_user) and user_qt.per_group.get(group, 0) + qt > group.max_per_user:
+            if is_quantity(group.max_per_user) and user_qt.per_group.get(group_pk, 0) + qt > group.max_per_user:
                 self._add_error(f"Vous ne pouvez pas prendre plus de {group.max_per_user} {group.name} par utilisateur.")
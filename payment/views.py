@@ -1,5 +1,3 @@
-from threading import Lock
-
 from django.urls import reverse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
@@ -7,11 +5,8 @@ from rest_framework.response import Response
 from rest_framework import status
 
 from sales.models import Order, OrderStatus
-from payment.validator import OrderValidator
 from payment.helpers import get_pay_service
-
-
-pay_lock = Lock()
+from payment.reservation import create_order_transaction
 
 
 class PaymentView:
@@ -27,37 +22,28 @@ class PaymentView:
 
         Steps:
             1. Retrieve Order
-            2. Verify Order
-            3. Create Transaction
-            4. Save Transaction info and redirect
+            2. Verify Order and book its stock
+            3. Create Transaction and save its id
+            4. Redirect
         """
         # 1. Retrieve Order
         order = Order.objects.filter(owner__pk=request.user.pk) \
                      .filter(status__in=OrderStatus.BUYABLE_STATUS_LIST.value) \
-                     .select_related('sale', 'owner') \
+                     .select_related('sale') \
                      .get(pk=pk)
+        # The owner has already been hydrated with its portal data
+        order.owner = request.user
 
-        # Lock sensitive part
-        with pay_lock:
-
-            # 2. Verify Order
-            validator = OrderValidator(order, raise_on_error=True)
-            validator.validate()
-
-            # 3. Create Transaction
-            pay_service = get_pay_service(order, request)
-            callback_url = request.build_absolute_uri(
-                reverse('order-status', kwargs={ 'pk': order.pk })
-            )
-            return_url = request.GET['return_url']
-            transaction = pay_service.create_transaction(order, callback_url, return_url)
-
-            # 4. Save transaction id and redirect
-            order.status = OrderStatus.AWAITING_PAYMENT.value
-            order.tra_id = transaction['tra_id']
-            order.save()
+        # 2. Verify Order and book its stock
+        # 3. Create Transaction once the stock is released
+        pay_service = get_pay_service(order, request)
+        callback_url = request.build_absolute_uri(
+            reverse('order-status', kwargs={ 'pk': order.pk })
+        )
+        return_url = request.GET['return_url']
+        transaction = create_order_transaction(order, pay_service, callback_url, return_url)
 
-        # Redirect to transaction url
+        # 4. Redirect to transaction url
         resp = {
             'status': order.get_status_display(),
             'redirect_url': transaction['url'],
@@ -1,12 +1,16 @@
+from tempfile import TemporaryFile
+
 from django.utils.safestring import mark_safe
 from django.db.models import Count
 from django.contrib import admin
+from django.http import FileResponse
 
 from core.helpers import adaptable_editability_fields
+from .tickets import export_sale_tickets
 from .models import (
     Association, Sale, ItemGroup, Item,
     OrderStatus, Order, OrderLine, OrderLineItem,
-    Field, ItemField, OrderLineField,
+    Field, ItemField, OrderLineField, CheckIn,
 )
 
 
@@ -68,6 +72,23 @@ class SaleAdmin(admin.ModelAdmin):
 
     search_fields = ('name', 'association')
     ordering = ('begin_at', 'end_at')
+    actions = ('export_tickets',)
+
+    def export_tickets(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, "Select exactly one sale to export its tickets", level='error')
+            return None
+
+        # Rendered with the shared pool of the web worker,
+        # the export_tickets command can use more processes for large sales
+        sale = queryset.get()
+        archive = TemporaryFile()
+        export_sale_tickets(sale.pk, archive)
+        archive.seek(0)
+        return FileResponse(archive, as_attachment=True, filename=f"Woolly_{sale.pk}_tickets.zip",
+                            content_type='application/zip')
+
+    export_tickets.short_description = "Export the tickets as a ZIP of PDFs"
 
 
 # --------------------------------------------
@@ -218,6 +239,19 @@ class OrderLineFieldAdmin(admin.ModelAdmin):
     search_fields = ('value', 'orderlineitem__id,' 'orderlineitem__orderline__owner__email')
 
 
+# --------------------------------------------
+#   Check-ins
+# --------------------------------------------
+
+class CheckInAdmin(admin.ModelAdmin):
+    list_display = ('orderlineitem', 'scanned_at', 'scanned_by', 'device')
+    list_filter = ('orderlineitem__orderline__order__sale', 'device')
+    list_select_related = ('scanned_by', 'orderlineitem__orderline__item', 'orderlineitem__orderline__order__owner')
+    readonly_fields = ('orderlineitem', 'scanned_at', 'scanned_by', 'device')
+    search_fields = ('orderlineitem__id', 'orderlineitem__orderline__order__owner__email')
+    ordering = ('-scanned_at',)
+
+
 admin.site.register(Association, AssociationAdmin)
 admin.site.register(Sale, SaleAdmin)
 
@@ -230,3 +264,4 @@ admin.site.register(Field, FieldAdmin)
 # admin.site.register(ItemField)
 admin.site.register(OrderLineItem, OrderLineItemAdmin)
 admin.site.register(OrderLineField, OrderLineFieldAdmin)
+admin.site.register(CheckIn, CheckInAdmin)
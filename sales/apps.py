@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SalesConfig(AppConfig):
     name = 'sales'
     verbose_name = 'Sales'
+
+    def ready(self):
+        from sales import signals  # noqa: F401
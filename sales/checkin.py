@@ -0,0 +1,282 @@
+from typing import BinaryIO, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+from datetime import datetime
+from io import BytesIO
+import logging
+import struct
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from authentication.models import User
+from sales.exceptions import InvalidTicket, TicketAlreadyScanned
+from sales.models import CheckIn, OrderLineItem, OrderStatus
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+# The token changes each time the valid tickets of a sale change
+INDEX_TOKEN_CACHE_KEY = "checkin:token:{sale_pk}"
+INDEX_CACHE_KEY = "checkin:index:{sale_pk}"
+BUNDLE_CACHE_KEY = "checkin:bundle:{sale_pk}:{token}"
+INDEX_TIMEOUT = int(settings.CHECKIN_INDEX_TIMEOUT.total_seconds())
+
+# Offline bundle: header, records sorted by UUID and UTF-8 holder names
+BUNDLE_MAGIC = b'WLCK'
+BUNDLE_VERSION = 1
+# Magic, version, number of records, generation timestamp
+BUNDLE_HEADER = struct.Struct('>4sHIQ')
+# UUID, item id, offset and length of the holder name
+BUNDLE_RECORD = struct.Struct('>16sIIH')
+
+MAX_UPLOADED_SCANS = 10000
+
+# Indexes already loaded by this process, by sale: (token, uuids)
+_indexes = {}
+
+
+# --------------------------------------------
+#   Index
+# --------------------------------------------
+
+def get_index_token(sale_pk: str) -> str:
+    """
+    Get the token of the current valid tickets of a sale
+    """
+    token_key = INDEX_TOKEN_CACHE_KEY.format(sale_pk=sale_pk)
+    token = cache.get(token_key)
+    if token is None:
+        cache.add(token_key, uuid.uuid4().hex, INDEX_TIMEOUT)
+        token = cache.get(token_key)
+    return token
+
+
+def clear_checkin_index(sale_pk: str) -> None:
+    """
+    Invalidate the index of the valid tickets of a sale in every process
+    """
+    cache.set(INDEX_TOKEN_CACHE_KEY.format(sale_pk=sale_pk), uuid.uuid4().hex, INDEX_TIMEOUT)
+
+
+def get_checkin_index(sale_pk: str) -> FrozenSet[str]:
+    """
+    Get the hex UUIDs of the valid tickets of a sale,
+    from the process memory, the cache or the database
+    """
+    token = get_index_token(sale_pk)
+
+    # Fast path, the index of this process is up to date
+    local = _indexes.get(sale_pk)
+    if local is not None and local[0] == token:
+        return local[1]
+
+    index_key = INDEX_CACHE_KEY.format(sale_pk=sale_pk)
+    stored = cache.get(index_key)
+    if stored is not None and stored[0] == token:
+        uuids = stored[1]
+    else:
+        # The token is read before the tickets so that a concurrent
+        # invalidation makes this index outdated instead of missing tickets
+        uuids = frozenset(
+            ticket_id.hex for ticket_id in get_valid_tickets(sale_pk).values_list('id', flat=True).iterator()
+        )
+        cache.set(index_key, (token, uuids), INDEX_TIMEOUT)
+        logger.info(f"Loaded check-in index of sale {sale_pk} with {len(uuids)} tickets")
+
+    _indexes[sale_pk] = (token, uuids)
+    return uuids
+
+
+def get_valid_tickets(sale_pk: str):
+    return OrderLineItem.objects.filter(
+        orderline__order__sale_id=sale_pk,
+        orderline__order__status__in=OrderStatus.VALIDATED_LIST.value,
+    )
+
+
+# --------------------------------------------
+#   Scans
+# --------------------------------------------
+
+def parse_ticket_id(code: Union[str, uuid.UUID]) -> uuid.UUID:
+    """
+    Parse the UUID of a ticket, with or without dashes as in QR codes
+    """
+    try:
+        return code if isinstance(code, uuid.UUID) else uuid.UUID(str(code).strip())
+    except ValueError:
+        raise InvalidTicket(details=f"Code: {code}")
+
+
+def check_in(sale_pk: str, code: str, user: User=None, device: str='') -> CheckIn:
+    """
+    Check in a ticket of a sale and return the check in.
+    Concurrent scans of the same ticket are detected by the database.
+    """
+    ticket_id = parse_ticket_id(code)
+    if ticket_id.hex not in get_checkin_index(sale_pk):
+        raise InvalidTicket(details=f"Code: {code}")
+
+    try:
+        with transaction.atomic():
+            return CheckIn.objects.create(orderlineitem_id=ticket_id, scanned_by=user, device=device)
+    except IntegrityError:
+        checkin = CheckIn.objects.filter(pk=ticket_id).first()
+        # The ticket has been deleted since the index was loaded
+        if checkin is None:
+            raise InvalidTicket(details=f"Code: {code}")
+        raise TicketAlreadyScanned(details={
+            'ticket': str(ticket_id),
+            'scanned_at': checkin.scanned_at.isoformat(),
+            'device': checkin.device,
+        })
+
+
+def parse_scan(scan: dict) -> Tuple[uuid.UUID, datetime]:
+    """
+    Parse an offline scan, which cannot be in the future
+    """
+    ticket_id = parse_ticket_id(scan.get('ticket'))
+    scanned_at = parse_datetime(str(scan.get('scanned_at', '')))
+    if scanned_at is None:
+        raise InvalidTicket(details=f"Date: {scan.get('scanned_at')}")
+    if timezone.is_naive(scanned_at):
+        scanned_at = timezone.make_aware(scanned_at)
+    return ticket_id, min(scanned_at, timezone.now())
+
+
+def upload_checkins(sale_pk: str, scans: Iterable[dict], user: User=None, device: str='') -> List[dict]:
+    """
+    Record scans made offline and return the result of each of them.
+    When a ticket was scanned multiple times, the earliest scan wins.
+    """
+    results, valid_results = [], []
+    earliest = {}
+    index = get_checkin_index(sale_pk)
+    for scan in scans:
+        if not isinstance(scan, dict):
+            scan = {}
+        result = { 'ticket': scan.get('ticket') }
+        results.append(result)
+        try:
+            ticket_id, scanned_at = parse_scan(scan)
+        except InvalidTicket:
+            ticket_id = None
+        if ticket_id is None or ticket_id.hex not in index:
+            result['status'] = 'invalid'
+            continue
+
+        valid_results.append((ticket_id, scanned_at, result))
+        if ticket_id not in earliest or scanned_at < earliest[ticket_id]:
+            earliest[ticket_id] = scanned_at
+
+    with transaction.atomic():
+        # Tickets might have been deleted since the index was loaded
+        existing = set(OrderLineItem.objects.filter(pk__in=earliest.keys())
+                                            .values_list('pk', flat=True))
+        earliest = { ticket_id: scanned_at for ticket_id, scanned_at in earliest.items()
+                     if ticket_id in existing }
+        CheckIn.objects.bulk_create((
+            CheckIn(orderlineitem_id=ticket_id, scanned_at=scanned_at, scanned_by=user, device=device)
+            for ticket_id, scanned_at in earliest.items()
+        ), ignore_conflicts=True)
+        # Replace the check-ins made after the offline scans
+        checkins = CheckIn.objects.in_bulk(earliest.keys())
+        for ticket_id, scanned_at in earliest.items():
+            if checkins[ticket_id].scanned_at > scanned_at:
+                updated = CheckIn.objects.filter(pk=ticket_id, scanned_at__gt=scanned_at) \
+                                         .update(scanned_at=scanned_at, scanned_by=user, device=device)
+                # An earlier scan might have been uploaded meanwhile
+                checkins[ticket_id] = CheckIn(orderlineitem_id=ticket_id, scanned_at=scanned_at,
+                                              scanned_by=user, device=device) \
+                    if updated else CheckIn.objects.get(pk=ticket_id)
+
+    for ticket_id, scanned_at, result in valid_results:
+        checkin = checkins.get(ticket_id)
+        if checkin is None:
+            result['status'] = 'invalid'
+            continue
+        is_first = checkin.scanned_at == scanned_at and checkin.device == device
+        result.update({
+            'status': 'checked_in' if is_first else 'already_scanned',
+            'scanned_at': checkin.scanned_at,
+            'device': checkin.device,
+        })
+    return results
+
+
+# --------------------------------------------
+#   Offline bundle
+# --------------------------------------------
+
+def write_bundle(sale_pk: str, fileobj: BinaryIO) -> int:
+    """
+    Write the offline bundle of the valid tickets of a sale
+    and return the number of tickets
+    """
+    # Holder names are pivoted in the database like the tickets PDF
+    tickets = get_valid_tickets(sale_pk).annotate(
+        nom=Max('orderlinefields__value', filter=Q(orderlinefields__field__name='Nom')),
+        prenom=Max('orderlinefields__value', filter=Q(orderlinefields__field__name='Prénom')),
+    ).order_by().values_list(
+        'id', 'orderline__item_id', 'nom', 'prenom',
+        'orderline__order__owner__first_name', 'orderline__order__owner__last_name',
+    )
+
+    records, names = [], bytearray()
+    for ticket_id, item_id, nom, prenom, owner_first_name, owner_last_name in tickets.iterator():
+        name = " ".join(filter(None, (
+            nom if nom is not None else owner_first_name,
+            prenom if prenom is not None else owner_last_name,
+        ))).encode()[:0xFFFF]
+        records.append((ticket_id.bytes, item_id, len(names), len(name)))
+        names += name
+
+    # Sorted by bytes for binary searches on devices
+    records.sort()
+    fileobj.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(records), int(time.time())))
+    for record in records:
+        fileobj.write(BUNDLE_RECORD.pack(*record))
+    fileobj.write(names)
+    return len(records)
+
+
+def get_bundle(sale_pk: str) -> bytes:
+    """
+    Get the offline bundle of a sale, cached until its valid tickets change
+    """
+    key = BUNDLE_CACHE_KEY.format(sale_pk=sale_pk, token=get_index_token(sale_pk))
+    bundle = cache.get(key)
+    if bundle is None:
+        buffer = BytesIO()
+        write_bundle(sale_pk, buffer)
+        bundle = buffer.getvalue()
+        cache.set(key, bundle, INDEX_TIMEOUT)
+    return bundle
+
+
+def find_in_bundle(bundle: bytes, ticket_id: uuid.UUID) -> Optional[Dict]:
+    """
+    Binary search a ticket in an offline bundle, as done by the devices
+    """
+    magic, version, count, _ = BUNDLE_HEADER.unpack_from(bundle)
+    if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+        raise ValueError("Invalid check-in bundle")
+
+    names_start = BUNDLE_HEADER.size + count * BUNDLE_RECORD.size
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        record = BUNDLE_RECORD.unpack_from(bundle, BUNDLE_HEADER.size + middle * BUNDLE_RECORD.size)
+        if record[0] == ticket_id.bytes:
+            start = names_start + record[2]
+            return { 'item': record[1], 'name': bundle[start:start + record[3]].decode() }
+        if record[0] < ticket_id.bytes:
+            low = middle + 1
+        else:
+            high = middle
+    return None
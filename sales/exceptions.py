@@ -7,3 +7,15 @@ class OrderValidationException(APIException):
     status_code = status.HTTP_406_NOT_ACCEPTABLE
     default_detail = "La commande n'est pas valide"
     default_code = 'invalid_order'
+
+
+class InvalidTicket(APIException):
+    status_code = status.HTTP_404_NOT_FOUND
+    default_detail = "Ce billet n'est pas valide"
+    default_code = 'invalid_ticket'
+
+
+class TicketAlreadyScanned(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "Ce billet a déjà été scanné"
+    default_code = 'ticket_already_scanned'
@@ -0,0 +1,135 @@
+from typing import BinaryIO, Dict, Iterator, List, Sequence, Tuple
+import codecs
+import csv
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Max, Q
+
+from sales.models import Field, OrderLineItem, OrderStatus
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    # Excel exports are only available when openpyxl is installed
+    Workbook = None
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+BASE_COLUMNS = ('Commande', 'UUID', 'Email', 'Item', 'Quantité')
+# Number of rows fetched at once from the database cursor
+DEFAULT_CHUNK_SIZE = 2000
+
+
+# --------------------------------------------
+#   Rows
+# --------------------------------------------
+
+def get_export_fields(sale_pk: str=None) -> List[Tuple[str, str]]:
+    """
+    Get the ids and names of the fields of the items of a sale
+    """
+    fields = Field.objects.all()
+    if sale_pk is not None:
+        fields = fields.filter(itemfields__item__sale_id=sale_pk)
+    return list(fields.order_by('id').values_list('id', 'name').distinct())
+
+
+def get_field_columns(fields: Sequence[Tuple[str, str]]) -> Dict[str, Max]:
+    """
+    Get the aggregations pivoting the values of each field into a column
+    """
+    return {
+        f"field_{i}": Max('orderlinefields__value', filter=Q(orderlinefields__field_id=field_id))
+        for i, (field_id, _) in enumerate(fields)
+    }
+
+
+def iter_export_rows(sale_pk: str=None, chunk_size: int=DEFAULT_CHUNK_SIZE) -> Iterator[list]:
+    """
+    Yield the header and then one row per ticket of the validated orders,
+    reading the tickets from a server-side cursor to keep memory use constant
+    """
+    fields = get_export_fields(sale_pk)
+    yield [ *BASE_COLUMNS, *(name for _, name in fields) ]
+
+    tickets = OrderLineItem.objects.filter(orderline__order__status__in=OrderStatus.VALIDATED_LIST.value)
+    if sale_pk is not None:
+        tickets = tickets.filter(orderline__order__sale_id=sale_pk)
+
+    # Field values are pivoted into columns by the database, one row per ticket
+    columns = get_field_columns(fields)
+    rows = tickets.annotate(**columns).order_by('orderline__order_id', 'id').values_list(
+        'orderline__order_id', 'id', 'orderline__order__owner__email',
+        'orderline__item__name', 'orderline__quantity', *columns,
+    ).iterator(chunk_size=chunk_size)
+
+    for order_id, uuid, *values in rows:
+        # Remove dashes from the UUID to match the QR codes
+        yield [ order_id, uuid.hex, *values ]
+
+
+# --------------------------------------------
+#   Writers
+# --------------------------------------------
+
+class Echo:
+    """
+    File-like object returning what is written, used to stream CSV lines
+    """
+    def write(self, value: str) -> str:
+        return value
+
+
+def stream_csv(rows: Iterator[Sequence]) -> Iterator[str]:
+    """
+    Yield the rows as CSV lines
+    """
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_csv(rows: Iterator[Sequence], fileobj: BinaryIO) -> int:
+    """
+    Write the rows to a CSV file and return the number of rows written
+    """
+    count = 0
+    stream = codecs.getwriter('utf-8')(fileobj)
+    for line in stream_csv(rows):
+        stream.write(line)
+        count += 1
+    return count
+
+
+def write_xlsx(rows: Iterator[Sequence], fileobj: BinaryIO) -> int:
+    """
+    Write the rows to an Excel file and return the number of rows written,
+    the workbook is write-only to keep memory use constant
+    """
+    if Workbook is None:
+        raise ImproperlyConfigured("openpyxl must be installed to export Excel files")
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(fileobj)
+    return count
+
+
+def export_sale(fileobj: BinaryIO, sale_pk: str=None, format: str='csv',
+                chunk_size: int=DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Export the tickets of a sale, or all sales, and return the number of tickets exported
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{format}'")
+
+    writer = write_xlsx if format == 'xlsx' else write_csv
+    # Header is not a ticket
+    return writer(iter_export_rows(sale_pk, chunk_size), fileobj) - 1
@@ -0,0 +1,119 @@
+from typing import Dict
+from datetime import timedelta
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from sales.models import Order, OrderLine, OrderStatus, book_orderlines
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+# Orders that can be expired from their age only, with their maximum age.
+# AWAITING_PAYMENT orders might have been paid meanwhile,
+# so their status must be fetched from the payment service instead,
+# unless their transaction has never been created.
+EXPIRABLE_STATUS = {
+    OrderStatus.ONGOING: 'MAX_ONGOING_TIME',
+    OrderStatus.AWAITING_VALIDATION: 'MAX_VALIDATION_TIME',
+    OrderStatus.AWAITING_PAYMENT: 'MAX_PAYMENT_TIME',
+}
+
+
+def expire_batch(status: OrderStatus, max_time: timedelta, batch_size: int) -> int:
+    """
+    Expire at most batch_size orders of the status older than max_time,
+    release the quantities they booked and return the number of expired orders
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # Skip orders being updated, they will be expired on the next batch
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        orders = Order.objects.filter(status=status.value, created_at__lt=now - max_time)
+        if status == OrderStatus.AWAITING_PAYMENT:
+            orders = orders.filter(tra_id__isnull=True)
+        ids = list(
+            orders
+            .select_for_update(skip_locked=skip_locked)
+            .order_by('created_at')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return 0
+
+        if status.value in OrderStatus.BOOKING_LIST.value:
+            book_orderlines(OrderLine.objects.filter(order_id__in=ids), -1)
+
+        return Order.objects.filter(pk__in=ids, status=status.value) \
+                            .update(status=OrderStatus.EXPIRED.value, updated_at=now)
+
+
+def expire_orders(batch_size: int) -> Dict[OrderStatus, int]:
+    """
+    Expire all the orders that are too old, batch by batch
+    and return the number of expired orders per status
+    """
+    expired = {}
+    for status, setting in EXPIRABLE_STATUS.items():
+        max_time = getattr(settings, setting)
+        expired[status] = 0
+        while True:
+            start = time.perf_counter()
+            count = expire_batch(status, max_time, batch_size)
+            duration = time.perf_counter() - start
+            if count:
+                logger.info(f"Expired {count} {status.name} orders in {duration * 1000:.1f}ms",
+                            extra={ 'status': status.name, 'count': count, 'duration': duration })
+            expired[status] += count
+            if count < batch_size:
+                break
+    return expired
+
+
+class Command(BaseCommand):
+    """
+    Expire the orders that have been waiting for too long
+
+    Usage:
+        python manage.py expire_orders --help
+    """
+
+    help = "Expire the orders that have been waiting for too long and release the items they booked."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-l', '--loop',
+                            action='store_true',
+                            help="Keep expiring orders until interrupted")
+        parser.add_argument('-i', '--interval',
+                            type=float,
+                            default=60,
+                            help="Seconds to wait between two sweeps in loop mode (default: 60)")
+        parser.add_argument('-b', '--batch-size',
+                            type=int,
+                            default=500,
+                            help="Maximum number of orders expired per transaction (default: 500)")
+
+    def sweep(self, batch_size: int) -> str:
+        start = time.perf_counter()
+        expired = expire_orders(batch_size)
+        duration = time.perf_counter() - start
+        details = ', '.join(f"{count} {status.name}" for status, count in expired.items())
+        return f"Expired {sum(expired.values())} orders ({details}) in {duration:.2f}s"
+
+    def handle(self, loop: bool=False, interval: float=60, batch_size: int=500, **options) -> str:
+        if not loop:
+            return self.sweep(batch_size)
+
+        logger.info(f"Starting to expire orders every {interval}s")
+        sweeps = 0
+        try:
+            while True:
+                self.stdout.write(self.sweep(batch_size))
+                sweeps += 1
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        return f"Stopped after {sweeps} sweeps"
@@ -0,0 +1,40 @@
+from datetime import datetime
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from sales.models import Sale
+from sales.checkin import write_bundle
+
+
+class Command(BaseCommand):
+    """
+    Export the bundle of the valid tickets of a sale for offline scanning
+
+    Usage:
+        python manage.py export_checkin_bundle --help
+    """
+
+    help = "Export the valid tickets of a sale as a binary bundle for offline scanning devices."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-s', '--sale',
+                            required=True,
+                            help="Sale to export the tickets from")
+        parser.add_argument('-o', '--output',
+                            default=None,
+                            help="Path of the bundle (default: in the exports directory)")
+
+    def handle(self, sale: str, output: str=None, **options) -> str:
+        if not Sale.objects.filter(pk=sale).exists():
+            raise CommandError(f"Sale {sale} does not exist")
+
+        if output is None:
+            os.makedirs(settings.EXPORTS_DIR, exist_ok=True)
+            date = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+            output = os.path.join(settings.EXPORTS_DIR, f"checkin_{sale}_{date}.checkin")
+
+        with open(output, 'wb') as fileobj:
+            count = write_bundle(sale, fileobj)
+        return f"Exported {count} tickets to {output}"
@@ -0,0 +1,54 @@
+from datetime import datetime
+import time
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from sales.models import Sale
+from sales.exports import DEFAULT_CHUNK_SIZE, EXPORT_FORMATS, Workbook, export_sale
+
+
+class Command(BaseCommand):
+    """
+    Export the tickets of the validated orders of a sale
+
+    Usage:
+        python manage.py export_sale --help
+    """
+
+    help = "Export the tickets of the validated orders of a sale, or all sales, to a CSV or Excel file."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-s', '--sale',
+                            default=None,
+                            help="Sale to export, all sales by default")
+        parser.add_argument('-f', '--format',
+                            choices=EXPORT_FORMATS,
+                            default='csv',
+                            help="Format of the export (default: csv)")
+        parser.add_argument('-o', '--output',
+                            default=None,
+                            help="Path of the exported file (default: in the exports directory)")
+        parser.add_argument('-c', '--chunk-size',
+                            type=int,
+                            default=DEFAULT_CHUNK_SIZE,
+                            help=f"Number of rows fetched at once from the database (default: {DEFAULT_CHUNK_SIZE})")
+
+    def handle(self, sale: str=None, format: str='csv', output: str=None,
+               chunk_size: int=DEFAULT_CHUNK_SIZE, **options) -> str:
+        if sale is not None and not Sale.objects.filter(pk=sale).exists():
+            raise CommandError(f"Sale {sale} does not exist")
+        if format == 'xlsx' and Workbook is None:
+            raise CommandError("openpyxl must be installed to export Excel files")
+
+        if output is None:
+            os.makedirs(settings.EXPORTS_DIR, exist_ok=True)
+            date = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+            output = os.path.join(settings.EXPORTS_DIR, f"sale_{sale or 'all'}_{date}.{format}")
+
+        start = time.perf_counter()
+        with open(output, 'wb') as fileobj:
+            exported = export_sale(fileobj, sale, format, chunk_size)
+        duration = time.perf_counter() - start
+        return f"Exported {exported} tickets to {output} in {duration:.2f}s"
@@ -0,0 +1,50 @@
+from datetime import datetime
+import time
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from sales.models import Sale
+from sales.tickets import export_sale_tickets
+
+
+class Command(BaseCommand):
+    """
+    Export the tickets of all the validated orders of a sale
+
+    Usage:
+        python manage.py export_tickets --help
+    """
+
+    help = "Export the tickets of all the validated orders of a sale as a ZIP of PDFs."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-s', '--sale',
+                            required=True,
+                            help="Sale to export the tickets from")
+        parser.add_argument('-o', '--output',
+                            default=None,
+                            help="Path of the ZIP archive (default: in the exports directory)")
+        parser.add_argument('-p', '--processes',
+                            type=int,
+                            default=settings.TICKETS_RENDER_PROCESSES,
+                            help="Number of processes rendering the PDFs in parallel "
+                                 f"(default: {settings.TICKETS_RENDER_PROCESSES})")
+
+    def handle(self, sale: str, output: str=None, processes: int=None, **options) -> str:
+        try:
+            sale = Sale.objects.get(pk=sale)
+        except Sale.DoesNotExist:
+            raise CommandError(f"Sale {sale} does not exist")
+
+        if output is None:
+            os.makedirs(settings.EXPORTS_DIR, exist_ok=True)
+            date = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+            output = os.path.join(settings.EXPORTS_DIR, f"tickets_{sale.pk}_{date}.zip")
+
+        start = time.perf_counter()
+        with open(output, 'wb') as fileobj:
+            exported = export_sale_tickets(sale.pk, fileobj, processes)
+        duration = time.perf_counter() - start
+        return f"Exported tickets of {exported} orders to {output} in {duration:.2f}s"
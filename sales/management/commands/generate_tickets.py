@@ -0,0 +1,83 @@
+from typing import List, Sequence
+import multiprocessing
+import logging
+import time
+
+from django.db import connections, models, transaction
+from django.core.management.base import BaseCommand
+
+from sales.models import Order, OrderLine, OrderStatus, generate_tickets
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+
+def get_orders_missing_tickets(sale: str=None) -> List[int]:
+    """
+    Get the ids of the validated orders which have less tickets than bought
+    """
+    orderlines = OrderLine.objects.filter(order__status__in=OrderStatus.VALIDATED_LIST.value)
+    if sale is not None:
+        orderlines = orderlines.filter(order__sale_id=sale)
+    return list(
+        orderlines
+        .annotate(nb_tickets=models.Count('orderlineitems'))
+        .filter(quantity__gt=models.F('nb_tickets'))
+        .order_by('order_id')
+        .values_list('order_id', flat=True)
+        .distinct()
+    )
+
+
+def generate_orders_tickets(order_ids: Sequence[int]) -> int:
+    """
+    Generate the missing tickets of the orders in a single transaction
+    """
+    with transaction.atomic():
+        # Lock the orders to prevent concurrent generations
+        list(Order.objects.select_for_update().filter(pk__in=order_ids).values_list('pk'))
+        return generate_tickets(OrderLine.objects.filter(order_id__in=order_ids))
+
+
+class Command(BaseCommand):
+    """
+    Generate the missing tickets of the validated orders
+
+    Usage:
+        python manage.py generate_tickets --help
+    """
+
+    help = "Generate the missing tickets of the validated orders, can be safely run multiple times."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-s', '--sale',
+                            default=None,
+                            help="Only generate the tickets of this sale")
+        parser.add_argument('-c', '--chunk-size',
+                            type=int,
+                            default=200,
+                            help="Number of orders processed per transaction (default: 200)")
+        parser.add_argument('-p', '--processes',
+                            type=int,
+                            default=1,
+                            help="Number of processes generating tickets in parallel (default: 1)")
+
+    def handle(self, sale: str=None, chunk_size: int=200, processes: int=1, **options) -> str:
+        start = time.perf_counter()
+        order_ids = get_orders_missing_tickets(sale)
+        chunks = [ order_ids[i:i + chunk_size] for i in range(0, len(order_ids), chunk_size) ]
+
+        if processes > 1 and len(chunks) > 1:
+            # Connections must not be shared with the forked processes
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                created = sum(pool.imap_unordered(generate_orders_tickets, chunks))
+        else:
+            created = 0
+            for chunk in chunks:
+                created += generate_orders_tickets(chunk)
+                logger.info(f"Generated tickets of {len(chunk)} orders, {created} tickets so far")
+
+        duration = time.perf_counter() - start
+        throughput = created / duration if duration else 0
+        return f"Generated {created} tickets for {len(order_ids)} orders " \
+               f"in {duration:.2f}s ({throughput:.0f} tickets/s)"
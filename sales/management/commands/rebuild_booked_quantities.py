@@ -0,0 +1,53 @@
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand
+
+from sales.models import Item, ItemGroup, OrderLine, OrderStatus
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the booked quantity counters of items and item groups from the orderlines
+
+    Usage:
+        python manage.py rebuild_booked_quantities --help
+    """
+
+    help = "Rebuild the booked quantity counters of items and item groups from the orderlines."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-s', '--sale',
+                            default=None,
+                            help="Only rebuild the counters of this sale")
+
+    def rebuild(self, queryset: models.QuerySet, lookup: str) -> int:
+        """
+        Rebuild the counters of the queryset and return the number of corrected ones
+        """
+        booked = (
+            OrderLine.objects
+            .filter(**{ lookup: models.OuterRef('pk') },
+                    order__status__in=OrderStatus.BOOKING_LIST.value)
+            .order_by().values(lookup)
+            .annotate(total=models.Sum('quantity'))
+            .values('total')
+        )
+        expected = Coalesce(models.Subquery(booked), 0)
+        drifted = queryset.annotate(expected=expected) \
+                          .exclude(booked_quantity=models.F('expected')) \
+                          .count()
+        queryset.update(booked_quantity=expected)
+        return drifted
+
+    def handle(self, sale: str=None, **options) -> str:
+        items = Item.objects.all()
+        groups = ItemGroup.objects.all()
+        if sale is not None:
+            items = items.filter(sale_id=sale)
+            groups = groups.filter(sale_id=sale)
+
+        with transaction.atomic():
+            n_items = self.rebuild(items, 'item')
+            n_groups = self.rebuild(groups, 'item__group')
+
+        return f"Corrected {n_items} item counters and {n_groups} item group counters"
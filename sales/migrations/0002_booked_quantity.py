@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:45
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+# Copy of OrderStatus.BOOKING_LIST at the time of the migration
+BOOKING_LIST = (1, 2, 3, 4)
+
+
+def init_booked_quantities(apps, schema_editor):
+    """
+    Compute the booked counters from the existing orderlines
+    """
+    Item = apps.get_model('sales', 'Item')
+    ItemGroup = apps.get_model('sales', 'ItemGroup')
+    OrderLine = apps.get_model('sales', 'OrderLine')
+
+    for Model, lookup in ((Item, 'item'), (ItemGroup, 'item__group')):
+        booked = (
+            OrderLine.objects
+            .filter(**{ lookup: models.OuterRef('pk') }, order__status__in=BOOKING_LIST)
+            .order_by().values(lookup)
+            .annotate(total=models.Sum('quantity'))
+            .values('total')
+        )
+        Model.objects.update(booked_quantity=Coalesce(models.Subquery(booked), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='booked_quantity',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='itemgroup',
+            name='booked_quantity',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(init_booked_quantities, migrations.RunPython.noop),
+    ]
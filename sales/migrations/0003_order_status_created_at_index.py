@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0002_booked_quantity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='sales_order_status_5a79ce_idx'),
+        ),
+    ]
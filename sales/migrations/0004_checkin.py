@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sales', '0003_order_status_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckIn',
+            fields=[
+                ('orderlineitem', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='checkin', serialize=False, to='sales.orderlineitem')),
+                ('scanned_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('device', models.CharField(blank=True, max_length=64)),
+                ('scanned_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='checkins', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('scanned_at',),
+            },
+        ),
+    ]
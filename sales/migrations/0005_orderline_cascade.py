@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:02
+
+from django.db import migrations, models
+import sales.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0004_checkin'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderline',
+            name='item',
+            field=models.ForeignKey(editable=False, on_delete=sales.models.cascade_orderlines, related_name='orderlines', to='sales.item'),
+        ),
+        migrations.AlterField(
+            model_name='orderline',
+            name='order',
+            field=models.ForeignKey(editable=False, on_delete=sales.models.cascade_orderlines, related_name='orderlines', to='sales.order'),
+        ),
+    ]
@@ -1,9 +1,10 @@
 import uuid
 from enum import Enum
+from typing import Dict, List, Tuple, Type
 
 from django.conf import settings
 from django.utils import timezone
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.core.mail import EmailMessage
 
 from core.models import APIModel
@@ -106,6 +107,9 @@ class ItemGroup(models.Model):
     quantity     = models.PositiveIntegerField(blank=True, null=True)
     max_per_user = models.PositiveIntegerField(blank=True, null=True)
 
+    # Denormalized quantity of items booked by orders, see book_items
+    booked_quantity = models.IntegerField(default=0, editable=False)
+
     def __str__(self) -> str:
         return self.name
 
@@ -135,27 +139,21 @@ class Item(models.Model):
     nemopay_id   = models.CharField(max_length=30, blank=True, null=True)
     # TODO Abstraire payment
 
+    # Denormalized quantity booked by orders, see book_items
+    booked_quantity = models.IntegerField(default=0, editable=False)
+
     fields = models.ManyToManyField('Field',
                                     through='ItemField',
                                     through_fields=('item', 'field'))
 
+    # Fields synchronized with the payment system
+    PAYMENT_FIELDS = ('name', 'price', 'sale', 'usertype', 'nemopay_id')
+
     def quantity_sold(self) -> int:
         """
-        Count item quantity sold
+        Count item quantity sold from the booked counter
         """
-        filters = {
-            'sale': self.sale_id,
-            'orderlines__item__pk': self.pk,
-            'status__in': OrderStatus.BOOKING_LIST.value,
-        }
-
-        qt_sum = models.Sum('orderlines__quantity',
-                            filter=models.Q(orderlines__item__pk=self.pk))
-        return (
-            Order.objects.filter(**filters)
-            .annotate(orderline_quantity=qt_sum)
-            .aggregate(sum=models.Sum('orderline_quantity'))
-        )['sum'] or 0
+        return self.booked_quantity
 
     def quantity_left(self) -> int:
         """
@@ -181,17 +179,43 @@ class Item(models.Model):
         else:
             return 0
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Keep track of the stored nemopay_id to detect changes
+        """
+        instance = super().from_db(db, field_names, values)
+        instance._stored_nemopay_id = instance.__dict__.get('nemopay_id')
+        return instance
+
+    def refresh_concurrent_fields(self) -> None:
+        """
+        Reload the fields updated in the database outside of this instance,
+        the booked quantity and the nemopay_id set by the sync_items command
+        unless it was changed on this instance
+        """
+        stored = Item.objects.select_for_update() \
+                             .filter(pk=self.pk).values('nemopay_id', 'booked_quantity').first()
+        if stored is None:
+            return
+        self.booked_quantity = stored['booked_quantity']
+        if self.nemopay_id == getattr(self, '_stored_nemopay_id', self.nemopay_id):
+            self.nemopay_id = stored['nemopay_id']
+
     def save(self, *args, **kwargs) -> None:
         """
-        Save item and synch it with the payment system
+        Save item and queue its synchronization with the payment system,
+        see the sync_items command
         """
-        from payment.helpers import get_pay_service
-        pay_service = get_pay_service(self)
-        try:
-            # FIXME Better error management
-            pay_service.sync_item(self)
-        finally:
+        from payment.models import ItemSync
+        update_fields = kwargs.get('update_fields')
+        with transaction.atomic():
+            if self.pk is not None and not self._state.adding:
+                self.refresh_concurrent_fields()
             super().save(*args, **kwargs)
+            if update_fields is None or not set(update_fields).isdisjoint(self.PAYMENT_FIELDS):
+                ItemSync.enqueue(self)
+        self._stored_nemopay_id = self.nemopay_id
 
     def __str__(self) -> str:
         return f"{self.name} ({self.sale})"
@@ -200,6 +224,51 @@ class Item(models.Model):
         ordering = ('id',)
 
 
+def get_booking_updates(quantities: Dict[int, int]) -> List[Tuple[Type[models.Model], int, int]]:
+    """
+    Get the quantities to add to the booked counters of items and their groups,
+    as (model, pk, quantity) in the constant order used to update them
+    """
+    quantities = { pk: qt for pk, qt in quantities.items() if qt }
+    if not quantities:
+        return []
+
+    per_group = {}
+    items_group = Item.objects.filter(pk__in=quantities, group__isnull=False) \
+                              .values_list('pk', 'group_id')
+    for item_pk, group_pk in items_group:
+        per_group[group_pk] = per_group.get(group_pk, 0) + quantities[item_pk]
+
+    return [
+        (Model, pk, per_pk[pk])
+        for Model, per_pk in ((ItemGroup, per_group), (Item, quantities))
+        for pk in sorted(per_pk) if per_pk[pk]
+    ]
+
+
+def book_items(quantities: Dict[int, int]) -> None:
+    """
+    Add quantities to the booked counters of items and their groups,
+    negative quantities release the items.
+    Counters are updated atomically in the database in a constant order.
+
+    Args:
+        quantities: the quantities to add per item pk
+    """
+    for Model, pk, quantity in get_booking_updates(quantities):
+        Model.objects.filter(pk=pk).update(booked_quantity=models.F('booked_quantity') + quantity)
+
+
+def book_orderlines(orderlines: models.QuerySet, sign: int=1) -> None:
+    """
+    Book (sign=1) or release (sign=-1) the quantities of orderlines
+    """
+    per_item = orderlines.order_by().values('item_id') \
+                         .annotate(total=models.Sum('quantity')) \
+                         .values_list('item_id', 'total')
+    book_items({ item_pk: sign * total for item_pk, total in per_item })
+
+
 # --------------------------------------------
 #   Orders
 # --------------------------------------------
@@ -270,6 +339,62 @@ class Order(models.Model):
     # TODO Abstraire payment
     tra_id = models.IntegerField(blank=True, null=True, default=None)
 
+    # ----- Booked quantities
+
+    @staticmethod
+    def is_booking_status(status: int) -> bool:
+        return status in OrderStatus.BOOKING_LIST.value
+
+    @classmethod
+    def from_db(cls, db, field_names, values) -> 'Order':
+        """
+        Keep track of the stored status to update booked quantities
+        """
+        instance = super().from_db(db, field_names, values)
+        instance._stored_status = instance.__dict__.get('status')
+        return instance
+
+    def save(self, *args, **kwargs) -> None:
+        """
+        Save the order and book or release its items
+        when it enters or leaves the booking statuses
+        """
+        adding = self._state.adding
+        with transaction.atomic():
+            stored_status = getattr(self, '_stored_status', None)
+            if not adding and connection.features.has_select_for_update:
+                # Read the stored status under lock in case of concurrent updates
+                stored_status = Order.objects.select_for_update() \
+                                     .filter(pk=self.pk) \
+                                     .values_list('status', flat=True).first()
+
+            super().save(*args, **kwargs)
+
+            if not adding:
+                self._book_status_change(stored_status)
+                self._validity_change(stored_status)
+
+        self._stored_status = self.status
+
+    def _book_status_change(self, stored_status: int) -> None:
+        """
+        Book or release the items if the order entered or left the booking statuses
+        """
+        sign = int(self.is_booking_status(self.status)) \
+            - int(stored_status is not None and self.is_booking_status(stored_status))
+        if sign:
+            book_orderlines(self.orderlines.all(), sign)
+
+    def _validity_change(self, stored_status: int) -> None:
+        """
+        Clear the check-in index of the sale if the tickets became valid or invalid
+        """
+        was_valid = stored_status in OrderStatus.VALIDATED_LIST.value
+        if was_valid != (self.status in OrderStatus.VALIDATED_LIST.value):
+            from sales.checkin import clear_checkin_index
+            sale_pk = self.sale_id
+            transaction.on_commit(lambda: clear_checkin_index(sale_pk))
+
     # ----- Additional methods
 
     def is_expired(self) -> bool:
@@ -296,8 +421,8 @@ class Order(models.Model):
         if self.status in OrderStatus.STABLE_LIST.value:
             return OrderStatus(self.status)
 
-        # Check payment status if waiting
-        if self.status == OrderStatus.AWAITING_PAYMENT.value:
+        # Check payment status if waiting, the transaction might not be created yet
+        if self.status == OrderStatus.AWAITING_PAYMENT.value and self.tra_id is not None:
             from payment.helpers import get_pay_service
             return get_pay_service(self).get_transaction_status(self)
 
@@ -309,31 +434,42 @@ class Order(models.Model):
     def update_status(self, status: OrderStatus=None) -> dict:
         """
         Update the order status, make side changes if needed,
-        and return an update response
+        and return an update response.
+        Concurrent updates of the order are only applied once.
         """
         if status is None:
             status = self.fetch_status()
 
+        old_status = self.status
         resp = {
             'old_status': self.get_status_display(),
             # Do not update if same or stable status
             'updated': self.status != status.value and self.status not in OrderStatus.STABLE_LIST.value,
             # Redirect to payment if needed
             'redirect_to_payment': status and status.value == OrderStatus.AWAITING_PAYMENT.value,
-            # If sale freshly validated, generate tickets
-            'tickets_generated': (status
-                                  and self.status not in OrderStatus.VALIDATED_LIST.value
-                                  and status.value in OrderStatus.VALIDATED_LIST.value),
         }
 
-        # Update order status
-        if resp['updated']:
-            self.status = status.value
-            self.save()
+        with transaction.atomic():
+            # Update order status only if it has not been updated meanwhile
+            if resp['updated']:
+                resp['updated'] = bool(
+                    Order.objects.filter(pk=self.pk, status=old_status)
+                                 .update(status=status.value, updated_at=timezone.now())
+                )
+                if resp['updated']:
+                    self.status = status.value
+                    self._book_status_change(old_status)
+                    self._validity_change(old_status)
+                else:
+                    self.refresh_from_db(fields=('status', 'updated_at'))
+                self._stored_status = self.status
 
-        # Generate tickets if needed
-        if resp['tickets_generated']:
-            self.generate_orderlineitems_and_fields()
+            # If sale freshly validated, generate tickets
+            resp['tickets_generated'] = (resp['updated']
+                                         and old_status not in OrderStatus.VALIDATED_LIST.value
+                                         and status.value in OrderStatus.VALIDATED_LIST.value)
+            if resp['tickets_generated']:
+                self.generate_orderlineitems_and_fields()
 
         resp['status']  = self.get_status_display()
         resp['message'] = OrderStatus.MESSAGES.value[self.status]
@@ -344,37 +480,10 @@ class Order(models.Model):
         """
         When an order has just been validated, create
         all the orderlineitems and fields required
-        TODO : add a lock or something, and improve from scripts
-        """
-        from .serializers import OrderLineItemSerializer, OrderLineFieldSerializer
-        orderlines = self.orderlines.filter(quantity__gt=0) \
-                         .prefetch_related('item', 'orderlineitems')
-
-        total = 0
-        for orderline in orderlines.all():
-            qte = orderline.quantity - len(orderline.orderlineitems.all())
-            while qte > 0:
-                # Create OrderLineItem
-                orderlineitem = OrderLineItemSerializer(data={
-                    'orderline': orderline.id
-                })
-                orderlineitem.is_valid(raise_exception=True)
-                orderlineitem.save()
-
-                # Create OrderLineFields
-                for field in orderline.item.fields.all():
-                    orderlinefield = OrderLineFieldSerializer(data = {
-                        'orderlineitem': orderlineitem.data['id'],
-                        'field': field.id,
-                        'value': get_field_default_value(field.default, self),
-                    })
-                    orderlinefield.is_valid(raise_exception=True)
-                    orderlinefield.save()
-
-                total += 1
-                qte -= 1
-
-        return total
+        """
+        # Lock the order so that concurrent updates do not generate tickets twice
+        list(Order.objects.select_for_update().filter(pk=self.pk).values_list('pk'))
+        return generate_tickets(self.orderlines.all())
 
     def send_confirmation_mail(self):
         """
@@ -408,16 +517,85 @@ class Order(models.Model):
 
     class Meta:
         ordering = ('-id',)
+        indexes = [
+            # Used to find orders to expire
+            models.Index(fields=('status', 'created_at')),
+        ]
+
+
+def cascade_orderlines(collector, field, sub_objs, using) -> None:
+    """
+    Cascade the deletion of orderlines like models.CASCADE and release their
+    booked quantities in aggregate, with the other updates of the deletion
+    """
+    collected = collector.data.get(OrderLine, ())
+    orderlines = [ orderline for orderline in sub_objs.select_related('order')
+                   if orderline not in collected ]
+    if not orderlines:
+        return
+    models.CASCADE(collector, field, orderlines, using)
+
+    quantities = {}
+    for orderline in orderlines:
+        # Already released, see release_orderline in sales.signals
+        orderline._released = True
+        if Order.is_booking_status(orderline.order.status):
+            quantities[orderline.item_id] = quantities.get(orderline.item_id, 0) - orderline.quantity
+    for Model, pk, quantity in get_booking_updates(quantities):
+        collector.add_field_update(Model._meta.get_field('booked_quantity'),
+                                   models.F('booked_quantity') + quantity, [ Model(pk=pk) ])
 
 
 class OrderLine(models.Model):
     """
     Links an Order to an Item with a quantity
     """
-    item     = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='orderlines', editable=False)
-    order    = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='orderlines', editable=False)
+    item     = models.ForeignKey(Item, on_delete=cascade_orderlines, related_name='orderlines', editable=False)
+    order    = models.ForeignKey(Order, on_delete=cascade_orderlines, related_name='orderlines', editable=False)
     quantity = models.PositiveSmallIntegerField()
 
+    @classmethod
+    def from_db(cls, db, field_names, values) -> 'OrderLine':
+        """
+        Keep track of the stored item and quantity to update booked quantities
+        """
+        instance = super().from_db(db, field_names, values)
+        instance._stored_item_id = instance.__dict__.get('item_id')
+        instance._stored_quantity = instance.__dict__.get('quantity')
+        return instance
+
+    def booked_changes(self) -> Dict[int, int]:
+        """
+        Get the quantities to book per item since the orderline was loaded
+        """
+        stored_item_id = getattr(self, '_stored_item_id', None) or self.item_id
+        changes = { stored_item_id: -(getattr(self, '_stored_quantity', None) or 0) }
+        changes[self.item_id] = changes.get(self.item_id, 0) + self.quantity
+        return { pk: qt for pk, qt in changes.items() if qt }
+
+    def save(self, *args, **kwargs) -> None:
+        """
+        Save the orderline and update the booked quantities if needed
+        """
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            changes = self.booked_changes()
+            if changes and Order.is_booking_status(self.order.status):
+                book_items(changes)
+        self._stored_item_id = self.item_id
+        self._stored_quantity = self.quantity
+
+    def release(self) -> None:
+        """
+        Release the stored booked quantity of the orderline if needed,
+        called before its deletion unless it was cascaded, see cascade_orderlines
+        """
+        if getattr(self, '_released', False):
+            return
+        quantity = getattr(self, '_stored_quantity', None) or 0
+        if quantity and Order.is_booking_status(self.order.status):
+            book_items({ getattr(self, '_stored_item_id', None) or self.item_id: -quantity })
+
     def __str__(self) -> str:
         return f"{self.id} - {self.quantity} x {self.item.name} (Order {self.order})"
 
@@ -508,3 +686,79 @@ class OrderLineField(models.Model):
 
     class Meta:
         ordering = ('id',)
+
+
+# --------------------------------------------
+#   Check-ins
+# --------------------------------------------
+
+class CheckIn(models.Model):
+    """
+    Records the first scan of a ticket, a ticket can only be checked in once
+    """
+    orderlineitem = models.OneToOneField(OrderLineItem,
+                                         on_delete=models.CASCADE,
+                                         primary_key=True,
+                                         related_name='checkin')
+    scanned_at = models.DateTimeField(default=timezone.now)
+    scanned_by = models.ForeignKey(User,
+                                   on_delete=models.SET_NULL,
+                                   null=True,
+                                   blank=True,
+                                   related_name='checkins')
+    device = models.CharField(max_length=64, blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.orderlineitem_id} scanned at {self.scanned_at}"
+
+    class Meta:
+        ordering = ('scanned_at',)
+
+
+# --------------------------------------------
+#   Tickets
+# --------------------------------------------
+
+def generate_tickets(orderlines: models.QuerySet) -> int:
+    """
+    Create in bulk the missing OrderLineItems of the orderlines and their OrderLineFields
+    with default values, and return the number of created OrderLineItems.
+    Orders must be locked to prevent concurrent generations.
+    """
+    orderlines = list(
+        orderlines
+        .annotate(nb_tickets=models.Count('orderlineitems'))
+        .filter(quantity__gt=models.F('nb_tickets'))
+        .select_related('order__owner')
+        .order_by('pk')
+    )
+    if not orderlines:
+        return 0
+
+    fields_per_item = {}
+    itemfields = ItemField.objects.select_related('field') \
+                                  .filter(item_id__in={ orderline.item_id for orderline in orderlines }) \
+                                  .order_by('pk')
+    for itemfield in itemfields:
+        fields_per_item.setdefault(itemfield.item_id, []).append(itemfield.field)
+
+    orderlineitems, orderlinefields = [], []
+    for orderline in orderlines:
+        fields = fields_per_item.get(orderline.item_id, [])
+        values = [ get_field_default_value(field.default, orderline.order) for field in fields ]
+        for _ in range(orderline.quantity - orderline.nb_tickets):
+            orderlineitem = OrderLineItem(orderline=orderline)
+            orderlineitems.append(orderlineitem)
+            orderlinefields.extend(
+                OrderLineField(orderlineitem=orderlineitem, field=field, value=value)
+                for field, value in zip(fields, values)
+            )
+
+    OrderLineItem.objects.bulk_create(orderlineitems)
+    OrderLineField.objects.bulk_create(orderlinefields)
+
+    # New tickets must be known by the check-in index once committed
+    from sales.checkin import clear_checkin_index
+    for sale_pk in { orderline.order.sale_id for orderline in orderlines }:
+        transaction.on_commit(lambda sale_pk=sale_pk: clear_checkin_index(sale_pk))
+    return len(orderlineitems)
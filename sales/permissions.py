@@ -5,7 +5,7 @@ from rest_framework.exceptions import MethodNotAllowed
 
 from core.permissions import ReadOnly, OBJECT_ACTIONS
 from core.exceptions import InvalidRequest
-from authentication.oauth import OAuthAPI
+from authentication.memberships import get_managed_asso_ids
 from .models import (
     Association, Sale, Item, ItemGroup, ItemField,
     Order, OrderLine, OrderLineItem, OrderLineField
@@ -29,73 +29,64 @@ def get_url_param(request, view, name: str, default: Any=None) -> Any:
     return default
 
 
-def get_related_model(Model, pk, *related) -> Any:
+# Path from each model to the id of its association
+ASSOCIATION_PATHS = {
+    Sale: 'association_id',
+    ItemGroup: 'sale__association_id',
+    Item: 'sale__association_id',
+    Order: 'sale__association_id',
+    ItemField: 'item__sale__association_id',
+    OrderLine: 'order__sale__association_id',
+    OrderLineItem: 'orderline__order__sale__association_id',
+    OrderLineField: 'orderlineitem__orderline__order__sale__association_id',
+}
+
+
+def get_association_id(Model, pk) -> str:
+    """
+    Get the id of the association related to an instance in a single query
+    """
     if pk is None:
         raise InvalidRequest(f"No related model", code='no_related_model')
 
-    try:
-        query = Model.objects
-        if related:
-            query = query.select_related(*related)
-        return query.get(pk=pk)
-    except Model.DoesNotExist:
+    path = 'pk' if Model is Association else ASSOCIATION_PATHS[Model]
+    asso_ids = Model.objects.filter(pk=pk).order_by().values_list(path, flat=True)[:1]
+
+    if not asso_ids:
         raise InvalidRequest(f"Could not retrieve related {Model.__name__}",
                              code='not_found_related_model')
+    return asso_ids[0]
 
 
 def get_related_asso_id(request, view) -> str:
-
+    """
+    Get the id of the existing association related to the target resource
+    """
     if view.action is None:
         raise MethodNotAllowed(request.method)
 
     Model = view.queryset.model
-    hasPk = 'pk' in view.kwargs
     pk = view.kwargs.get('pk')
 
-    if Model is Association:
-        return pk
+    if 'pk' in view.kwargs:
+        return get_association_id(Model, pk)
+
+    elif Model is Association:
+        return None
 
     elif Model is Sale:
-        if hasPk:
-            return get_related_model(Sale, pk).association_id
-        else:
-            return get_url_param(request, view, 'association')
+        return get_association_id(Association, get_url_param(request, view, 'association'))
 
-    # One step from sale
-    elif Model in { Item, ItemGroup, Order }:
-        if hasPk:
-            return get_related_model(Model, pk, 'sale').sale.association_id
-        else:
-            sale_pk = get_url_param(request, view, 'sale')
-            return get_related_model(Sale, sale_pk).association_id
-
-    # Multiple steps to sale
-    elif Model in { ItemField, OrderLine, OrderLineItem, OrderLineField }:
-        if hasPk:
-            # Get path from Model to Sale
-            path_to_sale = {
-                ItemField: ('item', 'sale'),
-                OrderLine: ('order', 'sale'),
-                OrderLineItem: ('orderline', 'order', 'sale'),
-                OrderLineField: ('orderlineitem', 'orderline', 'order', 'sale'),
-            }[Model]
-
-            # Get instance with path selected and walk to association_id
-            instance = get_related_model(Model, pk, '__'.join(path_to_sale))
-            for step in path_to_sale:
-                instance = getattr(instance, step)
-            return instance.association_id
-        else:
-            sale_pk = get_url_param(request, view, 'sale')
-            if sale_pk:
-                return get_related_model(Sale, sale_pk).association_id
+    # Resources created from a parent resource
+    elif Model in ASSOCIATION_PATHS:
+        sale_pk = get_url_param(request, view, 'sale')
+        if sale_pk or Model in { Item, ItemGroup, Order }:
+            return get_association_id(Sale, sale_pk)
 
-            if Model is ItemField:
-                item_pk = get_url_param(request, view, 'item')
-                return get_related_model(Item, item_pk, 'sale').sale.association_id
-            else:
-                order_pk = get_url_param(request, view, 'order')
-                return get_related_model(Order, order_pk, 'sale').sale.association_id
+        if Model is ItemField:
+            return get_association_id(Item, get_url_param(request, view, 'item'))
+        else:
+            return get_association_id(Order, get_url_param(request, view, 'order'))
 
     raise NotImplementedError(f"Model {Model.__name__} is not managed")
 
@@ -124,15 +115,8 @@ def check_is_manager(request, view) -> bool:
     if asso_id is None:
         return False
 
-    # Check that the association is real
-    if not Association.objects.filter(pk=asso_id).exists():
-        raise InvalidRequest(f"Could not retrieve association '{asso_id}'",
-                             code='not_found_related_model')
-
-    # Get user's associations and check if is manager
-    oauth_client = OAuthAPI(session=request.session)
-    user = request.user.get_with_api_data_and_assos(oauth_client)
-    request.is_manager = user.is_manager_of(asso_id)
+    # Check if the user manages the association
+    request.is_manager = str(asso_id) in get_managed_asso_ids(request.user, request.session)
     return request.is_manager
 
 
@@ -248,3 +232,26 @@ class IsOwnerOrManagerReadOnly(permissions.BasePermission):
 
         # Need to be owner to modify
         return check_order_ownership(request, view, obj)
+
+
+class IsSaleManager(permissions.BasePermission):
+    """
+    Check that the user is manager of the Association of the sale in the url
+
+    Used for function views, which do not have viewset actions
+    """
+    message = "You need to be the manager of this resource"
+
+    def has_permission(self, request, view) -> bool:
+        # Need to be authenticated
+        if not request.user.is_authenticated:
+            return False
+
+        # Allow admin
+        if request.user.is_admin:
+            request.is_manager = True
+            return True
+
+        asso_id = get_association_id(Sale, view.kwargs.get('pk'))
+        request.is_manager = str(asso_id) in get_managed_asso_ids(request.user, request.session)
+        return request.is_manager
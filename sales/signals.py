@@ -0,0 +1,59 @@
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from core.cache import bump_cache_version
+from sales.models import Sale, ItemGroup, Item, Field, ItemField, OrderLine, OrderLineItem, OrderLineField
+from sales.checkin import clear_checkin_index
+from sales.tickets import clear_tickets_cache
+
+# Cached responses of the sales, items and item groups
+CATALOG_CACHE_NAMESPACE = 'catalog'
+
+
+@receiver(pre_delete, sender=OrderLine)
+def release_orderline(sender, instance: OrderLine, **kwargs) -> None:
+    """
+    Release the booked quantity of an orderline deleted directly,
+    cascade deletions release them in aggregate, see cascade_orderlines
+    """
+    instance.release()
+
+
+@receiver((post_save, post_delete), sender=Sale)
+@receiver((post_save, post_delete), sender=ItemGroup)
+@receiver((post_save, post_delete), sender=Item)
+@receiver((post_save, post_delete), sender=Field)
+@receiver((post_save, post_delete), sender=ItemField)
+def clear_catalog_cache(sender, **kwargs) -> None:
+    """
+    Clear the cached catalog responses once the changes are committed
+    """
+    transaction.on_commit(lambda: bump_cache_version(CATALOG_CACHE_NAMESPACE))
+
+
+@receiver((post_save, post_delete), sender=OrderLineField)
+def clear_order_tickets(sender, instance: OrderLineField, **kwargs) -> None:
+    """
+    Clear the rendered tickets of the order when a field value changes
+    """
+    order_pk = OrderLineItem.objects.filter(pk=instance.orderlineitem_id) \
+                                    .values_list('orderline__order_id', flat=True) \
+                                    .first()
+    # The whole ticket might have been deleted
+    if order_pk is not None:
+        clear_tickets_cache(order_pk)
+
+
+@receiver((post_save, post_delete), sender=OrderLineItem)
+def clear_sale_checkin_index(sender, instance: OrderLineItem, created: bool=True, **kwargs) -> None:
+    """
+    Clear the check-in index of the sale when a ticket is created or deleted
+    """
+    if not created:
+        return
+    sale_pk = OrderLine.objects.filter(pk=instance.orderline_id) \
+                               .values_list('order__sale_id', flat=True) \
+                               .first()
+    if sale_pk is not None:
+        transaction.on_commit(lambda: clear_checkin_index(sale_pk))
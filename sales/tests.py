@@ -1,12 +1,54 @@
-from django.test import tag
+from io import BytesIO, StringIO
+from collections import Counter
+from datetime import timedelta
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from types import SimpleNamespace
+import zipfile
+import logging
+import time
+import uuid
+import csv
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.test import tag, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.core.management import call_command
+from django.contrib import admin
 from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase, APITransactionTestCase
 
-from core.testcases import APIModelViewSetTestCase, ModelViewSetTestCase, get_permissions_from_compact
+from core.faker import FakeModelFactory
+from core.utils import PdfReader
+from core.prefetch import plan_queryset
+from core.metrics import registry
+from core.testcases import (
+    APIModelViewSetTestCase, ModelViewSetTestCase, QueryBudgetTestMixin,
+    get_permissions_from_compact,
+)
+from authentication.memberships import clear_managed_asso_ids, set_managed_asso_ids
 from authentication.models import User
+from authentication.tests import StubPortalTestMixin
 from sales.models import (
     Association, Sale, ItemGroup, Item, OrderStatus, Order, OrderLine,
-    Field, ItemField, OrderLineItem, OrderLineField
+    Field, ItemField, OrderLineItem, OrderLineField, CheckIn, generate_tickets
+)
+from sales.admin import SaleAdmin
+from sales.checkin import (
+    BUNDLE_HEADER, check_in, find_in_bundle, get_checkin_index, upload_checkins,
 )
+from sales.exceptions import TicketAlreadyScanned
+from sales.exports import export_sale, iter_export_rows
+from sales.permissions import check_is_manager
+from sales.serializers import SaleSerializer
+from payment.tests import start_and_await_jobs
+from sales.tickets import close_render_pool, export_sale_tickets, get_render_pool
+
+logger = logging.getLogger(f"woolly.{__name__}")
 
 
 # Used for Association, Sale, ItemGroup, Item, ItemField
@@ -28,6 +70,21 @@ OrderOwnerOrAdmin = get_permissions_from_compact({
 })
 
 
+def create_ordered_sale(factory: FakeModelFactory, field: Field) -> Sale:
+    """
+    Create a public sale with a group of two items with a field, each in a paid order
+    """
+    sale = factory.create(Sale, is_active=True, is_public=True)
+    group = factory.create(ItemGroup, sale=sale)
+    for _ in range(2):
+        item = factory.create(Item, sale=sale, group=group, is_active=True)
+        factory.create(ItemField, item=item, field=field)
+        order = factory.create(Order, sale=sale, status=OrderStatus.AWAITING_PAYMENT.value)
+        factory.create(OrderLine, order=order, item=item, quantity=2)
+        order.update_status(OrderStatus.PAID)
+    return sale
+
+
 # --------------------------------------------
 #   Associations
 # --------------------------------------------
@@ -37,6 +94,94 @@ class AssociationViewSetTestCase(APIModelViewSetTestCase):
     model = Association
     permissions = ManagerOrReadOnly
 
+
+@tag('association', 'cache')
+class AssociationCacheTestCase(StubPortalTestMixin, APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server.paths = []
+        self.server.resources['assos'] = {
+            str(pk): { 'id': str(pk), 'shortname': f"Asso {i}" }
+            for i, pk in enumerate(uuid.uuid4() for _ in range(3))
+        }
+
+    def test_only_missing_are_fetched(self):
+        oauth_client = self.get_oauth_client()
+        assos = Association.objects.get_with_api_data(oauth_client)
+        self.assertEqual(len(assos), 3)
+        self.assertEqual(Association.objects.count(), 3)
+        self.assertEqual(self.server.paths, [ 'assos' ])
+
+        # Only the expired association is fetched
+        missing = assos[0]
+        cache.delete(Association._gen_key({ 'pk': missing.pk }))
+        pks = [ str(asso.pk) for asso in assos ]
+        self.assertEqual(len(Association.objects.filter(pk__in=pks).get_with_api_data(oauth_client)), 3)
+        self.assertEqual(self.server.paths, [ 'assos', f"assos/{missing.pk}" ])
+
+        # Listings, filtered querysets and pks are served from the cache
+        self.assertEqual(len(Association.objects.get_with_api_data(oauth_client)), 3)
+        self.assertEqual(len(Association.objects.filter(pk__in=pks[:2]).get_with_api_data(oauth_client)), 2)
+        self.assertEqual(str(Association.objects.get_with_api_data(oauth_client, pk=assos[1].pk).pk), str(assos[1].pk))
+        self.assertEqual(len(self.server.paths), 2)
+
+        # Expected instances missing from the cache are fetched by pk
+        cache.clear()
+        self.server.paths = []
+        self.assertEqual(len(Association.objects.filter(pk__in=pks[:2]).get_with_api_data(oauth_client)), 2)
+        self.assertEqual(len(Association.objects.get_with_api_data(oauth_client, pk=pks[2:], try_cache=False)), 1)
+        self.assertEqual(self.server.paths, [ f"assos/[{','.join(pks[:2])}]", f"assos/{pks[2]}" ])
+
+
+@tag('association', 'permissions')
+class ManagerPermissionTestCase(APITestCase):
+    """
+    Test that manager checks use the cached memberships and a single query
+    """
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        self.manager = self.factory.create(User)
+        self.sale = self.factory.create(Sale)
+        set_managed_asso_ids(self.manager.pk, [ self.sale.association_id ])
+        item = self.factory.create(Item, sale=self.sale)
+        order = self.factory.create(Order, sale=self.sale, status=OrderStatus.AWAITING_PAYMENT.value)
+        orderline = self.factory.create(OrderLine, order=order, item=item, quantity=1)
+        orderlineitem = self.factory.create(OrderLineItem, orderline=orderline)
+        self.instances = (
+            self.sale.association, self.sale, item, self.factory.create(ItemGroup, sale=self.sale),
+            order, orderline, orderlineitem,
+            self.factory.create(ItemField, item=item),
+            self.factory.create(OrderLineField, orderlineitem=orderlineitem),
+        )
+
+    def check_is_manager(self, user: User, instance) -> bool:
+        request = Request(APIRequestFactory().get('/'))
+        request.user = user
+        request._request.session = {}
+        view = SimpleNamespace(action='update', queryset=type(instance).objects.all(), kwargs={ 'pk': instance.pk })
+        return check_is_manager(request, view)
+
+    def test_single_query(self):
+        other = self.factory.create(User)
+        for instance in self.instances:
+            with self.subTest(model=type(instance).__name__):
+                manager = User.objects.get(pk=self.manager.pk)
+                with self.assertNumQueries(1):
+                    self.assertTrue(self.check_is_manager(manager, instance))
+                self.assertFalse(self.check_is_manager(other, instance))
+
+    def test_invalidation(self):
+        self.client.force_authenticate(user=self.manager)
+        url = f"/sales/{self.sale.pk}"
+        self.assertEqual(self.client.patch(url, { 'name': "Managed" }).status_code, status.HTTP_200_OK)
+
+        clear_managed_asso_ids(self.manager.pk)
+        set_managed_asso_ids(self.manager.pk, ())
+        self.assertEqual(self.client.patch(url, { 'name': "Managed" }).status_code, status.HTTP_403_FORBIDDEN)
+
+
 # TODO check visibilities
 @tag('sale')
 class SaleViewSetTestCase(ModelViewSetTestCase):
@@ -60,6 +205,124 @@ class ItemViewSetTestCase(ModelViewSetTestCase):
     permissions = ManagerOrReadOnly
 
 
+@tag('item', 'quantities')
+class BookedQuantitiesTestCase(APITestCase):
+    """
+    Test that the booked counters follow the orders statuses
+    """
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        self.sale = self.factory.create(Sale)
+        self.group = self.factory.create(ItemGroup, sale=self.sale)
+        self.item = self.factory.create(Item, sale=self.sale, group=self.group)
+        self.order = self.factory.create(Order, sale=self.sale, status=OrderStatus.ONGOING.value)
+        self.orderline = self.factory.create(OrderLine, order=self.order, item=self.item, quantity=3)
+
+    def assertBooked(self, quantity: int):
+        self.item.refresh_from_db()
+        self.group.refresh_from_db()
+        self.assertEqual(self.item.booked_quantity, quantity)
+        self.assertEqual(self.group.booked_quantity, quantity)
+        self.assertEqual(self.item.quantity_sold(), quantity)
+
+    def test_booked_quantities_follow_status(self):
+        self.assertBooked(0)
+
+        self.order.status = OrderStatus.AWAITING_PAYMENT.value
+        self.order.save()
+        self.assertBooked(3)
+
+        self.order.status = OrderStatus.PAID.value
+        self.order.save()
+        self.assertBooked(3)
+
+        self.orderline.quantity = 5
+        self.orderline.save()
+        self.assertBooked(5)
+
+        self.order.status = OrderStatus.CANCELLED.value
+        self.order.save()
+        self.assertBooked(0)
+
+    def test_booked_quantities_follow_deletions(self):
+        self.order.status = OrderStatus.AWAITING_PAYMENT.value
+        self.order.save()
+        other_item = self.factory.create(Item, sale=self.sale, group=None)
+        self.factory.create(OrderLine, order=self.order, item=other_item, quantity=2)
+        self.assertBooked(3)
+
+        # Moving a line books the new item and releases the old one
+        self.orderline.item = other_item
+        self.orderline.save()
+        self.assertBooked(0)
+        other_item.refresh_from_db()
+        self.assertEqual(other_item.booked_quantity, 5)
+
+        # Cascade deletions do not call OrderLine.delete
+        other_order = self.factory.create(Order, sale=self.sale, status=OrderStatus.PAID.value)
+        self.factory.create(OrderLine, order=other_order, item=self.item, quantity=4)
+        self.assertBooked(4)
+        other_item.delete()
+        self.assertBooked(4)
+        User.objects.filter(pk=other_order.owner_id).delete()
+        self.assertBooked(0)
+
+    def test_cascade_releases_in_aggregate(self):
+        other_item = self.factory.create(Item, sale=self.sale, group=self.group)
+
+        def delete_order(n_lines: int) -> int:
+            order = self.factory.create(Order, sale=self.sale, status=OrderStatus.ONGOING.value)
+            for i in range(n_lines):
+                self.factory.create(OrderLine, order=order, item=(self.item, other_item)[i % 2], quantity=1)
+            order.status = OrderStatus.AWAITING_PAYMENT.value
+            order.save()
+            with CaptureQueriesContext(connection) as queries:
+                order.delete()
+            self.assertBooked(0)
+            return len(queries)
+
+        # The number of queries does not depend on the number of orderlines
+        self.assertEqual(delete_order(2), delete_order(10))
+
+    def test_rebuild_booked_quantities(self):
+        self.order.status = OrderStatus.VALIDATED.value
+        self.order.save()
+        Item.objects.filter(pk=self.item.pk).update(booked_quantity=42)
+        ItemGroup.objects.filter(pk=self.group.pk).update(booked_quantity=0)
+
+        call_command('rebuild_booked_quantities', sale=self.sale.pk, stdout=StringIO())
+        self.assertBooked(3)
+
+    def test_expire_orders(self):
+        self.order.status = OrderStatus.AWAITING_VALIDATION.value
+        self.order.save()
+        fresh_order = self.factory.create(Order, sale=self.sale, status=OrderStatus.ONGOING.value)
+        ongoing_orders = [
+            self.factory.create(Order, sale=self.sale, status=OrderStatus.ONGOING.value)
+            for _ in range(3)
+        ]
+        # Only orders whose transaction has not been created are expired from their age
+        unpaid_order, paying_order = (
+            self.factory.create(Order, sale=self.sale, status=OrderStatus.AWAITING_PAYMENT.value, tra_id=tra_id)
+            for tra_id in (None, 1)
+        )
+        self.assertBooked(3)
+
+        created_at = timezone.now() - settings.MAX_VALIDATION_TIME - timedelta(minutes=1)
+        Order.objects.exclude(pk=fresh_order.pk).update(created_at=created_at)
+        call_command('expire_orders', batch_size=2, stdout=StringIO())
+
+        expired = Order.objects.filter(status=OrderStatus.EXPIRED.value)
+        self.assertSetEqual(set(expired.values_list('pk', flat=True)),
+                            { self.order.pk, unpaid_order.pk, *(order.pk for order in ongoing_orders) })
+        fresh_order.refresh_from_db()
+        self.assertEqual(fresh_order.status, OrderStatus.ONGOING.value)
+        paying_order.refresh_from_db()
+        self.assertEqual(paying_order.status, OrderStatus.AWAITING_PAYMENT.value)
+        self.assertBooked(0)
+
+
 # --------------------------------------------
 #   Orders
 # --------------------------------------------
@@ -92,6 +355,28 @@ class OrderViewSetTestCase(ModelViewSetTestCase):
             return status.HTTP_200_OK if user == 'user' else status.HTTP_201_CREATED
         return super().get_expected_status_code(method, allowed, user)
 
+    def test_cursor_pagination(self):
+        for _ in range(4):
+            self.create_object(self.users['user'])
+        expected = list(Order.objects.order_by('-id').values_list('id', flat=True))
+        self.client.force_authenticate(user=self.users['admin'])
+
+        ids, url = [], "/orders?all&pagination=cursor&page_size=2"
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                resp = self.client.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK, resp.data)
+            self.assertNotIn('count', resp.data)
+            self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+            ids.extend(order['id'] for order in resp.data['results'])
+            url = resp.data['next']
+        self.assertEqual(ids, expected)
+
+        resp = self.client.get("/orders?all&pagination=cursor&order_by=id")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get("/sales?pagination=cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_order_update(self):
         """
         Test the response generated by an order update
@@ -174,6 +459,528 @@ class OrderLineItemViewSetTestCase(ModelViewSetTestCase):
         return super().get_object_attributes(orderline=self.orderline, **kwargs)
 
 
+@tag('sale', 'item', 'cache')
+class CatalogCacheTestCase(APITransactionTestCase):
+    """
+    Test the cache of the public sale and item responses, committed to be cleared
+    """
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        cache.clear()
+        self.sale = self.factory.create(Sale, is_active=True, is_public=True)
+        self.item = self.factory.create(Item, sale=self.sale, group=None, is_active=True)
+
+    def get(self, url: str, expected_status: int=status.HTTP_200_OK, **headers):
+        resp = self.client.get(url, **headers)
+        self.assertEqual(resp.status_code, expected_status)
+        return resp
+
+    def test_cached_responses(self):
+        url = f"/sales/{self.sale.pk}"
+        resp = self.get(url, data={ 'include': 'items,association' })
+        etag = resp['ETag']
+
+        # Same query params in another order are served from the cache
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.get(url, data={ 'include': 'association,items' })
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(cached.data, resp.data)
+        self.assertNotEqual(self.get(url)['ETag'], etag)
+
+        # Clients with the same version get a 304
+        self.get(url, status.HTTP_304_NOT_MODIFIED, data={ 'include': 'items,association' },
+                 HTTP_IF_NONE_MATCH=etag)
+
+        # Changes invalidate the cache
+        self.sale.name = 'New name'
+        self.sale.save()
+        resp = self.get(url, data={ 'include': 'items,association' }, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual(resp.data['name'], 'New name')
+
+    def test_nested_items(self):
+        url = f"/sales/{self.sale.pk}/items"
+        self.assertEqual(self.get(url).data['count'], 1)
+        self.factory.create(Item, sale=self.sale, group=None, is_active=True)
+        self.assertEqual(self.get(url).data['count'], 2)
+
+    def test_managers_are_not_cached(self):
+        self.client.force_authenticate(user=self.factory.create(User, is_admin=True))
+        url = f"/sales/{self.sale.pk}/items"
+        resp = self.get(url, data={ 'with': 'quantity_left' })
+        self.assertNotIn('ETag', resp)
+
+
+@tag('sale', 'item', 'order', 'prefetch')
+class PrefetchPlanTestCase(APITestCase):
+    """
+    Test that the number of queries of the endpoints does not depend on the number of results
+    """
+    factory = FakeModelFactory()
+    urls = (
+        '/sales?include=items,items__itemfields,association',
+        '/sales?include=itemgroups__items&with=orders',
+        '/items?include=sale',
+        '/orders?include=orderlines__orderlineitems,sale',
+        '/orderlines?include=item__itemfields',
+        '/orderlinefields?include=field&with=name,type',
+    )
+
+    def setUp(self):
+        self.client.force_authenticate(user=self.factory.create(User, is_admin=True))
+        self.field = self.factory.create(Field)
+
+    def count_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK, resp.data)
+        return len(queries)
+
+    def test_constant_queries(self):
+        create_ordered_sale(self.factory, self.field)
+        counts = { url: self.count_queries(url) for url in self.urls }
+        for _ in range(2):
+            create_ordered_sale(self.factory, self.field)
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.count_queries(url), counts[url])
+
+    def test_manager_fields(self):
+        def get_lookups(queryset, prefix: str='') -> set:
+            lookups = set()
+            for lookup in queryset._prefetch_related_lookups:
+                lookups.add(prefix + lookup.prefetch_to)
+                lookups |= get_lookups(lookup.queryset, f"{prefix}{lookup.prefetch_to}__")
+            return lookups
+
+        def prefetched(**kwargs) -> set:
+            return get_lookups(plan_queryset(Sale.objects.all(), SaleSerializer, **kwargs))
+
+        # Manager fields are planned for managers requesting them, at every level
+        self.assertNotIn('orders', prefetched(is_manager=True))
+        self.assertNotIn('orders', prefetched(with_fields=[ 'orders' ]))
+        self.assertIn('orders', prefetched(with_fields=[ 'orders' ], is_manager=True))
+        include_tree = { 'itemgroups': { 'sale': { 'orders': {} } } }
+        self.assertNotIn('itemgroups__sale__orders', prefetched(include_tree=include_tree))
+        self.assertIn('itemgroups__sale__orders', prefetched(include_tree=include_tree, is_manager=True))
+
+        # Managers requesting manager fields do not make more queries per result
+        create_ordered_sale(self.factory, self.field)
+        url = '/sales?include=items&with=orders,is_public'
+        count = self.count_queries(url)
+        create_ordered_sale(self.factory, self.field)
+        self.assertEqual(self.count_queries(url), count)
+
+
+@tag('sale', 'item', 'order', 'metrics')
+class QueryBudgetTestCase(QueryBudgetTestMixin, APITestCase):
+    """
+    Fail when an endpoint exceeds its query budget
+    """
+    factory = FakeModelFactory()
+    query_budgets = {
+        '/sales': 2,
+        '/sales?include=items,itemgroups': 7,
+        '/sales?include=itemgroups__items&with=orders': 7,
+        '/items?include=sale': 4,
+        '/orders?include=orderlines__orderlineitems,sale': 5,
+        '/orderlinefields?include=field': 2,
+    }
+
+    def setUp(self):
+        self.client.force_authenticate(user=self.factory.create(User, is_admin=True))
+        self.field = self.factory.create(Field)
+        create_ordered_sale(self.factory, self.field)
+
+    def test_metrics(self):
+        self.assertQueryBudget('/sales', self.query_budgets['/sales'])
+        self.assertGreater(registry.snapshot()['endpoints']['sales-list']['avg_latency'], 0)
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data['endpoints']['sales-list']['requests'], 1)
+        self.client.force_authenticate(user=self.factory.create(User, is_admin=False))
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+
+
+@tag('order', 'tickets', 'benchmark')
+class TicketGenerationTestCase(APITestCase):
+    """
+    Test and benchmark the generation of the tickets of an order
+    """
+    factory = FakeModelFactory()
+    n_tickets = 200
+
+    def setUp(self):
+        self.sale = self.factory.create(Sale)
+        self.item = self.factory.create(Item, sale=self.sale, group=None)
+        self.fields = [
+            self.factory.create(Field, id=field_id, default=default)
+            for field_id, default in (('first_name', 'owner.first_name'), ('size', 'M'))
+        ]
+        for field in self.fields:
+            self.factory.create(ItemField, item=self.item, field=field)
+        self.order = self.factory.create(Order, sale=self.sale, status=OrderStatus.AWAITING_PAYMENT.value)
+        self.factory.create(OrderLine, order=self.order, item=self.item, quantity=self.n_tickets)
+
+    def test_generate_tickets(self):
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.order.update_status(OrderStatus.PAID)
+        duration = time.perf_counter() - start
+        logger.debug(f"Generated {self.n_tickets} tickets in {duration * 1000:.1f}ms "
+                     f"with {len(queries)} queries")
+
+        self.assertTrue(resp['tickets_generated'])
+        self.assertLess(len(queries), 15)
+        orderlineitems = OrderLineItem.objects.filter(orderline__order=self.order)
+        self.assertEqual(orderlineitems.count(), self.n_tickets)
+        values = Counter(OrderLineField.objects.filter(orderlineitem__in=orderlineitems)
+                                               .values_list('field_id', 'value'))
+        self.assertDictEqual(values, {
+            ('first_name', self.order.owner.first_name): self.n_tickets,
+            ('size', 'M'): self.n_tickets,
+        })
+
+        # Generating again does not create any ticket
+        self.assertEqual(self.order.generate_orderlineitems_and_fields(), 0)
+        self.assertFalse(self.order.update_status(OrderStatus.PAID)['tickets_generated'])
+        self.assertEqual(orderlineitems.count(), self.n_tickets)
+
+    def test_generate_tickets_command(self):
+        # Paid orders without tickets, with missing tickets and not paid
+        Order.objects.filter(pk=self.order.pk).update(status=OrderStatus.PAID.value)
+        partial_order = self.factory.create(Order, sale=self.sale, status=OrderStatus.VALIDATED.value)
+        partial_orderline = self.factory.create(OrderLine, order=partial_order, item=self.item, quantity=3)
+        self.factory.create(OrderLineItem, orderline=partial_orderline)
+        awaiting_order = self.factory.create(Order, sale=self.sale, status=OrderStatus.AWAITING_PAYMENT.value)
+        self.factory.create(OrderLine, order=awaiting_order, item=self.item, quantity=2)
+
+        for _ in range(2):
+            call_command('generate_tickets', sale=self.sale.pk, chunk_size=1, stdout=StringIO())
+            tickets = Counter(OrderLineItem.objects.values_list('orderline__order_id', flat=True))
+            self.assertDictEqual(tickets, { self.order.pk: self.n_tickets, partial_order.pk: 3 })
+
+
+@tag('order', 'tickets')
+class TicketsPDFTestCase(APITestCase):
+    """
+    Test the rendering and caching of the tickets PDF
+    """
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.factory.create(User, is_admin=True)
+        self.order = self.factory.create(Order, owner=self.user, status=OrderStatus.AWAITING_PAYMENT.value)
+        item = self.factory.create(Item, sale=self.order.sale, group=None)
+        field = self.factory.create(Field, id='size', default='M')
+        self.factory.create(ItemField, item=item, field=field)
+        self.factory.create(OrderLine, order=self.order, item=item, quantity=2)
+        self.order.update_status(OrderStatus.PAID)
+        self.client.force_authenticate(user=self.user)
+
+    def get_pdf(self, rendered: bool) -> bytes:
+        resp = self.client.get(f"/orders/{self.order.pk}/pdf")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['Content-Type'], 'application/pdf')
+        self.assertEqual('render;dur=' in resp['Server-Timing'], rendered)
+        return resp.content
+
+    def test_tickets_pdf_cache(self):
+        pdf = self.get_pdf(rendered=True)
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        self.assertEqual(self.get_pdf(rendered=False), pdf)
+
+        # Changing a field value renders the tickets again
+        orderlinefield = OrderLineField.objects.filter(orderlineitem__orderline__order=self.order).first()
+        orderlinefield.value = 'XL'
+        orderlinefield.save()
+        self.get_pdf(rendered=True)
+        self.get_pdf(rendered=False)
+
+    def test_parallel_rendering(self):
+        item = self.factory.create(Item, sale=self.order.sale, group=None)
+        orderline = self.factory.create(OrderLine, order=self.order, item=item, quantity=5)
+        generate_tickets(OrderLine.objects.filter(pk=orderline.pk))
+        pdf = self.get_pdf(rendered=True)
+        cache.clear()
+        close_render_pool()
+        self.addCleanup(close_render_pool)
+        with override_settings(TICKETS_PARALLEL_THRESHOLD=2, TICKETS_RENDER_PROCESSES=2):
+            merged_pdf = self.get_pdf(rendered=True)
+            self.assertIsNotNone(get_render_pool())
+        self.assertEqual(len(PdfReader(BytesIO(merged_pdf)).pages), len(PdfReader(BytesIO(pdf)).pages))
+
+    def test_export_sale_tickets(self):
+        # Orders not validated are not exported
+        self.factory.create(Order, owner=self.user, sale=self.order.sale, status=OrderStatus.ONGOING.value)
+        other_order = self.factory.create(Order, owner=self.user, sale=self.order.sale,
+                                          status=OrderStatus.AWAITING_PAYMENT.value)
+        self.factory.create(OrderLine, order=other_order, item=self.order.orderlines.first().item,
+                            quantity=1)
+        other_order.update_status(OrderStatus.PAID)
+
+        with NamedTemporaryFile() as output:
+            call_command('export_tickets', sale=self.order.sale.pk, processes=2, output=output.name,
+                         stdout=StringIO())
+            with zipfile.ZipFile(output) as archive:
+                parallel = { name: archive.read(name) for name in archive.namelist() }
+
+        cache.clear()
+        buffer = BytesIO()
+        self.assertEqual(export_sale_tickets(self.order.sale.pk, buffer), 2)
+        with zipfile.ZipFile(buffer) as archive:
+            names = archive.namelist()
+            self.assertSetEqual(set(names), set(parallel))
+            self.assertTrue(any(name.endswith(f"_{self.order.pk}.pdf") for name in names))
+            for name in names:
+                self.assertTrue(archive.read(name).startswith(b'%PDF'))
+                # Only the creation dates differ between the renderings
+                self.assertEqual(len(PdfReader(BytesIO(archive.read(name))).pages),
+                                 len(PdfReader(BytesIO(parallel[name])).pages))
+
+    def test_admin_export_tickets(self):
+        sale_admin = SaleAdmin(Sale, admin.site)
+        resp = sale_admin.export_tickets(None, Sale.objects.filter(pk=self.order.sale.pk))
+        self.assertEqual(resp['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(BytesIO(b''.join(resp.streaming_content))) as archive:
+            self.assertEqual(len(archive.namelist()), 1)
+        resp.file_to_stream.close()
+
+
+@tag('order', 'export')
+class SaleExportTestCase(APITestCase):
+    """
+    Test the streaming exports of the tickets of a sale
+    """
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        self.sale = self.factory.create(Sale)
+        item = self.factory.create(Item, sale=self.sale, group=None)
+        for field_id, default in (('size', 'M'), ('diet', None)):
+            field = self.factory.create(Field, id=field_id, name=field_id.title(), default=default)
+            self.factory.create(ItemField, item=item, field=field)
+        self.orders = [
+            self.factory.create(Order, sale=self.sale, status=OrderStatus.AWAITING_PAYMENT.value)
+            for _ in range(3)
+        ]
+        for order in self.orders:
+            self.factory.create(OrderLine, order=order, item=item, quantity=2)
+        for order in self.orders[:2]:
+            order.update_status(OrderStatus.PAID)
+
+    def check_rows(self, rows: list) -> None:
+        self.assertEqual(rows[0], [ 'Commande', 'UUID', 'Email', 'Item', 'Quantité', 'Diet', 'Size' ])
+        tickets = OrderLineItem.objects.filter(orderline__order__in=self.orders[:2])
+        self.assertEqual(len(rows) - 1, tickets.count())
+        self.assertSetEqual({ row[1] for row in rows[1:] }, { ticket.id.hex for ticket in tickets })
+        self.assertSetEqual({ row[6] for row in rows[1:] }, { 'M' })
+
+    def test_export_command(self):
+        with NamedTemporaryFile(suffix='.csv') as output:
+            result = StringIO()
+            call_command('export_sale', sale=self.sale.pk, output=output.name, stdout=result)
+            self.assertIn("Exported 4 tickets", result.getvalue())
+            with open(output.name, newline='', encoding='utf-8') as fileobj:
+                self.check_rows(list(csv.reader(fileobj)))
+
+    def test_export_constant_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(iter_export_rows(self.sale.pk, chunk_size=1))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(len(queries), 2)
+
+    def test_export_pivoted_values(self):
+        ticket = OrderLineItem.objects.filter(orderline__order=self.orders[0]).first()
+        OrderLineField.objects.filter(orderlineitem=ticket, field_id='diet').update(value='Vegan')
+        rows = { row[1]: row for row in iter_export_rows(self.sale.pk) }
+        self.assertEqual(rows[ticket.id.hex][5:], [ 'Vegan', 'M' ])
+
+    @tag('benchmark')
+    def test_export_benchmark(self):
+        n_tickets = 5000
+        order = self.orders[2]
+        orderline = self.factory.create(OrderLine, order=order, item=order.orderlines.first().item,
+                                        quantity=n_tickets)
+        generate_tickets(OrderLine.objects.filter(pk=orderline.pk))
+        Order.objects.filter(pk=order.pk).update(status=OrderStatus.PAID.value)
+
+        start = time.perf_counter()
+        exported = export_sale(BytesIO(), self.sale.pk)
+        duration = time.perf_counter() - start
+        logger.debug(f"Exported {exported} tickets in {duration * 1000:.1f}ms")
+        self.assertEqual(exported, n_tickets + 4)
+
+    def test_export_endpoint(self):
+        url = f"/sales/{self.sale.pk}/export"
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.factory.create(User, is_admin=True))
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.streaming)
+        content = b''.join(resp.streaming_content).decode()
+        self.check_rows(list(csv.reader(content.splitlines())))
+
+        resp = self.client.get(url, { 'type': 'pdf' })
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@tag('order', 'checkin')
+class CheckInTestCase(APITransactionTestCase):
+    """
+    Test the scan of the tickets, committed for the index to be cleared
+    """
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.factory.create(User, is_admin=True)
+        self.sale = self.factory.create(Sale)
+        self.item = self.factory.create(Item, sale=self.sale, group=None)
+        self.order = self.create_order(OrderStatus.PAID)
+        self.url = f"/sales/{self.sale.pk}/scan"
+        self.client.force_authenticate(user=self.user)
+
+    def create_order(self, status: OrderStatus) -> Order:
+        order = self.factory.create(Order, sale=self.sale, status=OrderStatus.AWAITING_PAYMENT.value)
+        self.factory.create(OrderLine, order=order, item=self.item, quantity=2)
+        order.update_status(status)
+        return order
+
+    def get_ticket(self, order: Order) -> OrderLineItem:
+        return OrderLineItem.objects.filter(orderline__order=order).first()
+
+    def scan(self, code: str, expected_status: int) -> dict:
+        resp = self.client.post(self.url, { 'ticket': code, 'device': 'door' }, format='json')
+        self.assertEqual(resp.status_code, expected_status, resp.data)
+        return resp.data
+
+    def test_scan(self):
+        ticket = self.get_ticket(self.order)
+        data = self.scan(ticket.id.hex, status.HTTP_201_CREATED)
+        self.assertEqual(data['ticket'], str(ticket.id))
+        self.assertEqual(CheckIn.objects.get().scanned_by, self.user)
+
+        data = self.scan(str(ticket.id), status.HTTP_409_CONFLICT)
+        self.assertEqual(data['code'], 'ticket_already_scanned')
+        self.assertEqual(data['details']['device'], 'door')
+
+        self.scan('not a ticket', status.HTTP_404_NOT_FOUND)
+        self.scan(uuid.uuid4().hex, status.HTTP_404_NOT_FOUND)
+        self.scan('', status.HTTP_400_BAD_REQUEST)
+
+    def test_index_invalidation(self):
+        self.scan(self.get_ticket(self.order).id.hex, status.HTTP_201_CREATED)
+
+        # Tickets of new orders are valid, tickets of cancelled orders are not
+        new_order = self.create_order(OrderStatus.PAID)
+        self.scan(self.get_ticket(new_order).id.hex, status.HTTP_201_CREATED)
+        self.order.status = OrderStatus.CANCELLED.value
+        self.order.save()
+        ticket = OrderLineItem.objects.filter(orderline__order=self.order, checkin__isnull=True).first()
+        self.scan(ticket.id.hex, status.HTTP_404_NOT_FOUND)
+
+        # Tickets of other sales are not valid
+        other_order = self.factory.create(Order, status=OrderStatus.AWAITING_PAYMENT.value)
+        self.factory.create(OrderLine, order=other_order, quantity=1,
+                            item=self.factory.create(Item, sale=other_order.sale, group=None))
+        other_order.update_status(OrderStatus.PAID)
+        self.scan(self.get_ticket(other_order).id.hex, status.HTTP_404_NOT_FOUND)
+
+    def test_offline_bundle(self):
+        tickets = list(OrderLineItem.objects.filter(orderline__order=self.order))
+        field = self.factory.create(Field, name='Nom')
+        self.factory.create(OrderLineField, orderlineitem=tickets[0], field=field, value='Holder')
+
+        resp = self.client.get(f"/sales/{self.sale.pk}/checkin-bundle")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        bundle = resp.content
+        self.assertEqual(BUNDLE_HEADER.unpack_from(bundle)[2], len(tickets))
+        self.assertDictEqual(find_in_bundle(bundle, tickets[0].id), {
+            'item': self.item.pk,
+            'name': f"Holder {self.order.owner.last_name}",
+        })
+        self.assertEqual(find_in_bundle(bundle, tickets[1].id)['name'], self.order.owner.get_full_name())
+        self.assertIsNone(find_in_bundle(bundle, uuid.uuid4()))
+
+        with NamedTemporaryFile() as output:
+            call_command('export_checkin_bundle', sale=self.sale.pk, output=output.name, stdout=StringIO())
+            exported = output.read()
+            # Same bundle except for its generation time
+            self.assertEqual(BUNDLE_HEADER.unpack_from(exported)[:3], BUNDLE_HEADER.unpack_from(bundle)[:3])
+            self.assertEqual(exported[BUNDLE_HEADER.size:], bundle[BUNDLE_HEADER.size:])
+
+    def test_upload_scans(self):
+        tickets = list(OrderLineItem.objects.filter(orderline__order=self.order))
+        self.scan(tickets[0].id.hex, status.HTTP_201_CREATED)
+        before = timezone.now() - timedelta(hours=1)
+
+        resp = self.client.post(f"/sales/{self.sale.pk}/scans", {
+            'device': 'offline',
+            'scans': [
+                # Scanned offline before the online scan
+                { 'ticket': tickets[0].id.hex, 'scanned_at': before.isoformat() },
+                { 'ticket': tickets[1].id.hex, 'scanned_at': (before + timedelta(minutes=5)).isoformat() },
+                { 'ticket': tickets[1].id.hex, 'scanned_at': before.isoformat() },
+                { 'ticket': uuid.uuid4().hex, 'scanned_at': before.isoformat() },
+                { 'ticket': tickets[1].id.hex },
+            ],
+        }, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([ result['status'] for result in resp.data['results'] ],
+                         [ 'checked_in', 'already_scanned', 'checked_in', 'invalid', 'invalid' ])
+        self.assertEqual(resp.data['checked_in'], 2)
+        for ticket in tickets:
+            checkin = CheckIn.objects.get(pk=ticket.id)
+            self.assertEqual((checkin.scanned_at, checkin.device), (before, 'offline'))
+
+        # Uploading again does not change anything
+        resp = self.client.post(f"/sales/{self.sale.pk}/scans", {
+            'device': 'other',
+            'scans': [ { 'ticket': tickets[0].id.hex, 'scanned_at': timezone.now().isoformat() } ],
+        }, format='json')
+        self.assertEqual(resp.data['already_scanned'], 1)
+        self.assertEqual(CheckIn.objects.get(pk=tickets[0].id).device, 'offline')
+
+    def test_upload_deleted_ticket_scans(self):
+        codes = list(OrderLineItem.objects.filter(orderline__order=self.order)
+                                          .values_list('id', flat=True))
+        self.assertIn(codes[1].hex, get_checkin_index(self.sale.pk))
+
+        # Scans of the tickets deleted since the index was loaded do not fail the others,
+        # the index is only cleared once the deletion is committed
+        with transaction.atomic():
+            OrderLineItem.objects.filter(pk=codes[1]).delete()
+            results = upload_checkins(self.sale.pk, [
+                { 'ticket': code.hex, 'scanned_at': timezone.now().isoformat() } for code in codes
+            ], device='offline')
+        self.assertEqual([ result['status'] for result in results ], [ 'checked_in', 'invalid' ])
+        self.assertTrue(CheckIn.objects.filter(pk=codes[0]).exists())
+        self.assertFalse(CheckIn.objects.filter(pk=codes[1]).exists())
+
+    def test_concurrent_scans(self):
+        ticket = self.get_ticket(self.order)
+        results = []
+
+        def scan():
+            try:
+                check_in(self.sale.pk, ticket.id.hex, device='door')
+                results.append('ok')
+            except TicketAlreadyScanned:
+                results.append('duplicate')
+            finally:
+                connection.close()
+
+        start_and_await_jobs(Thread(target=scan) for _ in range(8))
+        self.assertEqual(sorted(results), [ 'duplicate' ] * 7 + [ 'ok' ])
+        self.assertEqual(CheckIn.objects.count(), 1)
+
+
 # --------------------------------------------
 #   Fields
 # --------------------------------------------
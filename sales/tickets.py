@@ -0,0 +1,297 @@
+from typing import BinaryIO, List, Optional, Sequence, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from threading import Lock
+from hashlib import sha256
+import multiprocessing
+import logging
+import zipfile
+import json
+import math
+import time
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import get_template
+
+from core.utils import base64_qrcode, html_to_pdf, merge_pdfs
+from sales.models import Order, OrderStatus
+
+logger = logging.getLogger(f"woolly.{__name__}")
+
+TICKETS_TEMPLATE = 'pdf/template_order.html'
+# Bump to invalidate the rendered tickets when their assets change
+TICKETS_TEMPLATE_VERSION = 1
+# Number of tickets fitting on an A4 page with the template
+TICKETS_PER_PAGE = 3
+
+QRCODE_CACHE_KEY = "tickets:qrcode:{uuid}"
+PDF_CACHE_KEY = "tickets:pdf:{order_pk}:{digest}"
+# Digest of the last rendered tickets of an order, to clear them on changes
+LAST_PDF_CACHE_KEY = "tickets:last_pdf:{order_pk}"
+CACHE_TIMEOUT = int(settings.TICKETS_CACHE_TIMEOUT.total_seconds())
+
+_template_digest = None
+_render_pool = None
+_render_pool_lock = Lock()
+
+
+def get_template_digest() -> str:
+    """
+    Hash of the source and version of the tickets template
+    """
+    global _template_digest
+    if _template_digest is None:
+        source = get_template(TICKETS_TEMPLATE).template.source
+        _template_digest = sha256(f"{TICKETS_TEMPLATE_VERSION}:{source}".encode()).hexdigest()
+    return _template_digest
+
+
+def get_orders_with_tickets():
+    """
+    Get the orders with everything needed to render their tickets
+    """
+    return Order.objects.select_related('owner', 'sale').prefetch_related(
+        'orderlines', 'orderlines__orderlineitems', 'orderlines__item',
+        'orderlines__orderlineitems__orderlinefields',
+        'orderlines__orderlineitems__orderlinefields__field'
+    )
+
+
+def get_order_with_tickets(pk: int) -> Order:
+    """
+    Get an order with everything needed to render its tickets
+    """
+    return get_orders_with_tickets().get(pk=pk)
+
+
+def get_tickets_data(order: Order) -> List[dict]:
+    """
+    Get the data printed on each ticket of an order, without QR codes
+    """
+    tickets = []
+    for orderline in order.orderlines.all():
+        for orderlineitem in orderline.orderlineitems.all():
+            # TODO Add more flexibility
+            # Add Nom et Prénom to orderline
+            first_name = last_name = None
+            for orderlinefield in orderlineitem.orderlinefields.all():
+                if orderlinefield.field.name == 'Nom':
+                    first_name = orderlinefield.value
+                elif orderlinefield.field.name == 'Prénom':
+                    last_name = orderlinefield.value
+
+            if first_name is None:
+                first_name = order.owner.first_name
+            if last_name is None:
+                last_name = order.owner.last_name
+
+            tickets.append({
+                'nom': first_name,
+                'prenom': last_name,
+                'item': { 'name': orderline.item.name, 'price': orderline.item.price },
+                'uuid': str(orderlineitem.id),
+            })
+    return tickets
+
+
+def get_qrcode(uuid: str) -> str:
+    """
+    Get the base64 PNG QR code of a ticket, which never changes
+    """
+    key = QRCODE_CACHE_KEY.format(uuid=uuid)
+    qr_code = cache.get(key)
+    if qr_code is None:
+        # Remove dashes to shorten the code
+        qr_code = base64_qrcode(uuid.replace('-', ''))
+        cache.set(key, qr_code, CACHE_TIMEOUT)
+    return qr_code
+
+
+def get_tickets_context(order: Order, tickets: List[dict]=None) -> dict:
+    """
+    Get the context to render the tickets template
+    """
+    if tickets is None:
+        tickets = get_tickets_data(order)
+    return {
+        'tickets': [ { **ticket, 'qr_code': get_qrcode(ticket['uuid']) } for ticket in tickets ],
+        'order': { 'pk': order.pk, 'sale': { 'name': order.sale.name } },
+    }
+
+
+def get_tickets_digest(order: Order, tickets: List[dict]) -> str:
+    """
+    Hash of everything printed on the tickets of an order
+    """
+    content = json.dumps([ order.sale.name, tickets ], sort_keys=True, default=str)
+    return sha256(f"{get_template_digest()}:{content}".encode()).hexdigest()
+
+
+def get_pdf_cache_key(order: Order, tickets: List[dict]) -> str:
+    return PDF_CACHE_KEY.format(order_pk=order.pk, digest=get_tickets_digest(order, tickets))
+
+
+# --------------------------------------------
+#   Rendering
+# --------------------------------------------
+
+def create_render_pool(processes: int) -> Optional[ProcessPoolExecutor]:
+    """
+    Create a pool of processes converting HTML to PDF, None to render in the current process.
+    Workers are spawned rather than forked as forking threaded web workers
+    could deadlock on locks held by their other threads.
+    """
+    if processes < 2:
+        return None
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=django.setup)
+
+
+def get_render_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Get the pool of processes rendering PDFs, shared by the whole process
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = create_render_pool(settings.TICKETS_RENDER_PROCESSES)
+        return _render_pool
+
+
+def close_render_pool() -> None:
+    """
+    Shut down the shared pool, a new one is created on the next rendering
+    """
+    global _render_pool
+    with _render_pool_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+
+def render_pdfs(htmls: Sequence[str], pool: ProcessPoolExecutor=None,
+                chunksize: int=1) -> List[Optional[bytes]]:
+    """
+    Convert HTML documents to PDF, in parallel if a pool is given
+    """
+    if pool is None or len(htmls) < 2:
+        return [ html_to_pdf(html) for html in htmls ]
+
+    try:
+        return list(pool.map(html_to_pdf, htmls, chunksize=chunksize))
+    except BrokenProcessPool:
+        logger.exception("PDF rendering pool is broken, rendering in the current process")
+        if pool is _render_pool:
+            close_render_pool()
+        return [ html_to_pdf(html) for html in htmls ]
+
+
+def render_tickets_html(order: Order, tickets: List[dict]) -> str:
+    return get_template(TICKETS_TEMPLATE).render(get_tickets_context(order, tickets))
+
+
+def render_order_pdf(order: Order, tickets: List[dict]) -> Optional[bytes]:
+    """
+    Render the tickets of an order, page by page in parallel for large orders
+    """
+    pool = get_render_pool() if len(tickets) >= settings.TICKETS_PARALLEL_THRESHOLD else None
+    if pool is None:
+        return html_to_pdf(render_tickets_html(order, tickets))
+
+    pages = render_pdfs([ render_tickets_html(order, tickets[i:i + TICKETS_PER_PAGE])
+                          for i in range(0, len(tickets), TICKETS_PER_PAGE) ], pool)
+    if any(page is None for page in pages):
+        return None
+    return merge_pdfs(pages)
+
+
+def render_tickets_pdf(order: Order) -> Tuple[bytes, dict]:
+    """
+    Get the PDF of the tickets of an order from the cache or render it,
+    and return it with the time spent in each step
+    """
+    timings = {}
+    start = time.perf_counter()
+    tickets = get_tickets_data(order)
+    key = get_pdf_cache_key(order, tickets)
+    pdf = cache.get(key)
+    timings['cache'] = time.perf_counter() - start
+
+    if pdf is None:
+        start = time.perf_counter()
+        pdf = render_order_pdf(order, tickets)
+        timings['render'] = time.perf_counter() - start
+        if pdf is not None:
+            cache.set_many({
+                key: pdf,
+                LAST_PDF_CACHE_KEY.format(order_pk=order.pk): key,
+            }, CACHE_TIMEOUT)
+
+    logger.info(f"Tickets of order {order.pk} " + ("rendered" if 'render' in timings else "served from cache")
+                + " in " + ", ".join(f"{step}={duration * 1000:.1f}ms" for step, duration in timings.items()))
+    return pdf, timings
+
+
+def export_sale_tickets(sale_pk: str, fileobj: BinaryIO, processes: int=None,
+                        chunk_size: int=100) -> int:
+    """
+    Write the tickets of all the validated orders of a sale to a ZIP of PDFs,
+    rendering the orders with the given number of processes or the shared pool,
+    and return the number of orders exported
+    """
+    orders = get_orders_with_tickets() \
+        .filter(sale_id=sale_pk, status__in=OrderStatus.VALIDATED_LIST.value) \
+        .order_by('pk')
+    order_ids = list(orders.values_list('pk', flat=True))
+
+    exported = 0
+    if processes is None:
+        processes = settings.TICKETS_RENDER_PROCESSES
+        pool, pool_context = get_render_pool(), nullcontext()
+    else:
+        pool = create_render_pool(processes)
+        pool_context = pool or nullcontext()
+    with pool_context, zipfile.ZipFile(fileobj, 'w') as archive:
+        for i in range(0, len(order_ids), chunk_size):
+            chunk = list(orders.filter(pk__in=order_ids[i:i + chunk_size]))
+            tickets = { order.pk: get_tickets_data(order) for order in chunk }
+            keys = { order.pk: get_pdf_cache_key(order, tickets[order.pk]) for order in chunk if tickets[order.pk] }
+            pdfs = cache.get_many(keys.values())
+
+            # Render the missing PDFs, one order per process
+            # and sent in chunks to limit the inter-process overhead
+            missing = [ order for order in chunk if order.pk in keys and keys[order.pk] not in pdfs ]
+            htmls = [ render_tickets_html(order, tickets[order.pk]) for order in missing ]
+            chunksize = max(1, math.ceil(len(htmls) / (processes * 4)))
+            rendered = render_pdfs(htmls, pool, chunksize=chunksize)
+            to_cache = {}
+            for order, pdf in zip(missing, rendered):
+                if pdf is None:
+                    logger.error(f"Could not render the tickets of order {order.pk}")
+                    continue
+                pdfs[keys[order.pk]] = pdf
+                to_cache[keys[order.pk]] = pdf
+                to_cache[LAST_PDF_CACHE_KEY.format(order_pk=order.pk)] = keys[order.pk]
+            cache.set_many(to_cache, CACHE_TIMEOUT)
+
+            for order in chunk:
+                pdf = pdfs.get(keys.get(order.pk))
+                if pdf is not None:
+                    # Slashes would create folders in the archive
+                    sale_name = order.sale.name.replace("/", "-")
+                    archive.writestr(f"Woolly_{sale_name}_{order.pk}.pdf", pdf)
+                    exported += 1
+            logger.info(f"Exported tickets of {exported} orders of sale {sale_pk}")
+    return exported
+
+
+def clear_tickets_cache(order_pk: int) -> None:
+    """
+    Clear the last rendered tickets of an order
+    """
+    last_key = LAST_PDF_CACHE_KEY.format(order_pk=order_pk)
+    pdf_key = cache.get(last_key)
+    cache.delete_many([ last_key ] + ([ pdf_key ] if pdf_key else []))
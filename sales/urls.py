@@ -6,7 +6,7 @@ from authentication.views import UserViewSet, UserTypeViewSet
 from .views import (
     AssociationViewSet, SaleViewSet, ItemGroupViewSet, ItemViewSet,
     OrderViewSet, OrderLineViewSet, OrderLineItemViewSet, FieldViewSet,
-    OrderLineFieldViewSet, ItemFieldViewSet, generate_tickets
+    OrderLineFieldViewSet, ItemFieldViewSet, generate_tickets, scan_ticket, upload_scans, checkin_bundle, export_sale
 )
 
 urlpatterns = merge_sets(
@@ -65,6 +65,12 @@ urlpatterns = merge_sets(
 urlpatterns += [
     # Generation du PDF
     path('orders/<int:pk>/pdf', generate_tickets),
+    # Scan des billets d'une vente
+    path('sales/<slug:pk>/scan', scan_ticket),
+    path('sales/<slug:pk>/scans', upload_scans),
+    path('sales/<slug:pk>/checkin-bundle', checkin_bundle),
+    # Export des billets d'une vente
+    path('sales/<slug:pk>/export', export_sale),
 ]
 
 
@@ -1,23 +1,37 @@
+from collections import Counter
+from tempfile import TemporaryFile
+
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 
-from authentication.oauth import OAuthAuthentication
-from core.utils import render_to_pdf, base64_qrcode
+from authentication.hydration import hydrate_users
+from authentication.oauth import OAuthAPI, OAuthAuthentication
+from core.cache import ResponseCacheMixin
+from core.exceptions import APIException, InvalidRequest
 from core.viewsets import ModelViewSet, APIModelViewSet
+from core.views import CursorPagination
 from core.permissions import CanOnlyReadOrUpdate, IsAdmin, IsAdminOrReadOnly
 from sales.exceptions import OrderValidationException
 from sales.permissions import (
-    IsOwnerOrManager, IsOwnerOrManagerReadOnly, IsManagerOrReadOnly
+    IsOwnerOrManager, IsOwnerOrManagerReadOnly, IsManagerOrReadOnly, IsSaleManager
 )
+from sales.signals import CATALOG_CACHE_NAMESPACE
 from sales.models import (
     Association, Sale, ItemGroup, Item,
     OrderStatus, Order, OrderLine, OrderLineItem,
     Field, ItemField, OrderLineField
 )
+from sales.checkin import MAX_UPLOADED_SCANS, check_in, get_bundle, upload_checkins
+from sales.exports import (
+    EXPORT_CONTENT_TYPES, EXPORT_FORMATS, Workbook, iter_export_rows, stream_csv, write_xlsx
+)
+from sales.tickets import (
+    TICKETS_TEMPLATE, get_order_with_tickets, get_tickets_context, render_tickets_pdf
+)
 from sales.serializers import (
     AssociationSerializer, SaleSerializer, ItemGroupSerializer, ItemSerializer,
     OrderSerializer, OrderLineSerializer, OrderLineItemSerializer,
@@ -47,13 +61,14 @@ class AssociationViewSet(APIModelViewSet):
         return filters
 
 
-class SaleViewSet(ModelViewSet):
+class SaleViewSet(ResponseCacheMixin, ModelViewSet):
     """
     Defines the behavior of the sale view
     """
     queryset = Sale.objects.all()
     serializer_class = SaleSerializer
     permission_classes = [IsManagerOrReadOnly]
+    response_cache_namespace = CATALOG_CACHE_NAMESPACE
 
     # TODO Check for association in data or url for create/update
 
@@ -75,22 +90,24 @@ class SaleViewSet(ModelViewSet):
 #   Items
 # --------------------------------------------
 
-class ItemGroupViewSet(ModelViewSet):
+class ItemGroupViewSet(ResponseCacheMixin, ModelViewSet):
     """
     Defines the behavior of the itemGroup interactions
     """
     queryset = ItemGroup.objects.all()
     serializer_class = ItemGroupSerializer
     permission_classes = [IsManagerOrReadOnly]
+    response_cache_namespace = CATALOG_CACHE_NAMESPACE
 
 
-class ItemViewSet(ModelViewSet):
+class ItemViewSet(ResponseCacheMixin, ModelViewSet):
     """
     Defines the behavior of the item interactions
     """
     queryset = Item.objects.all()
     serializer_class = ItemSerializer
     permission_classes = [IsManagerOrReadOnly]
+    response_cache_namespace = CATALOG_CACHE_NAMESPACE
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -115,6 +132,7 @@ class OrderViewSet(ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsOwnerOrManagerReadOnly]
+    cursor_pagination_class = CursorPagination
 
     def get_sub_urls_filters(self, queryset) -> dict:
         """
@@ -139,6 +157,16 @@ class OrderViewSet(ModelViewSet):
 
         return queryset
 
+    def paginate_queryset(self, queryset):
+        """
+        Hydrate all the included owners of the page at once
+        """
+        page = super().paginate_queryset(queryset)
+        if page and 'owner' in (self.get_include_tree(self.request.GET) or {}):
+            oauth_client = OAuthAPI(session=self.request.session)
+            hydrate_users((order.owner for order in page if order.owner), oauth_client)
+        return page
+
     def get_object(self) -> Order:
         """
         Try to update order status if unstable
@@ -205,6 +233,7 @@ class OrderLineViewSet(ModelViewSet):
     queryset = OrderLine.objects.all()
     serializer_class = OrderLineSerializer
     permission_classes = [IsOwnerOrManagerReadOnly]
+    cursor_pagination_class = CursorPagination
 
     def get_sub_urls_filters(self, queryset) -> dict:
         """
@@ -359,12 +388,7 @@ class OrderLineFieldViewSet(ModelViewSet):
 @authentication_classes([OAuthAuthentication])
 @permission_classes([IsOwnerOrManagerReadOnly])
 def generate_tickets(request, pk: int, **kwargs):
-    # Get order
-    order = Order.objects.all().prefetch_related(
-        'orderlines', 'orderlines__orderlineitems', 'orderlines__item',
-        'orderlines__orderlineitems__orderlinefields',
-        'orderlines__orderlineitems__orderlinefields__field'
-    ).get(pk=pk)
+    order = get_order_with_tickets(pk)
 
     # Check order is valid
     if order.status not in OrderStatus.VALIDATED_LIST.value:
@@ -373,52 +397,101 @@ def generate_tickets(request, pk: int, **kwargs):
             details=f"Status: {order.get_status_display()}",
             status_code=status.HTTP_400_BAD_REQUEST)
 
-    # Process tickets
-    tickets = []
-    for orderline in order.orderlines.all():
-        for orderlineitem in orderline.orderlineitems.all():
-            # Process QRCode
-            orderline_code = str(orderlineitem.id).replace('-', '')
-            qr_code = base64_qrcode(orderline_code)
-
-            # TODO Add more flexibility
-            # Add Nom et Prénom to orderline
-            first_name = last_name = None
-            for orderlinefield in orderlineitem.orderlinefields.all():
-                if orderlinefield.field.name == 'Nom':
-                    first_name = orderlinefield.value
-                elif orderlinefield.field.name == 'Prénom':
-                    last_name = orderlinefield.value
-
-            if first_name is None:
-                first_name = order.owner.first_name
-            if last_name is None:
-                last_name = order.owner.last_name
-
-            # Add a ticket with this data
-            tickets.append({
-                'nom': first_name,
-                'prenom': last_name,
-                'qr_code': qr_code,
-                'item': orderline.item,
-                'uuid': orderlineitem.id,
-            })
-
     # Render template
-    template = 'pdf/template_order.html'
-    data = {
-        'tickets': tickets,
-        'order': order,
-    }
     if request.GET.get('type', 'pdf') == 'html':
-        return render(request, template, data)
-    else:
-        pdf = render_to_pdf(template, data)
-        response = HttpResponse(pdf, content_type='application/pdf')
+        return render(request, TICKETS_TEMPLATE, get_tickets_context(order))
+
+    pdf, timings = render_tickets_pdf(order)
+    if pdf is None:
+        raise APIException("Erreur lors de la génération des billets", 'tickets_rendering_error')
+
+    response = HttpResponse(pdf, content_type='application/pdf')
+    response['Server-Timing'] = ", ".join(f"{step};dur={duration * 1000:.1f}"
+                                          for step, duration in timings.items())
+
+    # Add download header by default
+    if request.GET.get('download', 'false') != 'false':
+        filename = f"Woolly_{order.sale.name}_{order.pk}.pdf"
+        response['Content-Disposition'] = f'attachment;filename="{filename}"'
+
+    return response
+
+
+# --------------------------------------------
+#   Check-ins
+# --------------------------------------------
 
-        # Add download header by default
-        if request.GET.get('download', 'false') != 'false':
-            filename = f"Woolly_{order.sale.name}_{order.pk}.pdf"
-            response['Content-Disposition'] = f'attachment;filename="{filename}"'
+@api_view(['POST'])
+@authentication_classes([OAuthAuthentication])
+@permission_classes([IsSaleManager])
+def scan_ticket(request, pk: str, **kwargs):
+    if not request.data.get('ticket'):
+        raise InvalidRequest("Le billet à scanner n'est pas spécifié", 'missing_ticket')
+
+    checkin = check_in(pk, request.data['ticket'], request.user, str(request.data.get('device', ''))[:64])
+    return Response({
+        'ticket': str(checkin.orderlineitem_id),
+        'scanned_at': checkin.scanned_at,
+        'device': checkin.device,
+    }, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@authentication_classes([OAuthAuthentication])
+@permission_classes([IsSaleManager])
+def upload_scans(request, pk: str, **kwargs):
+    scans = request.data.get('scans')
+    if not isinstance(scans, list):
+        raise InvalidRequest("Les scans doivent être une liste", 'invalid_scans')
+    if len(scans) > MAX_UPLOADED_SCANS:
+        raise InvalidRequest(f"Impossible d'envoyer plus de {MAX_UPLOADED_SCANS} scans à la fois",
+                             'too_many_scans')
+
+    results = upload_checkins(pk, scans, request.user, str(request.data.get('device', ''))[:64])
+    counts = Counter(result['status'] for result in results)
+    return Response({
+        'checked_in': counts['checked_in'],
+        'already_scanned': counts['already_scanned'],
+        'invalid': counts['invalid'],
+        'results': results,
+    })
+
+
+@api_view(['GET'])
+@authentication_classes([OAuthAuthentication])
+@permission_classes([IsSaleManager])
+def checkin_bundle(request, pk: str, **kwargs):
+    response = HttpResponse(get_bundle(pk), content_type='application/octet-stream')
+    response['Content-Disposition'] = f'attachment;filename="Woolly_{pk}.checkin"'
+    return response
+
+
+# --------------------------------------------
+#   Exports
+# --------------------------------------------
 
+@api_view(['GET'])
+@authentication_classes([OAuthAuthentication])
+@permission_classes([IsSaleManager])
+def export_sale(request, pk: str, **kwargs):
+    export_type = request.GET.get('type', 'csv')
+    if export_type not in EXPORT_FORMATS:
+        raise InvalidRequest(f"Le format d'export '{export_type}' n'existe pas", 'unknown_export_type',
+                             details=f"Formats: {', '.join(EXPORT_FORMATS)}")
+
+    filename = f"Woolly_{pk}.{export_type}"
+    rows = iter_export_rows(pk)
+    if export_type == 'csv':
+        # Rows are sent while they are fetched from the database
+        response = StreamingHttpResponse(stream_csv(rows), content_type=EXPORT_CONTENT_TYPES['csv'])
+        response['Content-Disposition'] = f'attachment;filename="{filename}"'
         return response
+
+    # Excel files cannot be streamed and are written to disk first
+    if Workbook is None:
+        raise APIException("L'export Excel n'est pas disponible", 'export_unavailable')
+    fileobj = TemporaryFile()
+    write_xlsx(rows, fileobj)
+    fileobj.seek(0)
+    return FileResponse(fileobj, as_attachment=True, filename=filename,
+                        content_type=EXPORT_CONTENT_TYPES['xlsx'])
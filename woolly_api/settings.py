@@ -29,6 +29,24 @@ MAX_PAYMENT_TIME = timedelta(hours=1)
 MAX_VALIDATION_TIME = timedelta(days=30)
 
 API_MODEL_CACHE_TIMEOUT = timedelta(minutes=30)
+# User profiles from the portal are cached in two tiers and refreshed in the background when stale
+USER_PROFILE_CACHE_TIMEOUT = timedelta(days=1)
+USER_PROFILE_REFRESH_AFTER = timedelta(minutes=5)
+USER_PROFILE_LRU_SIZE = 1000
+# Associations managed by each user, invalidated on login and logout
+MEMBERSHIP_CACHE_TIMEOUT = timedelta(minutes=10)
+TICKETS_CACHE_TIMEOUT = timedelta(days=7)
+# Orders with many tickets are rendered page by page in parallel
+TICKETS_RENDER_PROCESSES = env.int("TICKETS_RENDER_PROCESSES", os.cpu_count() or 1)
+TICKETS_PARALLEL_THRESHOLD = 20
+CHECKIN_INDEX_TIMEOUT = timedelta(days=1)
+RESPONSE_CACHE_TIMEOUT = timedelta(minutes=10)
+PAYUTC_SESSION_CACHE_TIMEOUT = timedelta(hours=1)
+PAYUTC_CATEGORY_CACHE_TIMEOUT = timedelta(days=1)
+
+ITEM_SYNC_MAX_ATTEMPTS = 10
+ITEM_SYNC_RETRY_DELAY = timedelta(seconds=30)
+ITEM_SYNC_MAX_RETRY_DELAY = timedelta(hours=1)
 
 VALID_TVA = {0, 5.5, 10, 20}
 
@@ -64,6 +82,11 @@ DATABASES = {
     'default': env.dj_db_url("DATABASE_URL"),
 }
 
+# Cache server, must be shared by the workers to share sessions
+CACHES = {
+    'default': env.dj_cache_url("CACHE_URL", "locmem://"),
+}
+
 # Email server
 email = env.dj_email_url("EMAIL_URL")
 EMAIL_HOST = email["EMAIL_HOST"]
@@ -160,7 +183,7 @@ INSTALLED_APPS = [
     'woolly_api.admin.AdminConfig',
     'core',
     'authentication',
-    'sales',
+    'sales.apps.SalesConfig',
     'payment',
 ]
 
@@ -169,6 +192,7 @@ ROOT_URLCONF = 'woolly_api.urls'
 WSGI_APPLICATION = 'woolly_api.wsgi.application'
 
 MIDDLEWARE = [
+    'core.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',